@@ -0,0 +1,354 @@
+"""
+Copyright (C) 2020-2024 JonathanFeenstra, Deivedux, kageroukw
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""Measure the per-message cost of the message listeners on a synthetic gateway event stream.
+
+Gateway payloads of message creates, edits and deletes are fed to the connection state of a QuoteBot that is not
+connected, so they are parsed and dispatched to `QuoteBot.on_message` and the listeners of the Highlights, Quote and
+Snipe cogs like real events. HTTP requests, like sending link quotes and highlight DMs, are answered by a fake
+client without any network access. The workload is generated from a fixed seed, so runs are comparable across
+commits.
+
+Usage (from the repository root):
+
+    python -m benchmarks.message_listeners [--messages 20000] [--rate 0] [--guilds 20] [--members 1000]
+        [--highlights 500] [--link-ratio 0.05] [--edit-ratio 0.05] [--delete-ratio 0.05] [--json results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import tempfile
+from collections import defaultdict
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Any, Optional
+
+import discord
+
+from bot import QuoteBot, apply_config_defaults
+from core.persistence import AsyncDatabaseConnection, ConnectionPool
+
+_BOT_ID = 1 << 40
+_CHANNELS_PER_GUILD = 10
+_VOCABULARY_SIZE = 2000
+_WORDS_PER_MESSAGE = (3, 20)
+# Messages that links, edits and deletes refer to are picked from the most recent messages of a guild
+_RECENT_MESSAGES = 200
+_TIMESTAMP = "2024-01-01T00:00:00+00:00"
+_BASE_SNOWFLAKE = discord.utils.time_snowflake(datetime(2024, 1, 1, tzinfo=timezone.utc))
+
+
+def _user_payload(user_id: int, bot: bool = False) -> dict[str, Any]:
+    return {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0", "avatar": None, "bot": bot}
+
+
+def _member_payload(user_id: int, bot: bool = False) -> dict[str, Any]:
+    return {
+        "user": _user_payload(user_id, bot),
+        "roles": [],
+        "joined_at": _TIMESTAMP,
+        "deaf": False,
+        "mute": False,
+        "flags": 0,
+    }
+
+
+def _guild_payload(guild_id: int, channel_ids: list[int], member_ids: list[int]) -> dict[str, Any]:
+    return {
+        "id": str(guild_id),
+        "name": f"guild{guild_id}",
+        "owner_id": str(member_ids[0]),
+        "roles": [
+            {
+                "id": str(guild_id),
+                "name": "@everyone",
+                "permissions": str(discord.Permissions.all().value),
+                "position": 0,
+                "color": 0,
+                "hoist": False,
+                "managed": False,
+                "mentionable": False,
+            }
+        ],
+        "channels": [
+            {"id": str(channel_id), "type": 0, "name": f"channel{i}", "position": i, "permission_overwrites": []}
+            for i, channel_id in enumerate(channel_ids)
+        ],
+        "members": [_member_payload(_BOT_ID, bot=True), *(_member_payload(member_id) for member_id in member_ids)],
+        "member_count": len(member_ids) + 1,
+        "threads": [],
+        "emojis": [],
+        "stickers": [],
+        "features": [],
+    }
+
+
+class _FakeHTTPClient(discord.http.HTTPClient):
+    """Answers the requests of the listeners with minimal payloads, instead of sending them to Discord."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        super().__init__(loop)
+        self.requests: dict[str, int] = defaultdict(int)
+        self._ids = iter(range(_BASE_SNOWFLAKE + (1 << 62), 1 << 63))
+
+    async def request(self, route: discord.http.Route, **kwargs: Any) -> Any:
+        self.requests[f"{route.method} {route.path}"] += 1
+        if route.path == "/users/@me/channels":
+            return {"id": str(next(self._ids)), "type": 1, "recipients": [_user_payload(kwargs["json"]["recipient_id"])]}
+        if route.method == "POST" and route.path == "/channels/{channel_id}/messages":
+            return {
+                "id": str(next(self._ids)),
+                "channel_id": str(route.channel_id),
+                "author": _user_payload(_BOT_ID, bot=True),
+                "content": "",
+                "timestamp": _TIMESTAMP,
+                "edited_timestamp": None,
+                "tts": False,
+                "mention_everyone": False,
+                "mentions": [],
+                "mention_roles": [],
+                "attachments": [],
+                "embeds": [],
+                "pinned": False,
+                "type": 0,
+            }
+        return None
+
+
+class _BenchmarkBot(QuoteBot):
+    def __init__(self, config: dict) -> None:
+        super().__init__(config)
+        self.listener_durations: dict[str, list[float]] = defaultdict(list)
+        self.pending_events: set[asyncio.Task] = set()
+
+    async def _run_event(self, coro: Any, event_name: str, *args: Any, **kwargs: Any) -> None:
+        start = perf_counter()
+        try:
+            await super()._run_event(coro, event_name, *args, **kwargs)
+        finally:
+            self.listener_durations[coro.__qualname__].append(perf_counter() - start)
+
+    def _schedule_event(self, coro: Any, event_name: str, *args: Any, **kwargs: Any) -> asyncio.Task:
+        task = super()._schedule_event(coro, event_name, *args, **kwargs)
+        self.pending_events.add(task)
+        task.add_done_callback(self.pending_events.discard)
+        return task
+
+
+class _Workload:
+    """Deterministic stream of gateway events over a set of guilds."""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.vocabulary = [f"word{i}" for i in range(_VOCABULARY_SIZE)]
+        self.guilds: list[tuple[int, list[int], list[int]]] = []
+        for g in range(args.guilds):
+            guild_id = _BASE_SNOWFLAKE + (g + 1) * 10_000_000
+            channel_ids = [guild_id + 1 + i for i in range(_CHANNELS_PER_GUILD)]
+            member_ids = [guild_id + 1_000_000 + i for i in range(args.members)]
+            self.guilds.append((guild_id, channel_ids, member_ids))
+        self.recent: dict[int, list[dict[str, Any]]] = defaultdict(list)
+        self._next_message_id = _BASE_SNOWFLAKE + (1 << 50)
+
+    def highlights(self) -> list[tuple[int, str, int]]:
+        """Get the user IDs, queries and guild IDs of the highlights, spread over the guilds."""
+        highlights = []
+        for _ in range(self.args.highlights):
+            guild_id, _, member_ids = self.rng.choice(self.guilds)
+            highlights.append((self.rng.choice(member_ids), rf"\b{self.rng.choice(self.vocabulary)}\b", guild_id))
+        return highlights
+
+    def next_event(self) -> tuple[str, dict[str, Any]]:
+        guild_id, channel_ids, member_ids = self.rng.choice(self.guilds)
+        recent = self.recent[guild_id]
+        roll = self.rng.random()
+        if recent and roll < self.args.delete_ratio:
+            msg = recent.pop(self.rng.randrange(len(recent)))
+            return "MESSAGE_DELETE", {"id": msg["id"], "channel_id": msg["channel_id"], "guild_id": msg["guild_id"]}
+        roll -= self.args.delete_ratio
+        if recent and roll < self.args.edit_ratio:
+            msg = self.rng.choice(recent)
+            msg = msg | {"content": self._content(), "edited_timestamp": _TIMESTAMP}
+            return "MESSAGE_UPDATE", msg
+        roll -= self.args.edit_ratio
+        content = self._content()
+        if recent and roll < self.args.link_ratio:
+            linked = self.rng.choice(recent)
+            content = f"https://discord.com/channels/{guild_id}/{linked['channel_id']}/{linked['id']} {content}"
+        author_id = self.rng.choice(member_ids)
+        self._next_message_id += 1 << 22
+        msg = {
+            "id": str(self._next_message_id),
+            "channel_id": str(self.rng.choice(channel_ids)),
+            "guild_id": str(guild_id),
+            "author": _user_payload(author_id),
+            "member": {"roles": [], "joined_at": _TIMESTAMP, "deaf": False, "mute": False, "flags": 0},
+            "content": content,
+            "timestamp": _TIMESTAMP,
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": [],
+            "embeds": [],
+            "pinned": False,
+            "type": 0,
+        }
+        recent.append(msg)
+        if len(recent) > _RECENT_MESSAGES:
+            del recent[0]
+        return "MESSAGE_CREATE", msg
+
+    def _content(self) -> str:
+        return " ".join(self.rng.choices(self.vocabulary, k=self.rng.randint(*_WORDS_PER_MESSAGE)))
+
+
+def _percentile(sorted_values: list[float], fraction: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+async def run_benchmark(args: argparse.Namespace) -> dict[str, Any]:
+    """Feed the workload to the listeners.
+
+    Returns:
+        dict[str, Any]: The throughput, the latency percentiles per listener and the database statements per message.
+    """
+    with open(os.path.join("configs", "credentials.json.example")) as config_data:
+        config = apply_config_defaults(json.load(config_data))
+    config["max_message_cache"] = args.message_cache
+    config["botlog_webhook_url"] = ""
+    bot = _BenchmarkBot(config)
+    # Binds the bot to the event loop, like entering `async with bot` does before logging in
+    await bot._async_setup_hook()
+    state = bot._connection
+    state.http = bot.http = _FakeHTTPClient(bot.loop)
+    state.user = discord.ClientUser(state=state, data=_user_payload(_BOT_ID, bot=True))  # type: ignore
+    # Highlight digests are sent in the background, so they don't wait for the coalesce window and cooldown
+    config["highlights"] |= {"cooldown": 0, "coalesce_window": 0}
+
+    workload = _Workload(args)
+    statements = 0
+
+    def count_statement(sql: str, duration: float, rows: Optional[int]) -> None:
+        nonlocal statements
+        statements += 1
+
+    with tempfile.TemporaryDirectory() as directory:
+        bot.db_pool = ConnectionPool(os.path.join(directory, "benchmark.db"), 1)
+        await bot.db_pool.open()
+        AsyncDatabaseConnection.query_observers.append(count_statement)
+        try:
+            async with bot.db_connect(write=True) as con:
+                await con.prepare_db(config["default_prefix"])
+            for extension in ("highlights", "quote", "snipe"):
+                await bot.load_extension(f"cogs.{extension}")
+            for guild_id, channel_ids, member_ids in workload.guilds:
+                state._add_guild_from_data(_guild_payload(guild_id, channel_ids, member_ids))  # type: ignore
+                bot.guild_settings.update(guild_id, quote_links=True)
+            for user_id, query, guild_id in workload.highlights():
+                bot.highlight_index.add(user_id, query, guild_id)
+            parsers = {
+                "MESSAGE_CREATE": state.parse_message_create,
+                "MESSAGE_UPDATE": state.parse_message_update,
+                "MESSAGE_DELETE": state.parse_message_delete,
+            }
+
+            async def feed(events: int) -> float:
+                start = perf_counter()
+                for i in range(events):
+                    event, data = workload.next_event()
+                    parsers[event](data)  # type: ignore
+                    if args.rate:
+                        await asyncio.sleep(max(0.0, start + (i + 1) / args.rate - perf_counter()))
+                    else:
+                        await asyncio.sleep(0)
+                while bot.pending_events:
+                    await asyncio.gather(*bot.pending_events)
+                return perf_counter() - start
+
+            await feed(args.warmup)
+            bot.listener_durations.clear()
+            statements = 0
+            elapsed = await feed(args.messages)
+            await asyncio.sleep(0.1)
+        finally:
+            AsyncDatabaseConnection.query_observers.remove(count_statement)
+            for extension in tuple(bot.extensions):
+                await bot.unload_extension(extension)
+            await bot.db_pool.close()
+            bot.pattern_search_pool.close()
+
+    listeners = {}
+    for listener, durations in sorted(bot.listener_durations.items()):
+        durations.sort()
+        listeners[listener] = {
+            "calls": len(durations),
+            "p50_us": _percentile(durations, 0.5) * 1e6,
+            "p99_us": _percentile(durations, 0.99) * 1e6,
+            "mean_us": statistics.fmean(durations) * 1e6,
+        }
+    return {
+        "events": args.messages,
+        "seconds": elapsed,
+        "events_per_second": args.messages / elapsed,
+        "db_statements_per_event": statements / args.messages,
+        "http_requests": dict(bot.http.requests),  # type: ignore
+        "listeners": listeners,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Measure the per-message cost of the message listeners on a synthetic gateway event stream."
+    )
+    parser.add_argument("--messages", type=int, default=20000, help="measured gateway events (default: 20000)")
+    parser.add_argument("--warmup", type=int, default=2000, help="unmeasured events sent first (default: 2000)")
+    parser.add_argument("--rate", type=float, default=0, help="events per second, 0 for as fast as possible (default: 0)")
+    parser.add_argument("--guilds", type=int, default=20, help="number of guilds (default: 20)")
+    parser.add_argument("--members", type=int, default=1000, help="members per guild (default: 1000)")
+    parser.add_argument("--highlights", type=int, default=500, help="guild highlights in total (default: 500)")
+    parser.add_argument("--link-ratio", type=float, default=0.05, help="ratio of messages with a link (default: 0.05)")
+    parser.add_argument("--edit-ratio", type=float, default=0.05, help="ratio of events that are edits (default: 0.05)")
+    parser.add_argument("--delete-ratio", type=float, default=0.05, help="ratio of events that are deletes (default: 0.05)")
+    parser.add_argument("--message-cache", type=int, default=5000, help="size of the message cache (default: 5000)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the workload (default: 0)")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = await run_benchmark(args)
+    print(
+        f"{results['events']} events in {results['seconds']:.2f}s: {results['events_per_second']:.0f} events/s, "
+        f"{results['db_statements_per_event']:.3f} database statements/event"
+    )
+    print(f"{'listener':<48}{'calls':>10}{'p50 (µs)':>12}{'p99 (µs)':>12}{'mean (µs)':>12}")
+    for listener, stats in results["listeners"].items():
+        print(f"{listener:<48}{stats['calls']:>10}{stats['p50_us']:>12.1f}{stats['p99_us']:>12.1f}{stats['mean_us']:>12.1f}")
+    for request, count in sorted(results["http_requests"].items()):
+        print(f"{count} requests to {request}")
+    if args.json:
+        with open(args.json, "w") as results_file:
+            json.dump({"arguments": vars(args), "results": results}, results_file, indent=4)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,303 @@
+"""
+Copyright (C) 2020-2024 JonathanFeenstra, Deivedux, kageroukw
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""Time the queries of the persistence mixins against a database of production scale.
+
+A seeded generator fills a fresh database with the schema of `prepare_db`, after which the methods of
+`QuoteBotDatabaseConnection` are timed through a `ConnectionPool`, the same way the bot uses them: reads on the reader
+connections and writes on the writer connection with a commit after each call. The size of the database file and the
+growth of the WAL per write workload are reported as well, so schema and index changes can be compared by numbers.
+
+Usage (from the repository root):
+
+    python -m benchmarks.persistence_scale [--guilds 100000] [--channels 1000000] [--messages 1000000]
+        [--saved-quotes 500000] [--highlights 200000] [--profile durable] [--directory /path/on/target/disk]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import string
+import tempfile
+from collections.abc import Awaitable, Callable, Iterator
+from time import perf_counter
+from typing import Any
+
+from core.persistence import PERFORMANCE_PROFILES, ConnectionPool, QuoteBotDatabaseConnection, performance_pragmas
+
+# Lowest 22 bits of the generated IDs, so IDs of different kinds never collide, e.g. a saved quote owned by a user
+# is not deleted with a guild. The higher bits count up, which spreads the guilds evenly over the shards.
+_GUILD, _CHANNEL, _MESSAGE, _USER = range(1, 5)
+_SHARD_COUNT = 16
+_SAVED_QUOTE_GUILD_OWNER_RATIO = 0.2
+_GLOBAL_HIGHLIGHT_RATIO = 0.3
+_QUERY_LENGTH = (4, 12)
+
+
+def _snowflake(kind: int, index: int) -> int:
+    return ((index + 1) << 22) | kind
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def _latency_stats(durations: list[float]) -> dict[str, float]:
+    durations = sorted(durations)
+    return {
+        "calls": len(durations),
+        "p50_ms": statistics.median(durations) * 1e3,
+        "p99_ms": durations[min(len(durations) - 1, int(len(durations) * 0.99))] * 1e3,
+        "mean_ms": statistics.fmean(durations) * 1e3,
+    }
+
+
+class _Dataset:
+    """Seeded rows of all tables, generated lazily so millions of rows are not kept in memory."""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.users = max(1, args.highlights // args.highlights_per_user)
+        rng = random.Random(args.seed)
+        # The highlights are kept, since the workloads look up the queries of existing highlights
+        self.highlights: dict[tuple[int, str, int], None] = {}
+        while len(self.highlights) < args.highlights:
+            query = "".join(rng.choices(string.ascii_lowercase, k=rng.randint(*_QUERY_LENGTH)))
+            guild_id = 0 if rng.random() < _GLOBAL_HIGHLIGHT_RATIO else self.guild_id(rng.randrange(args.guilds))
+            self.highlights[(_snowflake(_USER, rng.randrange(self.users)), query, guild_id)] = None
+
+    def guild_id(self, index: int) -> int:
+        return _snowflake(_GUILD, index)
+
+    def channel_id(self, index: int) -> int:
+        return _snowflake(_CHANNEL, index)
+
+    def guild_rows(self) -> Iterator[int]:
+        return (self.guild_id(i) for i in range(self.args.guilds))
+
+    def channel_rows(self) -> Iterator[tuple[int, int]]:
+        return ((self.channel_id(i), self.guild_id(i % self.args.guilds)) for i in range(self.args.channels))
+
+    def message_rows(self) -> Iterator[tuple[int, int]]:
+        rng = random.Random(self.args.seed + 1)
+        return (
+            (_snowflake(_MESSAGE, i), self.channel_id(rng.randrange(self.args.channels))) for i in range(self.args.messages)
+        )
+
+    def saved_quote_rows(self) -> Iterator[tuple[int, str, int]]:
+        rng = random.Random(self.args.seed + 2)
+        for i in range(self.args.saved_quotes):
+            if rng.random() < _SAVED_QUOTE_GUILD_OWNER_RATIO:
+                owner_id = self.guild_id(rng.randrange(self.args.guilds))
+            else:
+                owner_id = _snowflake(_USER, rng.randrange(self.users))
+            yield owner_id, f"quote{i}", _snowflake(_MESSAGE, rng.randrange(self.args.messages))
+
+
+class _ScaleBenchmark:
+    def __init__(self, args: argparse.Namespace, database: str) -> None:
+        self.args = args
+        self.database = database
+        self.dataset = _Dataset(args)
+        self.rng = random.Random(args.seed + 3)
+        self.pool = ConnectionPool(database, 1, performance_pragmas(args.profile))
+        # Guilds and channels that are not deleted yet, for the delete workloads to pick from
+        self.guild_ids = list(self.dataset.guild_rows())
+        self.channel_ids = [self.dataset.channel_id(i) for i in range(args.channels)]
+
+    async def run(self) -> dict[str, Any]:
+        await self.pool.open()
+        try:
+            start = perf_counter()
+            await self._populate()
+            results: dict[str, Any] = {"populate_seconds": perf_counter() - start, "after_populate": await self._sizes()}
+            results["workloads"] = workloads = {}
+            highlights = list(self.dataset.highlights)
+            workloads["fetch_prefix"] = await self._time_reads(
+                self.args.samples, lambda con: con.fetch_prefix(self.rng.choice(self.guild_ids))
+            )
+            workloads["fetch_highlights"] = await self._time_reads(self.args.full_scans, lambda con: con.fetch_highlights())
+
+            def fetch_user_highlights_starting_with(con: QuoteBotDatabaseConnection) -> Awaitable[Any]:
+                user_id, query, guild_id = self.rng.choice(highlights)
+                prefix = query[: self.rng.randint(1, 3)]
+                return con.fetch_user_highlights_starting_with(user_id, prefix, guild_id)
+
+            workloads["fetch_user_highlights_starting_with"] = await self._time_reads(
+                self.args.samples, fetch_user_highlights_starting_with
+            )
+            workloads["delete_guild"] = await self._time_writes(
+                self.args.deletes, lambda con: con.delete_guild(self._pop_random(self.guild_ids))
+            )
+            workloads["delete_channel_or_thread"] = await self._time_writes(
+                self.args.deletes, lambda con: con.delete_channel_or_thread(self._pop_random(self.channel_ids))
+            )
+
+            def filter_guilds(con: QuoteBotDatabaseConnection) -> Awaitable[None]:
+                # Like reconciling after being removed from some guilds while offline
+                for _ in range(self.args.filter_removed):
+                    self._pop_random(self.guild_ids)
+                return con.filter_guilds(self.guild_ids)
+
+            workloads["filter_guilds"] = await self._time_writes(self.args.filter_runs, filter_guilds)
+
+            def filter_guilds_of_shards(con: QuoteBotDatabaseConnection) -> Awaitable[None]:
+                shard_ids = range(_SHARD_COUNT // 2)
+                for _ in range(self.args.filter_removed):
+                    self._pop_random(self.guild_ids)
+                return con.filter_guilds(
+                    (guild_id for guild_id in self.guild_ids if (guild_id >> 22) % _SHARD_COUNT in shard_ids),
+                    shard_ids,
+                    _SHARD_COUNT,
+                )
+
+            workloads["filter_guilds (half of the shards)"] = await self._time_writes(
+                self.args.filter_runs, filter_guilds_of_shards
+            )
+            results["after_workloads"] = await self._sizes()
+            return results
+        finally:
+            await self.pool.close()
+
+    async def _populate(self) -> None:
+        async with self.pool.acquire(write=True) as con:
+            await con.prepare_db(">")
+            async with con.transaction():
+                await con.insert_guilds(self.dataset.guild_rows(), ">")
+                await con.executemany("INSERT INTO channel VALUES (?, ?)", self.dataset.channel_rows())
+                await con.executemany("INSERT INTO message VALUES (?, ?)", self.dataset.message_rows())
+                await con.executemany("INSERT INTO saved_quote VALUES (?, ?, ?)", self.dataset.saved_quote_rows())
+                await con.executemany("INSERT INTO highlight VALUES (?, ?, ?)", self.dataset.highlights)
+            await con.execute("ANALYZE")
+
+    def _pop_random(self, ids: list[int]) -> int:
+        index = self.rng.randrange(len(ids))
+        ids[index], ids[-1] = ids[-1], ids[index]
+        return ids.pop()
+
+    async def _time_reads(
+        self, calls: int, call: Callable[[QuoteBotDatabaseConnection], Awaitable[Any]]
+    ) -> dict[str, float]:
+        durations = []
+        for _ in range(calls):
+            async with self.pool.acquire() as con:
+                start = perf_counter()
+                await call(con)
+                durations.append(perf_counter() - start)
+        return _latency_stats(durations)
+
+    async def _time_writes(
+        self, calls: int, call: Callable[[QuoteBotDatabaseConnection], Awaitable[Any]]
+    ) -> dict[str, float]:
+        """Time writes including their commit, and measure how much they grew the WAL."""
+        await self._checkpoint()
+        durations = []
+        for _ in range(calls):
+            start = perf_counter()
+            async with self.pool.acquire(write=True) as con:
+                await call(con)
+                await con.commit()
+            durations.append(perf_counter() - start)
+        return _latency_stats(durations) | {"wal_bytes": _file_size(f"{self.database}-wal")}
+
+    async def _checkpoint(self) -> None:
+        """Write the WAL back into the database and truncate it, so the next workload starts with an empty WAL."""
+        async with self.pool.acquire(write=True) as con:
+            await con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    async def _sizes(self) -> dict[str, int]:
+        await self._checkpoint()
+        async with self.pool.acquire() as con:
+            page_count = (await con.execute_fetchone("PRAGMA page_count"))[0]  # type: ignore
+            freelist_count = (await con.execute_fetchone("PRAGMA freelist_count"))[0]  # type: ignore
+        return {"file_bytes": _file_size(self.database), "pages": page_count, "free_pages": freelist_count}
+
+
+async def run_benchmark(args: argparse.Namespace) -> dict[str, Any]:
+    """Generate the database and run the workloads against it.
+
+    Returns:
+        dict[str, Any]: The population time, the latency percentiles and WAL growth per workload, and the file sizes.
+    """
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        return await _ScaleBenchmark(args, os.path.join(directory, "benchmark.db")).run()
+
+
+def _format_size(size: int) -> str:
+    return f"{size / 2**20:.1f} MiB"
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Time the queries of the persistence mixins against a database of production scale."
+    )
+    parser.add_argument("--guilds", type=int, default=100_000, help="number of guilds (default: 100000)")
+    parser.add_argument("--channels", type=int, default=1_000_000, help="number of channels (default: 1000000)")
+    parser.add_argument("--messages", type=int, default=1_000_000, help="number of messages (default: 1000000)")
+    parser.add_argument("--saved-quotes", type=int, default=500_000, help="number of saved quotes (default: 500000)")
+    parser.add_argument("--highlights", type=int, default=200_000, help="number of highlights (default: 200000)")
+    parser.add_argument("--highlights-per-user", type=int, default=4, help="average highlights per user (default: 4)")
+    parser.add_argument("--samples", type=int, default=2000, help="calls per lookup workload (default: 2000)")
+    parser.add_argument("--full-scans", type=int, default=5, help="calls of fetch_highlights (default: 5)")
+    parser.add_argument("--deletes", type=int, default=200, help="calls per delete workload (default: 200)")
+    parser.add_argument("--filter-runs", type=int, default=5, help="calls per filter_guilds workload (default: 5)")
+    parser.add_argument(
+        "--filter-removed", type=int, default=10, help="guilds removed before each filter_guilds call (default: 10)"
+    )
+    parser.add_argument(
+        "--profile", default="durable", choices=PERFORMANCE_PROFILES, help="database profile (default: durable)"
+    )
+    parser.add_argument("--directory", help="directory for the temporary database, to measure a specific disk")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated data (default: 0)")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args()
+    # Both filter_guilds workloads remove guilds as well
+    if args.deletes + 2 * args.filter_runs * args.filter_removed > args.guilds:
+        parser.error("--deletes plus 2 * --filter-runs * --filter-removed must not exceed --guilds")
+    if args.deletes > args.channels:
+        parser.error("--deletes must not exceed --channels")
+
+    results = await run_benchmark(args)
+    after_populate, after_workloads = results["after_populate"], results["after_workloads"]
+    print(
+        f"Populated in {results['populate_seconds']:.1f}s: {_format_size(after_populate['file_bytes'])}, "
+        f"{after_populate['pages']} pages ({after_populate['free_pages']} free)"
+    )
+    print(f"{'workload':<40}{'calls':>8}{'p50 (ms)':>12}{'p99 (ms)':>12}{'mean (ms)':>12}{'WAL':>14}")
+    for workload, stats in results["workloads"].items():
+        wal = _format_size(stats["wal_bytes"]) if "wal_bytes" in stats else ""
+        print(
+            f"{workload:<40}{stats['calls']:>8}{stats['p50_ms']:>12.3f}{stats['p99_ms']:>12.3f}{stats['mean_ms']:>12.3f}"
+            f"{wal:>14}"
+        )
+    print(
+        f"After the workloads: {_format_size(after_workloads['file_bytes'])}, "
+        f"{after_workloads['pages']} pages ({after_workloads['free_pages']} free)"
+    )
+    if args.json:
+        with open(args.json, "w") as results_file:
+            json.dump({"arguments": vars(args), "results": results}, results_file, indent=4)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
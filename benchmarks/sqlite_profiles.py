@@ -0,0 +1,136 @@
+"""
+Copyright (C) 2020-2024 JonathanFeenstra, Deivedux, kageroukw
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""Compare the database performance profiles on a workload of the persistence mixins.
+
+Each profile gets a fresh database in a temporary directory, which is queried through a `ConnectionPool` the same way
+the bot does: one pooled connection per operation and a commit after every write.
+
+Usage (from the repository root):
+
+    python -m benchmarks.sqlite_profiles [--operations 2000] [--profiles durable fast] [--directory /path/on/target/disk]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+from collections.abc import Awaitable, Callable
+from time import perf_counter
+
+from core.persistence import PERFORMANCE_PROFILES, ConnectionPool, performance_pragmas
+
+_GUILDS = 100
+_CHANNELS_PER_GUILD = 10
+_SAVED_QUOTE_OWNERS = 500
+
+
+def _channel_id(guild_id: int, index: int) -> int:
+    return guild_id * 1000 + index
+
+
+async def _time_operations(operations: int, operation: Callable[[int], Awaitable[None]]) -> float:
+    start = perf_counter()
+    for i in range(operations):
+        await operation(i)
+    return operations / (perf_counter() - start)
+
+
+async def _populate(pool: ConnectionPool, operations: int) -> None:
+    async with pool.acquire(write=True) as con:
+        await con.prepare_db(">")
+        async with con.transaction():
+            await con.insert_guilds(range(1, _GUILDS + 1), ">")
+            await con.executemany(
+                "INSERT INTO channel VALUES (?, ?)",
+                (
+                    (_channel_id(guild_id, i), guild_id)
+                    for guild_id in range(1, _GUILDS + 1)
+                    for i in range(_CHANNELS_PER_GUILD)
+                ),
+            )
+            await con.executemany(
+                "INSERT INTO message VALUES (?, ?)",
+                ((msg_id, _channel_id(msg_id % _GUILDS + 1, msg_id % _CHANNELS_PER_GUILD)) for msg_id in range(operations)),
+            )
+            await con.executemany(
+                "INSERT INTO saved_quote VALUES (?, ?, ?)",
+                ((msg_id % _SAVED_QUOTE_OWNERS, f"alias{msg_id}", msg_id) for msg_id in range(operations)),
+            )
+
+
+async def benchmark_profile(profile: str, operations: int, directory: str | None = None, seed: int = 0) -> dict[str, float]:
+    """Run the workload against a fresh database using a performance profile.
+
+    Returns:
+        dict[str, float]: The workload names mapped to the measured operations per second.
+    """
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory(dir=directory) as tmp_directory:
+        pool = ConnectionPool(os.path.join(tmp_directory, "benchmark.db"), 1, performance_pragmas(profile))
+        await pool.open()
+        try:
+            await _populate(pool, operations)
+
+            async def insert_highlight(i: int) -> None:
+                async with pool.acquire(write=True) as con:
+                    await con.insert_highlight(
+                        rng.randrange(10_000), f"pattern{i}", rng.choice((0, rng.randint(1, _GUILDS)))
+                    )
+                    await con.commit()
+
+            async def look_up_saved_quote(_: int) -> None:
+                msg_id = rng.randrange(operations)
+                async with pool.acquire() as con:
+                    if await con.fetch_saved_quote_message_id(msg_id % _SAVED_QUOTE_OWNERS, f"alias{msg_id}"):
+                        await con.fetch_message_channel_or_thread(msg_id)
+
+            async def delete_message(i: int) -> None:
+                async with pool.acquire(write=True) as con:
+                    await con.delete_message(i)
+                    await con.commit()
+
+            return {
+                "highlight inserts": await _time_operations(operations, insert_highlight),
+                "saved quote lookups": await _time_operations(operations, look_up_saved_quote),
+                "message deletes": await _time_operations(operations, delete_message),
+            }
+        finally:
+            await pool.close()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compare the database performance profiles on a workload of the persistence mixins."
+    )
+    parser.add_argument("--operations", type=int, default=2000, help="operations per workload (default: 2000)")
+    parser.add_argument(
+        "--profiles", nargs="+", default=list(PERFORMANCE_PROFILES), choices=PERFORMANCE_PROFILES, help="profiles to run"
+    )
+    parser.add_argument("--directory", help="directory for the temporary databases, to measure a specific disk")
+    args = parser.parse_args()
+
+    results = {profile: await benchmark_profile(profile, args.operations, args.directory) for profile in args.profiles}
+    workloads = next(iter(results.values())).keys()
+    print(f"{'profile':<12}" + "".join(f"{workload:>24}" for workload in workloads) + "   (operations/s)")
+    for profile, result in results.items():
+        print(f"{profile:<12}" + "".join(f"{result[workload]:>24.0f}" for workload in workloads))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -20,17 +20,103 @@ import importlib
 import json
 import os
 from sys import stderr
-from traceback import print_tb
-from typing import Awaitable, Callable, Iterable, List, NamedTuple, Optional, Set
+from time import perf_counter
+from traceback import print_exc, print_tb
+from typing import Any, AsyncContextManager, Awaitable, Callable, Iterable, Iterator, List, NamedTuple, Optional, Set
 
 import discord
 from aiohttp import ClientSession
-from aiosqlite import connect
 from discord.ext import commands
 
+from core.cache import LRUCache
+from core.cluster import ClusterClient, shard_id_of
+from core.guild_settings import GuildSettingsCache
 from core.help import QuoteBotHelpCommand
+from core.highlight_index import HighlightIndex
+from core.message_cache import FetchedMessageCache, IndexedConnectionState, read_rss
 from core.message_retrieval import DEFAULT_AVATAR_URL, MESSAGE_URL_RE, MessageRetrievalContext
-from core.persistence import QuoteBotDatabaseConnection, connect
+from core.metrics import CallbackMetric, MetricsRegistry, MetricsServer, RateLimitCounter
+from core.pattern_search import PatternSearchPool, PatternTooExpensive
+from core.persistence import AsyncDatabaseConnection, ConnectionPool, QuoteBotDatabaseConnection, performance_pragmas
+from core.query_stats import QueryStats
+from core.recent_messages import RecentMessageBuffers
+from core.render_cache import RenderCache, RenderKey
+from core.snipe_store import SnipeStore
+from core.thread_joins import PRIORITY_DEFAULT, PRIORITY_FEATURES, PRIORITY_NEEDED, ThreadJoinScheduler
+from core.timing import BootReport, PhaseTimer
+from core.watchdog import LoopWatchdog, Stall
+
+_CONFIG_DEFAULTS = {
+    "database": {
+        "readers": 4,
+        "profile": "durable",
+        "pragmas": {},
+        "slow_query_ms": 100,
+    },
+    "message_retrieval": {
+        "probe_concurrency": 8,
+        "remembered_message_channels": 10000,
+    },
+    "pattern_search": {
+        "workers": 2,
+        "timeout": 1.0,
+    },
+    "highlights": {
+        "delivery_workers": 4,
+        "cooldown": 10,
+        "coalesce_window": 2,
+    },
+    "clone": {
+        "prefetch_messages": 3,
+        "memory_budget_mb": 32,
+    },
+    "snipe": {
+        "max_bytes": 16777216,
+        "ttl": 86400,
+        "entries_per_channel": 10,
+    },
+    "message_cache": {
+        "fetched_max_messages": 1000,
+        "fetched_ttl": 600,
+        "target_rss_mb": None,
+    },
+    "render_cache": {
+        "max_entries": 2048,
+    },
+    "thread_joins": {
+        "workers": 4,
+        "lazy": False,
+    },
+    "cluster": {
+        "processes": 2,
+        "shard_count": None,
+        "hub_port": 8765,
+    },
+    "metrics": {
+        "enabled": False,
+        "host": "127.0.0.1",
+        "port": 9100,
+    },
+    "recent_messages": {
+        "messages_per_channel": 100,
+        "max_channels": 5000,
+    },
+    "watchdog": {
+        "stall_threshold": 0.25,
+        "alert_interval": 300,
+        "debug": False,
+    },
+}
+# Interval in seconds between resident set size checks when the message cache is sized by a target
+_RSS_CHECK_INTERVAL = 60
+_MIN_MESSAGE_CACHE_SIZE = 100
+
+
+def apply_config_defaults(config: dict) -> dict:
+    """Fill in the default values of missing options in the sections of the configuration."""
+    for section, defaults in _CONFIG_DEFAULTS.items():
+        config[section] = defaults | config.get(section, {})
+    return config
 
 
 class QuoteText(NamedTuple):
@@ -38,6 +124,11 @@ class QuoteText(NamedTuple):
     raw_embed: str
 
 
+class RenderedQuote(NamedTuple):
+    content: Optional[str]
+    embed: discord.Embed
+
+
 class QuoteBot(commands.AutoShardedBot):
     _QUOTE_TYPE_TEXT = {
         "quote": QuoteText("Quoted", "quoted"),
@@ -48,8 +139,26 @@ class QuoteBot(commands.AutoShardedBot):
     }
     owner_ids: Set[int]
 
-    def __init__(self, config: dict) -> None:
+    def __init__(
+        self,
+        config: dict,
+        shard_ids: Optional[List[int]] = None,
+        shard_count: Optional[int] = None,
+        cluster_id: Optional[int] = None,
+        cluster_port: Optional[int] = None,
+    ) -> None:
+        """Create a QuoteBot running all shards, or a range of shards as one process of a cluster.
+
+        Args:
+            config (dict): The configuration from `credentials.json`.
+            shard_ids (List[int], optional): The shards to run, all shards if not specified.
+            shard_count (int, optional): The total number of shards, recommended by Discord if not specified.
+            cluster_id (int, optional): The ID of the process in cluster mode.
+            cluster_port (int, optional): The port of the cluster hub in cluster mode.
+        """
         super().__init__(
+            shard_ids=shard_ids,
+            shard_count=shard_count,
             help_command=QuoteBotHelpCommand(),
             command_prefix=self.get_prefix,  # type: ignore
             case_insensitive=True,
@@ -67,48 +176,259 @@ class QuoteBot(commands.AutoShardedBot):
             ),
         )
 
-        self.config = config
+        self.config = config = apply_config_defaults(config)
+        self.guild_settings = GuildSettingsCache(config["default_prefix"])
+        self.highlight_index = HighlightIndex()
+        # IDs in the `message` table, so deletions of messages without saved quotes don't need a database query
+        self.saved_message_ids: Set[int] = set()
+        # Channel or thread IDs of messages quoted by bare ID, to avoid probing the guild again
+        self.message_channel_ids: LRUCache[int, int] = LRUCache(config["message_retrieval"]["remembered_message_channels"])
+        recent_messages_config = config["recent_messages"]
+        self.recent_messages = RecentMessageBuffers(
+            recent_messages_config["messages_per_channel"], recent_messages_config["max_channels"]
+        )
+        pattern_search_config = config["pattern_search"]
+        self.pattern_search_pool = PatternSearchPool(pattern_search_config["workers"], pattern_search_config["timeout"])
+        snipe_config = config["snipe"]
+        self.snipe_store = SnipeStore(snipe_config["max_bytes"], snipe_config["ttl"], snipe_config["entries_per_channel"])
+        # Deleted messages are only available while in the message cache, so older classifications would be unused
+        self._command_message_ids: LRUCache[int, bool] = LRUCache(config["max_message_cache"])
+        self.render_cache = RenderCache(config["render_cache"]["max_entries"])
+        message_cache_config = config["message_cache"]
+        self._connection.fetched_messages = FetchedMessageCache(
+            message_cache_config["fetched_max_messages"], message_cache_config["fetched_ttl"]
+        )
+        self.thread_joins = ThreadJoinScheduler(config["thread_joins"]["workers"])
+        self.boot_report = BootReport()
+        # Created in `startup`
+        self.db_pool: Optional[ConnectionPool] = None
+        self.session: Optional[ClientSession] = None
+        # Set when startup is done with the database, successfully if `_database_prepared` is also set
+        self._database_ready = asyncio.Event()
+        self._database_prepared = False
+        # Shards that have not been reconciled since startup, or None when startup is complete
+        self._booting_shard_ids: Optional[Set[int]] = None
+        self._register_metrics()
+        self.watchdog = LoopWatchdog(config["watchdog"]["stall_threshold"], self._on_loop_stall, self._loop_lag.observe)
+        self.cluster: Optional[ClusterClient] = None
+        if cluster_port is not None and shard_ids is not None and shard_count is not None:
+            self.cluster = ClusterClient(cluster_port, cluster_id or 0, shard_ids, shard_count, self._on_cluster_message)
         print("Bot configured.")
 
+    def _register_metrics(self) -> None:
+        self.metrics = MetricsRegistry()
+        self.metrics_server: Optional[MetricsServer] = None
+        self._event_durations = self.metrics.histogram(
+            "quotebot_listener_duration_seconds", "Duration of event listeners.", ("listener",)
+        )
+        self._command_durations = self.metrics.histogram(
+            "quotebot_command_duration_seconds", "Duration of commands after their checks passed.", ("command", "status")
+        )
+        self._command_starts: dict[int, float] = {}
+        self.before_invoke(self._start_command_timer)
+        self.after_invoke(self._stop_command_timer)
+        query_durations = self.metrics.histogram(
+            "quotebot_db_query_duration_seconds", "Duration of database statements.", ("statement",)
+        )
+        self.query_stats = QueryStats()
+        AsyncDatabaseConnection.query_observers = [
+            lambda sql, duration, rows: query_durations.observe(duration, sql.lstrip().split(None, 1)[0].upper()),
+            self.query_stats.record,
+        ]
+        if (slow_query_ms := self.config["database"]["slow_query_ms"]) is not None:
+            AsyncDatabaseConnection.slow_query_threshold = slow_query_ms / 1000
+        self.highlight_matches = self.metrics.counter(
+            "quotebot_highlight_matches_total", "Highlights matched by messages and enqueued for delivery."
+        )
+        RateLimitCounter(
+            self.metrics.counter("quotebot_discord_rate_limited_total", "HTTP 429 responses from Discord.", ("logger",))
+        ).install()
+        self._loop_lag = self.metrics.histogram(
+            "quotebot_event_loop_lag_seconds", "How much later than scheduled the event loop resumed a sleeping task."
+        )
+        self.metrics.register(
+            CallbackMetric(
+                "quotebot_cache_entries", "Number of entries in the in-memory caches.", ("cache",), self._cache_sizes
+            )
+        )
+        self.metrics.register(
+            CallbackMetric(
+                "quotebot_snipe_bytes", "Estimated size of the sniped messages.", (), lambda: {(): self.snipe_store.nbytes}
+            )
+        )
+        self.metrics.register(
+            CallbackMetric(
+                "quotebot_boot_phase_duration_seconds",
+                "Duration of the startup phases.",
+                ("phase",),
+                lambda: {(name,): duration for name, (_, duration) in self.boot_report.phases.items()},
+            )
+        )
+        self.metrics.register(
+            CallbackMetric(
+                "quotebot_highlight_digests_total",
+                "Highlight digests sent as DMs by result.",
+                ("result",),
+                self._highlight_digest_counts,
+                "counter",
+            )
+        )
+
+    def _cache_sizes(self) -> dict[tuple[str, ...], float]:
+        messages = self._connection._messages
+        return {
+            ("messages",): len(messages) if messages is not None else 0,
+            ("fetched_messages",): len(self._connection.fetched_messages),
+            ("snipes",): len(self.snipe_store),
+            ("rendered_quotes",): len(self.render_cache),
+            ("recent_message_snapshots",): len(self.recent_messages),
+            ("thread_joins",): len(self.thread_joins),
+        }
+
+    def _highlight_digest_counts(self) -> dict[tuple[str, ...], float]:
+        if (highlights := self.get_cog("Highlights")) is None:
+            return {}
+        stats = highlights.delivery_queue.stats()  # type: ignore
+        return {("sent",): stats.sent, ("failed",): stats.failed}
+
+    async def _start_command_timer(self, ctx: commands.Context) -> None:
+        self._command_starts[id(ctx)] = perf_counter()
+
+    async def _stop_command_timer(self, ctx: commands.Context) -> None:
+        if (start := self._command_starts.pop(id(ctx), None)) is not None and ctx.command is not None:
+            self._command_durations.observe(
+                perf_counter() - start, ctx.command.qualified_name, "error" if ctx.command_failed else "ok"
+            )
+
+    async def _run_event(self, coro: Callable[..., Awaitable[Any]], event_name: str, *args: Any, **kwargs: Any) -> None:
+        start = perf_counter()
+        try:
+            await super()._run_event(coro, event_name, *args, **kwargs)
+        finally:
+            self._event_durations.observe(perf_counter() - start, coro.__qualname__)
+
+    async def _start_metrics_server(self) -> None:
+        metrics_config = self.config["metrics"]
+        # Each process of a cluster serves its own metrics on the next port
+        port = metrics_config["port"] + (self.cluster.cluster_id if self.cluster is not None else 0)
+        try:
+            self.metrics_server = MetricsServer(self.metrics, metrics_config["host"], port)
+            await self.metrics_server.start()
+        except (ValueError, OSError) as error:
+            self.metrics_server = None
+            print(f"Metrics endpoint not started: {error}", file=stderr)
+            return
+        print(f"Metrics served at http://{metrics_config['host']}:{port}/metrics.")
+
+    def _start_watchdog(self) -> None:
+        watchdog_config = self.config["watchdog"]
+        if watchdog_config["debug"]:
+            # Makes asyncio log every callback or task step that takes longer than the threshold, at a performance cost
+            self.loop.set_debug(True)
+            self.loop.slow_callback_duration = watchdog_config["stall_threshold"] or self.loop.slow_callback_duration
+        self.watchdog.start()
+
+    def _on_loop_stall(self, stall: Stall) -> None:
+        print(f"Event loop blocked for {stall.duration:.3f}s by {stall.task or 'unknown'}.", file=stderr)
+        if stall.stack is not None:
+            print(stall.stack, end="", file=stderr)
+        self.dispatch("loop_stall", stall)
+
+    def _get_state(self, **options) -> IndexedConnectionState:
+        return IndexedConnectionState(
+            dispatch=self.dispatch, handlers=self._handlers, hooks=self._hooks, http=self.http, **options
+        )
+
     async def setup_hook(self):
+        self.thread_joins.start()
+        self.pattern_search_pool.start()
+        if self.cluster is not None:
+            self.cluster.start()
         self.loop.create_task(self.startup())
+        if (target_rss_mb := self.config["message_cache"]["target_rss_mb"]) is not None:
+            self.loop.create_task(self._fit_message_cache_to_rss(target_rss_mb * 2**20))
 
-    async def startup(self) -> None:
-        self.session = ClientSession(loop=self.loop)
-        await self._load_extensions()
-        print("Extensions loaded.")
+    async def _fit_message_cache_to_rss(self, target_rss: int) -> None:
+        """Periodically resize the message cache to keep the resident set size of the process near a target."""
+        if read_rss() is None:
+            print("Resident set size unavailable, message cache size is fixed.", file=stderr)
+            return
+        while not self.is_closed():
+            await asyncio.sleep(_RSS_CHECK_INTERVAL)
+            if (messages := self._connection._messages) is None or (rss := read_rss()) is None:
+                return
+            if rss > target_rss:
+                maxlen = max(_MIN_MESSAGE_CACHE_SIZE, int(len(messages) * 0.9))
+            elif rss < target_rss * 0.9 and len(messages) >= (messages.maxlen or 0):
+                maxlen = int(len(messages) * 1.1) + 1
+            else:
+                continue
+            self._connection.max_messages = maxlen
+            messages.resize(maxlen)
 
-        async with self.db_connect() as con:
-            await con.prepare_db(self.config["default_prefix"])
-        print("Database prepared.")
+    async def startup(self) -> None:
+        database_config = self.config["database"]
+        boot = self.boot_report
+        try:
+            with boot.phase("database pool"):
+                self.db_pool = ConnectionPool(
+                    os.path.join("configs", "QuoteBot.db"),
+                    database_config["readers"],
+                    performance_pragmas(database_config["profile"], database_config["pragmas"]),
+                )
+                await self.db_pool.open()
+            with boot.phase("session"):
+                self.session = ClientSession(loop=self.loop)
+                self._start_watchdog()
+                if self.config["metrics"]["enabled"]:
+                    await self._start_metrics_server()
+            # The extensions don't use the database while loading, so they are loaded while the database is prepared
+            await asyncio.gather(self._load_extensions(), self._prepare_database())
+        except Exception:
+            print("Startup failed:", file=stderr)
+            print_exc()
+            raise
+        finally:
+            # Wakes up the waiting shards also when startup failed, so they don't wait forever
+            self._database_ready.set()
+        print("Extensions loaded and database prepared.")
+        with boot.phase("application info"):
+            self.owner_ids.add((await self.application_info()).owner.id)
+        # The guilds are reconciled per shard in `on_shard_ready`
+
+    async def _prepare_database(self) -> None:
+        with self.boot_report.phase("database"):
+            async with self.db_connect(write=True) as con:
+                await con.prepare_db(self.config["default_prefix"])
+                await self._load_caches(con)
+        self._database_prepared = True
+
+    def db_connect(self, write: bool = False) -> AsyncContextManager[QuoteBotDatabaseConnection]:
+        """Acquire a pooled database connection.
 
-        await self.wait_until_ready()
-        self.owner_ids.add((await self.application_info()).owner.id)
-        await self._update_guilds()
-        print("Servers updated.")
+        Args:
+            write (bool, optional): Whether the connection is used to modify the database. Defaults to False.
 
-        for guild in self.guilds:
-            try:
-                active_threads = await guild.active_threads()
-            except TypeError:
-                # Due to a bug in discord.py 2.0.0a, `guild.active_threads()` sometimes raises a TypeError.
-                continue
-            for thread in active_threads:
-                await self.on_thread_create(thread)
+        Returns:
+            AsyncContextManager[QuoteBotDatabaseConnection]: Context manager returning the connection to the pool on exit.
+        """
+        assert self.db_pool is not None
+        return self.db_pool.acquire(write)
 
-        print("QuoteBot is ready.")
+    def get_cached_message(self, msg_id: int) -> Optional[discord.Message]:
+        return self._connection._get_message(msg_id)
 
-    def db_connect(self) -> QuoteBotDatabaseConnection:
-        return connect(os.path.join("configs", "QuoteBot.db"))  # type: ignore
+    def get_cached_channel_messages(self, channel_or_thread_id: int) -> Iterator[discord.Message]:
+        """Iterate over the cached messages of a channel or thread, newest first."""
+        if (messages := self._connection._messages) is None:
+            return iter(())
+        return messages.in_channel(channel_or_thread_id)
 
     async def get_context(self, msg: discord.Message, *, cls=MessageRetrievalContext) -> MessageRetrievalContext:
         return await super().get_context(msg, cls=cls)
 
     async def get_prefix(self, msg: discord.Message) -> List[str]:
-        prefix = self.config["default_prefix"]
-        if msg.guild:
-            async with self.db_connect() as con:
-                prefix = await con.fetch_prefix(msg.guild.id) or prefix
+        prefix = self.guild_settings.get(msg.guild.id).prefix if msg.guild else self.config["default_prefix"]
         return commands.when_mentioned_or(prefix)(self, msg)
 
     async def _update_presence(self) -> None:
@@ -121,38 +441,107 @@ class QuoteBot(commands.AutoShardedBot):
         )
 
     async def _load_extensions(self) -> None:
-        for extension in ("highlights", "owneronly", "quote", "savedquotes", "settings", "snipe"):
-            await self.load_extension(f"cogs.{extension}")
-
+        extensions = ["highlights", "owneronly", "quote", "savedquotes", "settings", "snipe"]
         if self.config["botlog_webhook_url"]:
-            await self.load_extension("cogs.botlog")
+            extensions.append("botlog")
+        with self.boot_report.phase("extensions"):
+            await asyncio.gather(*(self.load_extension(f"cogs.{extension}") for extension in extensions))
 
-    async def _update_guilds(self) -> None:
-        async with self.db_connect() as con:
-            await con.enable_foreign_keys()
-            await con.filter_guilds(tuple(guild.id for guild in self.guilds))
-            await con.commit()
-            old_guild_ids = await con.fetch_guild_ids()
-            await self._purge_deleted_channels(con)
-            await self._insert_valid_new_guilds(con, old_guild_ids)
-            await con.commit()
+    async def _update_guilds(self, shard_id: int) -> None:
+        """Reconcile the database with the guilds, channels and threads of a shard.
 
-    async def _purge_deleted_channels(self, con: QuoteBotDatabaseConnection) -> None:
-        for channel_id, guild_id in await con.fetch_channels_and_threads():
-            if not (guild := self.get_guild(guild_id)):
-                await con.delete_guild(guild_id)
-            elif not guild.get_channel(channel_id):
-                await con.delete_channel_or_thread(channel_id)
-
-    async def _insert_valid_new_guilds(self, con: QuoteBotDatabaseConnection, old_guild_ids: Iterable[int]) -> None:
-        for guild in self.guilds:
-            if await con.is_blocked(guild.id):
+        The live IDs are loaded into temporary tables, so stale rows are removed with a few set-based statements in a
+        single transaction, instead of one statement per row. The caches are updated for the removed and added guilds.
+        """
+        timer = PhaseTimer()
+        shard_count = self.shard_count or 1
+        shards = {} if shard_count == 1 else {"shard_ids": (shard_id,), "shard_count": shard_count}
+
+        async with self.db_connect(write=True) as con:
+            # Collected while holding the writer, so guilds joined while waiting for it are not deleted again
+            timer.end_phase("wait for writer")
+            guilds = [guild for guild in self.guilds if guild.shard_id == shard_id]
+            guild_ids = {guild.id for guild in guilds}
+            channel_or_thread_ids = [
+                channel_or_thread.id for guild in guilds for channel_or_thread in (*guild.channels, *guild.threads)
+            ]
+            blocked_guilds = [guild for guild in guilds if self.guild_settings.is_blocked(guild.id)]
+            removed_guild_ids = [
+                guild_id
+                for guild_id in self.guild_settings
+                if guild_id not in guild_ids and shard_id_of(guild_id, shard_count) == shard_id
+            ]
+            timer.end_phase("collect")
+            await con.enable_foreign_keys()
+            async with con.transaction():
+                await con.filter_guilds(guild_ids, **shards)
+                timer.end_phase("delete guilds")
+                await con.filter_channels_and_threads(channel_or_thread_ids, **shards)
+                timer.end_phase("delete channels")
+                await con.insert_guilds(
+                    (guild_id for guild_id in guild_ids if not self.guild_settings.is_blocked(guild_id)),
+                    self.config["default_prefix"],
+                )
+                timer.end_phase("insert guilds")
+            timer.end_phase("commit")
+            # Messages of deleted channels stay in `saved_message_ids`, which only costs a query when they are deleted
+            for guild_id in removed_guild_ids:
+                self.guild_settings.remove_guild(guild_id)
+                self.highlight_index.remove_guild(guild_id)
+            for guild_id in guild_ids:
+                if not self.guild_settings.is_blocked(guild_id):
+                    self.guild_settings.add_guild(guild_id, self.config["default_prefix"])
+            timer.end_phase("update caches")
+
+        for guild in blocked_guilds:
+            try:
                 await guild.leave()
-            elif guild.id not in old_guild_ids:
-                await self.insert_new_guild(con, guild.id)
+            except discord.HTTPException:
+                pass
+        timer.end_phase("leave blocked")
+        print(
+            f"Reconciled {len(guild_ids)} servers and {len(channel_or_thread_ids)} channels/threads "
+            f"of shard {shard_id} ({timer})."
+        )
+
+    async def _load_caches(self, con: QuoteBotDatabaseConnection) -> None:
+        self.guild_settings.load(await con.fetch_guild_settings(), await con.fetch_blocked_ids())
+        self.highlight_index.load(await con.fetch_highlights())
+        self.saved_message_ids = set(await con.fetch_message_ids())
 
-    async def insert_new_guild(self, con, guild_id: int) -> None:
+    async def insert_new_guild(self, con: QuoteBotDatabaseConnection, guild_id: int) -> None:
         await con.insert_guild(guild_id, self.config["default_prefix"])
+        self.guild_settings.add_guild(guild_id, self.config["default_prefix"])
+
+    async def delete_guild(self, con: QuoteBotDatabaseConnection, guild_id: int) -> None:
+        await con.delete_guild(guild_id)
+        self.guild_settings.remove_guild(guild_id)
+        self.highlight_index.remove_guild(guild_id)
+
+    def broadcast(self, op: str, **data: Any) -> None:
+        """Notify the other processes in cluster mode, which dispatch a `cluster_<op>` event with the data.
+
+        Only the other processes receive the event, so the caller should apply the change to its own caches.
+        """
+        if self.cluster is not None:
+            self.cluster.publish(op, **data)
+
+    def is_local_guild(self, guild_id: int) -> bool:
+        """Check whether the guild's events are received by this process, which is always the case outside cluster mode."""
+        return self.cluster is None or self.cluster.is_local_guild(guild_id)
+
+    def _on_cluster_message(self, op: str, data: dict[str, Any]) -> None:
+        self.dispatch(f"cluster_{op}", **data)
+
+    async def on_cluster_settings(self, guild_id: int, changes: dict[str, Any]) -> None:
+        self.guild_settings.update(guild_id, **changes)
+
+    async def on_cluster_saved_messages(self, added: List[int], removed: List[int]) -> None:
+        self.saved_message_ids.update(added)
+        self.saved_message_ids.difference_update(removed)
+
+    async def on_cluster_shutdown(self) -> None:
+        await self.close()
 
     async def quote_message(
         self,
@@ -162,17 +551,39 @@ class QuoteBot(commands.AutoShardedBot):
         quoted_by: str,
         quote_type: str = "quote",
     ) -> Optional[discord.Message]:
+        rendered = await self.render_quote(msg, destination, quoted_by, quote_type)
+        return await send_method(content=rendered.content, embed=rendered.embed)
+
+    async def render_quote(
+        self, msg: discord.Message, destination: discord.abc.Messageable, quoted_by: str, quote_type: str = "quote"
+    ) -> RenderedQuote:
+        """Render the quote of a message without sending it.
+
+        Args:
+            msg (discord.Message): The message to quote.
+            destination (discord.abc.Messageable): Where the quote will be sent.
+            quoted_by (str): The name of the user quoting the message.
+            quote_type (str, optional): The key of the quote type in `_QUOTE_TYPE_TEXT` or "highlight". Defaults to
+                "quote".
+
+        Returns:
+            RenderedQuote: The content and embed of the quote.
+        """
         destination_guild = getattr(destination, "guild", None)
         if self._is_quote(msg):
-            return await self._requote_message(msg, destination_guild, send_method, quoted_by, quote_type)
+            return self._render_requote(msg, destination_guild, quoted_by, quote_type)
         if not msg.content and msg.embeds:
-            return await send_method(
-                self._get_raw_embed_quote_content(msg, quoted_by, quote_type, destination_guild),
-                embed=msg.embeds[0],
+            return RenderedQuote(
+                self._get_raw_embed_quote_content(msg, quoted_by, quote_type, destination_guild), msg.embeds[0]
             )
-        embed = await self._create_quote_embed(msg, destination)
+        key = RenderKey(
+            msg.id, msg.edited_at, msg.guild == destination_guild, self._hides_nsfw_attachments(msg, destination), quote_type
+        )
+        if (embed := self.render_cache.get(key)) is None:
+            embed = await self._create_quote_embed(msg, destination)
+            self.render_cache.put(key, embed)
         self._format_quote_embed_footer(msg, quoted_by, quote_type, destination_guild, embed)
-        return await send_method(embed=embed)
+        return RenderedQuote(None, embed)
 
     def _is_quote(self, msg: discord.Message) -> bool:
         if msg.author == self.user and len(msg.embeds) == 1:
@@ -199,12 +610,7 @@ class QuoteBot(commands.AutoShardedBot):
         self, msg: discord.Message, destination_channel: discord.abc.Messageable, embed: discord.Embed
     ) -> None:
         # TODO: embed images from imgur, Gyazo, etc.
-        if (
-            isinstance(msg.channel, discord.abc.GuildChannel)
-            and msg.channel.is_nsfw()
-            and isinstance(destination_channel, discord.abc.GuildChannel)
-            and not destination_channel.is_nsfw()
-        ):
+        if self._hides_nsfw_attachments(msg, destination_channel):
             embed.add_field(
                 name="Attachment(s)",
                 value=f":underage: **Message quoted from an NSFW channel.**",
@@ -219,21 +625,23 @@ class QuoteBot(commands.AutoShardedBot):
                 value="\n".join(f"[{attachment.filename}]({attachment.url})" for attachment in msg.attachments),
             )
 
-    async def _requote_message(
-        self,
-        msg: discord.Message,
-        destination_guild: Optional[discord.Guild],
-        send_method: Callable[..., Awaitable[Optional[discord.Message]]],
-        quoted_by: str,
-        quote_type: str,
-    ) -> Optional[discord.Message]:
+    def _hides_nsfw_attachments(self, msg: discord.Message, destination_channel: discord.abc.Messageable) -> bool:
+        return (
+            isinstance(msg.channel, discord.abc.GuildChannel)
+            and msg.channel.is_nsfw()
+            and isinstance(destination_channel, discord.abc.GuildChannel)
+            and not destination_channel.is_nsfw()
+        )
+
+    def _render_requote(
+        self, msg: discord.Message, destination_guild: Optional[discord.Guild], quoted_by: str, quote_type: str
+    ) -> RenderedQuote:
         embed = msg.embeds[0]
         if msg.content:
             # raw embed quote
-            msg.content = self._get_raw_embed_quote_content(msg, quoted_by, quote_type, destination_guild)
-        else:
-            self._format_quote_embed_footer(msg, quoted_by, quote_type, destination_guild, embed)
-        return await send_method(content=msg.content, embed=embed)
+            return RenderedQuote(self._get_raw_embed_quote_content(msg, quoted_by, quote_type, destination_guild), embed)
+        self._format_quote_embed_footer(msg, quoted_by, quote_type, destination_guild, embed)
+        return RenderedQuote(None, embed)
 
     def _get_raw_embed_quote_content(
         self, msg: discord.Message, quoted_by: str, quote_type: str, destination_guild: Optional[discord.Guild]
@@ -264,25 +672,80 @@ class QuoteBot(commands.AutoShardedBot):
     async def on_ready(self) -> None:
         await self._update_presence()
 
+    async def on_shard_ready(self, shard_id: int) -> None:
+        """Reconcile the guilds of a shard as soon as it is ready, instead of waiting for all shards.
+
+        Also called when a shard has to identify again after a disconnect, when events may have been missed.
+        """
+        await self._database_ready.wait()
+        if not self._database_prepared:
+            print(f"Shard {shard_id} not reconciled, the database was not prepared.", file=stderr)
+            if self.boot_report.total is None:
+                self.boot_report.finish()
+                print(f"QuoteBot started without a database.\n{self.boot_report}", file=stderr)
+            return
+        if self._booting_shard_ids is None and self.boot_report.total is None:
+            self._booting_shard_ids = set(self.shard_ids or range(self.shard_count or 1))
+        if self._booting_shard_ids is not None and shard_id in self._booting_shard_ids:
+            try:
+                with self.boot_report.shard_phase(shard_id):
+                    await self._reconcile_shard(shard_id)
+            finally:
+                # A shard that failed to reconcile doesn't hold up the boot report, it is retried when it identifies again
+                self._booting_shard_ids.discard(shard_id)
+                if not self._booting_shard_ids:
+                    self._booting_shard_ids = None
+                    self.boot_report.finish()
+                    print(f"QuoteBot is ready.\n{self.boot_report}")
+        else:
+            await self._reconcile_shard(shard_id)
+
+    async def _reconcile_shard(self, shard_id: int) -> None:
+        await self._update_guilds(shard_id)
+        # The active threads are cached with their guild, so scheduling them needs no API calls
+        for guild in self.guilds:
+            if guild.shard_id == shard_id:
+                self.schedule_thread_joins(guild.threads)
+
     async def on_guild_join(self, guild: discord.Guild) -> None:
-        async with self.db_connect() as con:
-            if await con.is_blocked(guild.id):
-                await guild.leave()
-            else:
-                await self._update_presence()
-                await self.insert_new_guild(con, guild.id)
-                await con.commit()
+        if self.guild_settings.is_blocked(guild.id):
+            await guild.leave()
+            return
+        async with self.db_connect(write=True) as con:
+            await self.insert_new_guild(con, guild.id)
+            await con.commit()
+        await self._update_presence()
 
-        for thread in await guild.active_threads():
-            await self.on_thread_create(thread)
+        self.schedule_thread_joins(guild.threads)
 
     async def on_guild_remove(self, guild: discord.Guild) -> None:
         await self._update_presence()
-        async with self.db_connect() as con:
+        async with self.db_connect(write=True) as con:
             await con.enable_foreign_keys()
-            await con.delete_guild(guild.id)
+            await self.delete_guild(con, guild.id)
             await con.commit()
 
+    def schedule_thread_joins(self, threads: Iterable[discord.Thread]) -> None:
+        """Schedule joining threads in the background, unless threads are joined lazily.
+
+        Threads in guilds that use quote reactions, quote links or highlights are joined first.
+        """
+        if self.config["thread_joins"]["lazy"]:
+            return
+        for thread in threads:
+            self.thread_joins.schedule(thread, self._thread_join_priority(thread.guild))
+
+    def join_thread_when_needed(self, channel: discord.abc.Messageable) -> None:
+        """Join a thread the bot is about to be used in ahead of the other pending joins."""
+        if isinstance(channel, discord.Thread):
+            self.thread_joins.schedule(channel, PRIORITY_NEEDED)
+
+    def _thread_join_priority(self, guild: discord.Guild) -> int:
+        settings = self.guild_settings.get(guild.id)
+        if settings.quote_reactions or settings.quote_links or self.highlight_index.has_highlights(guild):
+            return PRIORITY_FEATURES
+        return PRIORITY_DEFAULT
+
     async def on_thread_create(self, thread: discord.Thread) -> None:
         """Called when a thread is created.
 
@@ -291,14 +754,45 @@ class QuoteBot(commands.AutoShardedBot):
         Args:
             thread (discord.Thread): The thread that was joined or created.
         """
-        try:
-            await thread.join()
-        except (discord.Forbidden, discord.HTTPException):
-            pass
+        self.schedule_thread_joins((thread,))
 
     async def on_message(self, msg: discord.Message) -> None:
-        if not msg.guild or msg.channel.permissions_for(msg.guild.me).send_messages:
-            await self.process_commands(msg)
+        self.recent_messages.add(msg)
+        # Cogs listen to `on_message_context` instead of `on_message`, so the context is only resolved once per message
+        ctx = await self.get_context(msg)
+        self._command_message_ids[msg.id] = ctx.valid
+        if ctx.valid:
+            self.join_thread_when_needed(msg.channel)
+        self.dispatch("message_context", ctx)
+        if not msg.author.bot and (not msg.guild or msg.channel.permissions_for(msg.guild.me).send_messages):
+            await self.invoke(ctx)
+
+    async def is_command_message(self, msg: discord.Message) -> bool:
+        """Check whether a message invokes a command, reusing the result from when the message was received."""
+        if (valid := self._command_message_ids.get(msg.id)) is None:
+            valid = (await self.get_context(msg)).valid
+        return valid
+
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent) -> None:
+        self.render_cache.invalidate(payload.message_id)
+        self._connection.fetched_messages.invalidate(payload.message_id)
+        if (content := payload.data.get("content")) is not None:
+            self.recent_messages.update_content(payload.channel_id, payload.message_id, content)
+
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent) -> None:
+        self.render_cache.invalidate(payload.message_id)
+        self._connection.fetched_messages.invalidate(payload.message_id)
+        self.recent_messages.remove(payload.channel_id, (payload.message_id,))
+
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent) -> None:
+        for msg_id in payload.message_ids:
+            self.render_cache.invalidate(msg_id)
+            self._connection.fetched_messages.invalidate(msg_id)
+        self.recent_messages.remove(payload.channel_id, payload.message_ids)
+
+    async def on_shard_disconnect(self, shard_id: int) -> None:
+        # Messages sent while disconnected are never received, so the buffers of the shard would have gaps
+        self.recent_messages.drop_shard(shard_id, self.shard_count or 1)
 
     async def on_command_error(self, ctx: commands.Context, error: Exception) -> None:
         if isinstance(error, commands.CommandNotFound) or hasattr(ctx.command, "on_error"):
@@ -314,6 +808,8 @@ class QuoteBot(commands.AutoShardedBot):
             await ctx.send(":x: **You don't have permission to use this command.**")
         elif ctx.command is None:
             return
+        elif isinstance(error, PatternTooExpensive):
+            await ctx.send(":x: **That regular expression is too expensive to search with. Try a simpler pattern.**")
         elif isinstance(error, commands.UserInputError):
             await ctx.send(
                 f":x: **Invalid command input. See `{ctx.prefix}help {ctx.command.qualified_name}` for usage info.**"
@@ -326,8 +822,18 @@ class QuoteBot(commands.AutoShardedBot):
 
     async def close(self) -> None:
         print("QuoteBot closed.")
-        await self.session.close()
+        if self.cluster is not None:
+            self.cluster.close()
+        if self.session is not None:
+            await self.session.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
         await super().close()
+        if self.db_pool is not None:
+            await self.db_pool.close()
+        self.pattern_search_pool.close()
+        self.thread_joins.stop()
+        self.watchdog.stop()
 
 
 def install_uvloop_if_found() -> None:
@@ -344,15 +850,26 @@ def install_uvloop_if_found() -> None:
         print("uvloop installed.")
 
 
+def load_config() -> dict:
+    with open(os.path.join("configs", "credentials.json")) as config_data:
+        return apply_config_defaults(json.load(config_data))
+
+
+async def run(config: dict, **options: Any) -> None:
+    """Run a QuoteBot until it is closed.
+
+    Args:
+        config (dict): The configuration from `credentials.json`.
+        **options: Keyword arguments passed to :class:`QuoteBot`.
+    """
+    async with QuoteBot(config, **options) as bot:
+        await bot.start(config["token"])
+
+
 async def main() -> None:
     print("Starting QuoteBot...")
     install_uvloop_if_found()
-
-    with open(os.path.join("configs", "credentials.json")) as config_data:
-        bot = QuoteBot(json.load(config_data))
-
-    async with bot:
-        await bot.start(bot.config["token"])
+    await run(load_config())
 
 
 if __name__ == "__main__":
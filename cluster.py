@@ -0,0 +1,175 @@
+"""
+Copyright (C) 2020-2024 JonathanFeenstra, Deivedux, kageroukw
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import signal
+from multiprocessing.process import BaseProcess
+from sys import stderr
+from time import monotonic
+from typing import Any
+
+from aiohttp import ClientSession
+
+from bot import install_uvloop_if_found, load_config, run
+from core.cluster import SHUTDOWN_OP, ClusterHub, shard_ranges
+from core.persistence import connect
+
+_GATEWAY_BOT_URL = "https://discord.com/api/v10/gateway/bot"
+# Identifying with a shard is allowed once per 5 seconds per bucket of `max_concurrency` shards
+_IDENTIFY_INTERVAL = 5
+_MAX_RESTART_DELAY = 60
+# A process that ran for this long before exiting is restarted without delay
+_STABLE_UPTIME = 60
+_SHUTDOWN_TIMEOUT = 30
+
+
+def _run_process(config: dict, cluster_id: int, shard_ids: list[int], shard_count: int, hub_port: int) -> None:
+    install_uvloop_if_found()
+    asyncio.run(run(config, shard_ids=shard_ids, shard_count=shard_count, cluster_id=cluster_id, cluster_port=hub_port))
+
+
+class _Worker:
+    def __init__(self, cluster_id: int, shard_ids: list[int]) -> None:
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.process: BaseProcess | None = None
+        self.started_at = 0.0
+        self.restart_delay = 0.0
+        self.restart_at = 0.0
+
+
+class ClusterLauncher:
+    """Runs QuoteBot as one process per range of shards and restarts processes that exit.
+
+    The processes share the database and are connected to a :class:`core.cluster.ClusterHub`, through which they keep
+    their caches in sync and coordinate owner commands.
+    """
+
+    def __init__(self, config: dict) -> None:
+        self.config = config
+        self._context = multiprocessing.get_context("spawn")
+        self._workers: list[_Worker] = []
+        self._stopping = asyncio.Event()
+        cluster_config = config["cluster"]
+        self._hub = ClusterHub(cluster_config["hub_port"], self._on_publish)
+
+    async def run(self) -> None:
+        shard_count, max_concurrency = await self._get_sharding()
+        ranges = shard_ranges(shard_count, self.config["cluster"]["processes"])
+        print(f"Running {shard_count} shards in {len(ranges)} processes.")
+        # Migrate the database once, instead of in every process at the same time
+        async with connect(os.path.join("configs", "QuoteBot.db")) as con:
+            await con.prepare_db(self.config["default_prefix"])
+        await self._hub.start()
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._stopping.set)
+            except NotImplementedError:
+                # Not supported on Windows, where Ctrl+C interrupts the processes directly
+                pass
+        try:
+            for cluster_id, shard_ids in enumerate(ranges):
+                worker = _Worker(cluster_id, shard_ids)
+                self._workers.append(worker)
+                self._start(worker, shard_count)
+                # Each process identifies its shards from the start, so give it time before starting the next one
+                identify_buckets = -(-len(shard_ids) // max_concurrency)
+                if await self._wait_stopping(identify_buckets * _IDENTIFY_INTERVAL):
+                    break
+            await self._supervise(shard_count)
+        finally:
+            await self._stop_workers()
+            await self._hub.close()
+
+    async def _get_sharding(self) -> tuple[int, int]:
+        """Get the shard count from the config or as recommended by Discord, and the identify concurrency."""
+        async with ClientSession() as session:
+            async with session.get(
+                _GATEWAY_BOT_URL, headers={"Authorization": f"Bot {self.config['token']}"}, raise_for_status=True
+            ) as response:
+                gateway = await response.json()
+        shard_count = self.config["cluster"]["shard_count"] or gateway["shards"]
+        return shard_count, gateway["session_start_limit"]["max_concurrency"]
+
+    def _start(self, worker: _Worker, shard_count: int) -> None:
+        worker.process = self._context.Process(
+            target=_run_process,
+            args=(self.config, worker.cluster_id, worker.shard_ids, shard_count, self._hub.port),
+            name=f"QuoteBot cluster {worker.cluster_id}",
+        )
+        worker.process.start()
+        worker.started_at = monotonic()
+        print(f"Started cluster {worker.cluster_id} with shards {worker.shard_ids[0]}-{worker.shard_ids[-1]}.")
+
+    async def _supervise(self, shard_count: int) -> None:
+        while not await self._wait_stopping(1):
+            now = monotonic()
+            for worker in self._workers:
+                if worker.process is None or worker.process.is_alive():
+                    continue
+                if not worker.restart_at:
+                    # Exponential backoff for processes that keep exiting shortly after starting
+                    if now - worker.started_at >= _STABLE_UPTIME:
+                        worker.restart_delay = 0
+                    else:
+                        worker.restart_delay = min(_MAX_RESTART_DELAY, max(1, worker.restart_delay * 2))
+                    worker.restart_at = now + worker.restart_delay
+                    print(
+                        f"Cluster {worker.cluster_id} exited with code {worker.process.exitcode}, "
+                        f"restarting in {worker.restart_delay:.0f}s.",
+                        file=stderr,
+                    )
+                elif now >= worker.restart_at:
+                    worker.restart_at = 0
+                    self._start(worker, shard_count)
+
+    async def _wait_stopping(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._stopping.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def _stop_workers(self) -> None:
+        self._hub.publish(SHUTDOWN_OP)
+        deadline = monotonic() + _SHUTDOWN_TIMEOUT
+        for worker in self._workers:
+            if (process := worker.process) is None:
+                continue
+            while process.is_alive() and monotonic() < deadline:
+                await asyncio.sleep(0.5)
+            if process.is_alive():
+                print(f"Cluster {worker.cluster_id} did not shut down, terminating it.", file=stderr)
+                process.terminate()
+            process.join()
+
+    def _on_publish(self, op: str, data: dict[str, Any]) -> None:
+        if op == SHUTDOWN_OP:
+            self._stopping.set()
+
+
+async def main() -> None:
+    print("Starting QuoteBot cluster...")
+    await ClusterLauncher(load_config()).run()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
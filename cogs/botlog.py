@@ -16,12 +16,16 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import sys
+from time import monotonic
 
 import discord
 from discord.ext import commands
 
 from bot import QuoteBot
 from core.message_retrieval import DEFAULT_AVATAR_URL
+from core.watchdog import Stall
+
+_MAX_CONTENT_LENGTH = 2000
 
 
 class BotLog(commands.Cog):
@@ -33,29 +37,35 @@ class BotLog(commands.Cog):
         except ValueError:
             print(f"Invalid botlog webhook url: '{botlog_webhook_url}'. Botlog extension will be unloaded.", file=sys.stderr)
             self.bot.loop.create_task(self._unload())
+        self._next_stall_alert = 0.0
+        self._suppressed_stalls = 0
 
     async def _unload(self) -> None:
         await self.bot.unload_extension("cogs.botlog")
 
-    async def _send_guild_update(self, guild: discord.Guild, join: bool = True) -> None:
+    async def _send(self, content: str) -> None:
         bot = self.bot
         if bot.user is None:
             return
-        async with bot.db_connect() as con:
-            if await con.is_blocked(guild.id):
-                return
         try:
             await self.webhook.send(
                 username=bot.user.name,
                 avatar_url=getattr(bot.user.display_avatar, "url", DEFAULT_AVATAR_URL),
-                content=f":{'in' if join else 'out'}box_tray: **Guild {'added' if join else 'removed'}: "
-                f"{discord.utils.escape_markdown(guild.name)}** (ID: {guild.id})\n"
-                f"Total guild members: {guild.member_count}\nTotal guilds: {len(bot.guilds)}",
+                content=content,
             )
         except discord.NotFound:
             print("The configured botlog webhook was not found. Botlog extension will be unloaded.", file=sys.stderr)
             await self._unload()
 
+    async def _send_guild_update(self, guild: discord.Guild, join: bool = True) -> None:
+        if self.bot.guild_settings.is_blocked(guild.id):
+            return
+        await self._send(
+            f":{'in' if join else 'out'}box_tray: **Guild {'added' if join else 'removed'}: "
+            f"{discord.utils.escape_markdown(guild.name)}** (ID: {guild.id})\n"
+            f"Total guild members: {guild.member_count}\nTotal guilds: {len(self.bot.guilds)}"
+        )
+
     @commands.Cog.listener()
     async def on_guild_join(self, guild: discord.Guild) -> None:
         await self._send_guild_update(guild, join=True)
@@ -64,6 +74,27 @@ class BotLog(commands.Cog):
     async def on_guild_remove(self, guild: discord.Guild) -> None:
         await self._send_guild_update(guild, join=False)
 
+    @commands.Cog.listener()
+    async def on_loop_stall(self, stall: Stall) -> None:
+        # At most one alert per interval, since a stalled loop tends to stall repeatedly
+        now = monotonic()
+        if now < self._next_stall_alert:
+            self._suppressed_stalls += 1
+            return
+        self._next_stall_alert = now + self.bot.config["watchdog"]["alert_interval"]
+        suppressed, self._suppressed_stalls = self._suppressed_stalls, 0
+        stats = self.bot.watchdog.stats()
+        content = (
+            f":warning: **Event loop blocked for {stall.duration:.2f}s** by `{stall.task or 'unknown'}`\n"
+            f"Lag p99: {stats.p99_lag * 1000:.0f} ms, max: {stats.max_lag * 1000:.0f} ms"
+            f"{f' ({suppressed} more stalls since the last alert)' if suppressed else ''}"
+        )
+        if stall.stack is not None:
+            # The innermost frames are at the end, so those are kept
+            max_stack_length = _MAX_CONTENT_LENGTH - len(content) - len("\n```py\n\n```")
+            content += f"\n```py\n{stall.stack[-max_stack_length:]}\n```"
+        await self._send(content)
+
 
 async def setup(bot: QuoteBot) -> None:
     await bot.add_cog(BotLog(bot))
@@ -16,7 +16,6 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import re
-import sqlite3
 from collections import defaultdict
 from typing import Iterable
 
@@ -26,20 +25,13 @@ from discord.ext import commands
 
 from bot import QuoteBot
 from core.converters import OptionalCurrentGuild
-from core.message_retrieval import DEFAULT_AVATAR_URL
-from core.persistence import QuoteBotDatabaseConnection
+from core.highlight_delivery import HighlightDeliveryQueue, split_digest
+from core.message_retrieval import DEFAULT_AVATAR_URL, MessageRetrievalContext
+from core.pattern_search import has_nested_unbounded_repeat
 
 _MAX_PATTERN_LENGTH = 50
 
 
-def _should_send_highlight(msg: discord.Message, member: discord.Member, query: str) -> bool:
-    return (
-        member.id != msg.author.id
-        and re.search(query, msg.content, re.IGNORECASE) is not None
-        and msg.channel.permissions_for(member).read_messages
-    )
-
-
 def _for_guild_str(guild: discord.Guild) -> str:
     return f"for server `{guild.name} ({guild.id})`"
 
@@ -47,31 +39,74 @@ def _for_guild_str(guild: discord.Guild) -> str:
 class Highlights(commands.Cog):
     def __init__(self, bot: QuoteBot) -> None:
         self.bot = bot
+        config = bot.config["highlights"]
+        self.delivery_queue = HighlightDeliveryQueue(
+            self._send_digest, config["delivery_workers"], config["cooldown"], config["coalesce_window"]
+        )
+
+    async def cog_load(self) -> None:
+        self.delivery_queue.start()
+
+    async def cog_unload(self) -> None:
+        self.delivery_queue.stop()
 
     @commands.Cog.listener()
-    async def on_message(self, msg: discord.Message) -> None:
-        if msg.guild is None or not msg.content or msg.author.bot:
+    async def on_message_context(self, ctx: MessageRetrievalContext) -> None:
+        if ctx.guild is None or not (msg := ctx.message).content or msg.author.bot:
             return
-        async with self.bot.db_connect() as con:
-            highlights = await con.fetch_highlights()
-            await self._send_highlights(con, msg, highlights)
+        if isinstance(msg.author, discord.Member):
+            # Without the members intent, members are cached when they send messages instead of when they join
+            self.bot.highlight_index.add_member(msg.author)
+        await self._send_highlights(msg)
 
-    async def _send_highlights(
-        self, con: QuoteBotDatabaseConnection, msg: discord.Message, highlights: Iterable[sqlite3.Row]
-    ) -> None:
-        seen_user_ids = set()
-        for user_id, query, guild_id in highlights:
-            if not (member := msg.guild.get_member(user_id)):
-                continue
-            elif guild_id != 0 and guild_id != msg.guild.id:
+    @commands.Cog.listener()
+    async def on_member_join(self, member: discord.Member) -> None:
+        self.bot.highlight_index.add_member(member)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: discord.Member) -> None:
+        self.bot.highlight_index.remove_member(member)
+
+    @commands.Cog.listener()
+    async def on_cluster_highlights(self, user_id: int) -> None:
+        async with self.bot.db_connect() as con:
+            highlights = await con.fetch_user_highlights(user_id)
+        self.bot.highlight_index.clear_user(user_id)
+        for query, guild_id in highlights:
+            self.bot.highlight_index.add(user_id, query, guild_id)
+
+    async def _send_highlights(self, msg: discord.Message) -> None:
+        seen_user_ids = {msg.author.id}
+        for user_id, _ in self.bot.highlight_index.find_matches(msg.guild, msg.content):
+            if user_id in seen_user_ids or not (member := msg.guild.get_member(user_id)):
                 continue
-            elif user_id not in seen_user_ids and _should_send_highlight(msg, member, query):
-                seen_user_ids.add(user_id)
-                try:
-                    await self.bot.quote_message(msg, member, member.send, str(member), "highlight")
-                except (discord.Forbidden, discord.HTTPException):
-                    continue
-        await con.commit()
+            seen_user_ids.add(user_id)
+            if msg.channel.permissions_for(member).read_messages:
+                self.delivery_queue.enqueue(member, msg)
+                self.bot.highlight_matches.inc()
+
+    async def _send_digest(self, member: discord.Member, messages: list[discord.Message]) -> None:
+        quotes = [await self.bot.render_quote(msg, member, str(member), "highlight") for msg in messages]
+        error = None
+        for batch in split_digest(quotes):
+            try:
+                await member.send(
+                    content="\n".join(content for content, _ in batch if content) or None,
+                    embeds=[embed for _, embed in batch],
+                )
+            except discord.Forbidden:
+                raise
+            except discord.HTTPException:
+                # Send the quotes one by one, so a quote that cannot be sent does not take the others with it
+                for content, embed in batch:
+                    try:
+                        await member.send(content=content, embed=embed)
+                    except discord.Forbidden:
+                        raise
+                    except discord.HTTPException as e:
+                        error = e
+        if error is not None:
+            raise error
 
     @commands.hybrid_command(aliases=["hl", "hladd"])
     async def highlight(
@@ -92,6 +127,9 @@ class Highlights(commands.Cog):
         except re.error:
             await ctx.send(":x: **Invalid regular expression. You can test your pattern at: https://pythex.org/.**")
             return
+        if has_nested_unbounded_repeat(pattern):
+            await ctx.send(":x: **Highlight pattern is too expensive to match. Avoid nesting repeats like `(a+)+`.**")
+            return
         try:
             await ctx.author.send()
         except discord.Forbidden:
@@ -101,7 +139,7 @@ class Highlights(commands.Cog):
             return
         except discord.HTTPException:
             pass
-        async with self.bot.db_connect() as con:
+        async with self.bot.db_connect(write=True) as con:
             if await con.fetch_user_highlight_count(user_id := ctx.author.id) >= 10:
                 await ctx.send(":x: **Highlight limit exceeded.**")
             guild_id = server.id if server else 0
@@ -110,6 +148,7 @@ class Highlights(commands.Cog):
                 # Remove global highlight
                 if await con.fetch_highlight(user_id, pattern, 0):
                     await con.delete_highlight(user_id, pattern, 0)
+                    self.bot.highlight_index.remove(user_id, pattern, 0)
                     global_overwritten = True
             elif guilds := await con.fetch_user_highlight_guilds(user_id, pattern, exclude_global_guild=True):
                 # Warning about server highlights
@@ -124,6 +163,8 @@ class Highlights(commands.Cog):
                 return
             await con.insert_highlight(user_id, pattern, guild_id)
             await con.commit()
+        self.bot.highlight_index.add(user_id, pattern, guild_id)
+        self.bot.broadcast("highlights", user_id=user_id)
         await ctx.send(
             f":white_check_mark: **Highlight pattern `{pattern.replace('`', '')}` added"
             f" {_for_guild_str(server) if server else 'globally'}."
@@ -166,7 +207,7 @@ class Highlights(commands.Cog):
     ) -> None:
         """Remove a Highlight from the server (0 = from all servers)."""
         guild_id = server.id if server else 0
-        async with self.bot.db_connect() as con:
+        async with self.bot.db_connect(write=True) as con:
             if await con.fetch_highlight(user_id := ctx.author.id, pattern, guild_id or None):
                 await con.delete_highlight(user_id, pattern, guild_id)
             elif len(matches := await con.fetch_user_highlights_starting_with(user_id, pattern, guild_id)) == 1:
@@ -175,6 +216,8 @@ class Highlights(commands.Cog):
                 await ctx.send(":x: **Highlight not found.**")
                 return
             await con.commit()
+        self.bot.highlight_index.remove(user_id, pattern, guild_id)
+        self.bot.broadcast("highlights", user_id=user_id)
         await ctx.send(
             f":white_check_mark: **Highlight pattern `{pattern.replace('`', '')}` removed"
             f" {_for_guild_str(server) if server else 'globally'}.**"
@@ -194,9 +237,11 @@ class Highlights(commands.Cog):
     @commands.hybrid_command(aliases=["hlclear"])
     async def highlightclear(self, ctx: commands.Context, server: discord.Guild | None = OptionalCurrentGuild) -> None:
         """Clear all your Highlights on the server (0 = all)."""
-        async with self.bot.db_connect() as con:
+        async with self.bot.db_connect(write=True) as con:
             await con.clear_user_highlights(ctx.author.id, server.id if server else 0)
             await con.commit()
+        self.bot.highlight_index.clear_user(ctx.author.id, server.id if server else 0)
+        self.bot.broadcast("highlights", user_id=ctx.author.id)
         await ctx.send(
             f":white_check_mark: **Cleared all your Highlights{f' {_for_guild_str(server)}' if server else ''}.**"
         )
@@ -15,13 +15,19 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from typing import List
+from sys import stderr
+from typing import List, Union
 
 import discord
 from discord import app_commands
 from discord.ext import commands
 
 from bot import QuoteBot
+from core.converters import GuildOrIdConverter
+from core.watchdog import ROLLING_BUCKETS
+
+_DB_STATS_STATEMENTS = 10
+_DB_STATS_SQL_LENGTH = 80
 
 
 class OwnerOnly(commands.Cog):
@@ -39,6 +45,7 @@ class OwnerOnly(commands.Cog):
         except commands.ExtensionError as error:
             await ctx.send(f":x: {error.__class__.__name__}: {error}`")
         else:
+            self.bot.broadcast("reload", extension=extension)
             await ctx.send(f":white_check_mark: **Reloaded extension `{extension}`.**", ephemeral=True)
 
     @reload.autocomplete("extension")
@@ -52,38 +59,54 @@ class OwnerOnly(commands.Cog):
         ][:25]
 
     @commands.hybrid_command(aliases=["kick"])
-    async def leave(self, ctx: commands.Context, guild: discord.Guild) -> None:
+    async def leave(
+        self,
+        ctx: commands.Context,
+        guild: Union[discord.Guild, discord.Object] = commands.param(converter=GuildOrIdConverter),
+    ) -> None:
         """Make bot leave the specified server (owner only)."""
         try:
-            await guild.leave()
-            await ctx.send(
-                f":white_check_mark: **Left server `{discord.utils.escape_markdown(guild.name)}`.**", ephemeral=True
-            )
+            # Left with an API call, since the guild may be cached by another process in cluster mode
+            await self.bot.http.leave_guild(guild.id)
+            name = discord.utils.escape_markdown(guild.name) if isinstance(guild, discord.Guild) else guild.id
+            await ctx.send(f":white_check_mark: **Left server `{name}`.**", ephemeral=True)
         except discord.HTTPException:
             await ctx.send(":x: **Server not found.**", ephemeral=True)
 
     @commands.hybrid_command()
-    async def block(self, ctx: commands.Context, guild: discord.Guild) -> None:
+    async def block(
+        self,
+        ctx: commands.Context,
+        guild: Union[discord.Guild, discord.Object] = commands.param(converter=GuildOrIdConverter),
+    ) -> None:
         """Block the specified server (owner only)."""
-        async with self.bot.db_connect() as con:
+        async with self.bot.db_connect(write=True) as con:
             await con.insert_blocked_id(guild.id)
             await con.commit()
+        self.bot.guild_settings.block(guild.id)
+        self.bot.broadcast("block", guild_id=guild.id)
         await ctx.send(":white_check_mark: **Server blocked.**", ephemeral=True)
         try:
-            await guild.leave()
+            await self.bot.http.leave_guild(guild.id)
         except discord.HTTPException:
             pass
 
     @commands.hybrid_command()
-    async def unblock(self, ctx: commands.Context, guild: discord.Guild) -> None:
+    async def unblock(
+        self,
+        ctx: commands.Context,
+        guild: Union[discord.Guild, discord.Object] = commands.param(converter=GuildOrIdConverter),
+    ) -> None:
         """Unblock the specified server (owner only)."""
-        async with self.bot.db_connect() as con:
-            if not await con.is_blocked(guild.id):
-                await ctx.send(":x: **Server was not blocked.**", ephemeral=True)
-            else:
-                await con.delete_blocked_id(guild.id)
-                await con.commit()
-                await ctx.send(":white_check_mark: **Server unblocked.**", ephemeral=True)
+        if not self.bot.guild_settings.is_blocked(guild.id):
+            await ctx.send(":x: **Server was not blocked.**", ephemeral=True)
+            return
+        async with self.bot.db_connect(write=True) as con:
+            await con.delete_blocked_id(guild.id)
+            await con.commit()
+        self.bot.guild_settings.unblock(guild.id)
+        self.bot.broadcast("unblock", guild_id=guild.id)
+        await ctx.send(":white_check_mark: **Server unblocked.**", ephemeral=True)
 
     @commands.hybrid_command()
     async def sync(self, ctx: commands.Context) -> None:
@@ -91,6 +114,109 @@ class OwnerOnly(commands.Cog):
         commands = await self.bot.tree.sync()
         await ctx.send(f":white_check_mark: **Synced {len(commands)} commands.**", ephemeral=True)
 
+    @commands.hybrid_command()
+    async def cachestats(self, ctx: commands.Context) -> None:
+        """Show the memory usage of the in-memory caches (owner only)."""
+        lines = []
+        if (message_cache := self.bot._connection._messages) is not None:
+            messages = message_cache.stats()
+            lines.append(
+                f"**Messages:** {messages.messages}/{messages.maxlen} in {messages.guilds} servers, "
+                f"largest server {messages.largest_guild_messages}"
+            )
+        fetched = self.bot._connection.fetched_messages.stats()
+        lines.append(
+            f"**Fetched messages:** {fetched.messages}/{fetched.max_messages}, "
+            f"{fetched.hits} hits, {fetched.misses} misses"
+        )
+        snipes = self.bot.snipe_store.stats()
+        lines.append(
+            f"**Snipes:** {snipes.entries} messages in {snipes.channels} channels, "
+            f"~{snipes.nbytes / 2**20:.2f}/{snipes.max_bytes / 2**20:.2f} MiB"
+        )
+        renders = self.bot.render_cache.stats()
+        lines.append(
+            f"**Rendered quotes:** {renders.entries}/{renders.max_entries} embeds, "
+            f"{renders.hit_rate:.1%} hit rate ({renders.hits} hits, {renders.misses} misses)"
+        )
+        await ctx.send("\n".join(lines), ephemeral=True)
+
+    @commands.hybrid_command()
+    async def highlightstats(self, ctx: commands.Context) -> None:
+        """Show the state of the highlight delivery queue (owner only)."""
+        if (highlights := self.bot.get_cog("Highlights")) is None:
+            await ctx.send(":x: **Highlights extension not loaded.**", ephemeral=True)
+            return
+        stats = highlights.delivery_queue.stats()  # type: ignore
+        latency = (
+            "no digests sent yet"
+            if stats.median_latency is None
+            else f"median {stats.median_latency:.1f}s, max {stats.max_latency:.1f}s"
+        )
+        await ctx.send(
+            f"**Pending:** {stats.pending_messages} messages for {stats.pending_users} users\n"
+            f"**Digests:** {stats.sent} sent, {stats.failed} failed, {stats.dropped} messages dropped\n"
+            f"**Latency:** {latency}",
+            ephemeral=True,
+        )
+
+    @commands.hybrid_command()
+    async def dbstats(self, ctx: commands.Context, reset: bool = False) -> None:
+        """Show the database statements with the highest total duration (owner only)."""
+        if not (top := self.bot.query_stats.top(_DB_STATS_STATEMENTS)):
+            await ctx.send(":x: **No statements recorded yet.**", ephemeral=True)
+            return
+        lines = []
+        for stats in top:
+            sql = stats.sql if len(stats.sql) <= _DB_STATS_SQL_LENGTH else f"{stats.sql[:_DB_STATS_SQL_LENGTH - 1]}…"
+            rows = "" if stats.rows is None else f", {stats.rows / stats.count:.1f} rows avg"
+            lines.append(
+                f"`{sql.replace('`', '')}`\n> {stats.count}x, {stats.total_duration * 1000:.0f} ms total, "
+                f"median {stats.median_duration * 1000:.2f} ms, p95 {stats.p95_duration * 1000:.2f} ms, "
+                f"max {stats.max_duration * 1000:.2f} ms{rows}"
+            )
+        if reset:
+            self.bot.query_stats.reset()
+        await ctx.send("\n".join(lines), ephemeral=True)
+
+    @commands.hybrid_command()
+    async def threadjoinstats(self, ctx: commands.Context) -> None:
+        """Show the progress of joining threads (owner only)."""
+        stats = self.bot.thread_joins.stats()
+        if stats.backlog_duration is None:
+            progress = "no threads joined yet"
+        elif stats.backlog_done:
+            progress = f"last backlog joined in {stats.backlog_duration:.1f}s"
+        else:
+            progress = f"joining for {stats.backlog_duration:.1f}s"
+        await ctx.send(
+            f"**Pending:** {stats.pending} threads ({progress})\n"
+            f"**Joins:** {stats.joined} joined, {stats.skipped} skipped, {stats.failed} failed",
+            ephemeral=True,
+        )
+
+    @commands.hybrid_command()
+    async def loopstats(self, ctx: commands.Context) -> None:
+        """Show the event loop lag of the last 2 minutes (owner only)."""
+        stats = self.bot.watchdog.stats()
+        if not stats.samples:
+            await ctx.send(":x: **No lag measured yet.**", ephemeral=True)
+            return
+        bounds = [f"≤{bound * 1000:.0f} ms" for bound in ROLLING_BUCKETS] + [f">{ROLLING_BUCKETS[-1] * 1000:.0f} ms"]
+        histogram = ", ".join(f"{bound}: {count}" for bound, count in zip(bounds, stats.histogram) if count)
+        await ctx.send(
+            f"**Lag:** median {stats.median_lag * 1000:.1f} ms, p99 {stats.p99_lag * 1000:.1f} ms, "
+            f"max {stats.max_lag * 1000:.1f} ms over {stats.samples} samples\n"
+            f"**Histogram:** {histogram}\n"
+            f"**Stalls:** {stats.stalls} since startup",
+            ephemeral=True,
+        )
+
+    @commands.hybrid_command()
+    async def bootreport(self, ctx: commands.Context) -> None:
+        """Show the durations of the startup phases (owner only)."""
+        await ctx.send(f"```\n{self.bot.boot_report}\n```", ephemeral=True)
+
     @commands.hybrid_command(aliases=["logout", "close"])
     async def shutdown(self, ctx: commands.Context) -> None:
         """Shutdown the bot (owner only)."""
@@ -98,8 +224,24 @@ class OwnerOnly(commands.Cog):
             await ctx.send(":white_check_mark: **Shutting down.**", ephemeral=True)
         except discord.Forbidden:
             pass
+        self.bot.broadcast("shutdown")
         await self.bot.close()
 
+    @commands.Cog.listener()
+    async def on_cluster_block(self, guild_id: int) -> None:
+        self.bot.guild_settings.block(guild_id)
+
+    @commands.Cog.listener()
+    async def on_cluster_unblock(self, guild_id: int) -> None:
+        self.bot.guild_settings.unblock(guild_id)
+
+    @commands.Cog.listener()
+    async def on_cluster_reload(self, extension: str) -> None:
+        try:
+            await self.bot.reload_extension(f"cogs.{extension}")
+        except commands.ExtensionError as error:
+            print(f"{error.__class__.__name__}: {error}", file=stderr)
+
 
 async def setup(bot: QuoteBot) -> None:
     await bot.add_cog(OwnerOnly(bot))
@@ -16,27 +16,41 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import asyncio
-from typing import Optional, Union
+from collections import deque
+from typing import Optional, Sequence, Union
 
 import discord
 from discord import app_commands
 from discord.ext import commands
 
 from bot import QuoteBot
+from core.attachments import MemoryBudget, download_attachments
+from core.cache import LRUCache
 from core.decorators import delete_message_if_needed
 from core.message_retrieval import DEFAULT_AVATAR_URL, MessageRetrievalContext
+from core.pattern_search import PatternTooExpensive
 
 _MAX_CLONE_MESSAGES = 50
+_MAX_CACHED_WEBHOOKS = 256
 _QUOTE_EMOJI = "💬"
 _QUOTE_EXCEPTIONS = (discord.NotFound, discord.Forbidden, discord.HTTPException, commands.BadArgument)
 
 
-async def webhook_copy(webhook, msg: discord.Message, clean_content: bool = False):
+async def webhook_copy(
+    webhook,
+    msg: discord.Message,
+    clean_content: bool = False,
+    files: Optional[list[discord.File]] = None,
+    attachment_urls: Sequence[str] = (),
+):
+    content = msg.clean_content if clean_content else msg.content
+    if attachment_urls:
+        content = "\n".join((content, *attachment_urls)) if content else "\n".join(attachment_urls)
     await webhook.send(
         username=getattr(msg.author, "nick", False) or msg.author.name,
         avatar_url=getattr(msg.author.display_avatar, "url", DEFAULT_AVATAR_URL),
-        content=msg.clean_content if clean_content else msg.content,
-        files=[await attachment.to_file() for attachment in msg.attachments],
+        content=content,
+        files=[await attachment.to_file() for attachment in msg.attachments] if files is None else files,
         embed=(msg.embeds[0] if msg.embeds and msg.embeds[0].type == "rich" else None),
         allowed_mentions=discord.AllowedMentions.none(),
     )
@@ -48,18 +62,22 @@ class Quote(commands.Cog):
         # https://github.com/Rapptz/discord.py/issues/7823#issuecomment-1086830458
         self.quote_context_menu = app_commands.ContextMenu(name="Quote message", callback=self.quote_from_context_menu)
         self.bot.tree.add_command(self.quote_context_menu)
+        self._clone_webhooks: LRUCache[int, discord.Webhook] = LRUCache(_MAX_CACHED_WEBHOOKS)
 
     async def cog_unload(self) -> None:
         self.bot.tree.remove_command(self.quote_context_menu.name, type=self.quote_context_menu.type)
 
     @commands.Cog.listener()
-    async def on_message(self, msg: discord.Message) -> None:
-        ctx: MessageRetrievalContext = await self.bot.get_context(msg)
-        if ctx.valid or not msg.guild:
+    async def on_webhooks_update(self, channel: discord.abc.GuildChannel) -> None:
+        self._clone_webhooks.pop(channel.id)
+
+    @commands.Cog.listener()
+    async def on_message_context(self, ctx: MessageRetrievalContext) -> None:
+        if ctx.guild is None or ctx.valid:
             return
-        async with self.bot.db_connect() as con:
-            if await con.is_blocked(msg.guild.id) or not await con.fetch_quote_links(msg.guild.id):
-                return
+        if self.bot.guild_settings.is_blocked(ctx.guild.id) or not ctx.guild_settings.quote_links:
+            return
+        msg = ctx.message
         msg_urls = ctx.get_message_urls()
         if (msg_url_match := next(msg_urls, None)) and next(msg_urls, None) is None:
             # message contains 1 message link
@@ -74,9 +92,8 @@ class Quote(commands.Cog):
     async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent) -> None:
         if payload.guild_id is None or payload.member is None or payload.emoji.name != _QUOTE_EMOJI:
             return
-        async with self.bot.db_connect() as con:
-            if not await con.fetch_quote_reactions(payload.guild_id):
-                return
+        if not self.bot.guild_settings.get(payload.guild_id).quote_reactions:
+            return
         if (guild := self.bot.get_guild(payload.guild_id)) is None:
             return
         if (channel_or_thread := guild.get_channel(payload.channel_id) or guild.get_thread(payload.channel_id)) is None:
@@ -89,6 +106,7 @@ class Quote(commands.Cog):
             and perms.read_message_history
             and perms.send_messages
         ):
+            self.bot.join_thread_when_needed(channel_or_thread)
             try:
                 msg = channel_or_thread._state._get_message(payload.message_id) or await channel_or_thread.fetch_message(
                     payload.message_id
@@ -104,26 +122,53 @@ class Quote(commands.Cog):
             if not isinstance(ctx.channel, discord.TextChannel):
                 await ctx.send(":x: **This command can only be used in text channels.**")
                 return
-            webhook = await ctx.channel.create_webhook(name=self.bot.user.name)
+            webhook = await self._get_clone_webhook(ctx.channel)
         else:
             webhook = ctx.interaction.followup
         messages = [msg async for msg in source.history(limit=msg_limit, before=ctx.message)]
-        ignored_exceptions = (discord.HTTPException, discord.NotFound, discord.Forbidden)
+        messages.reverse()
+        clean_content = ctx.guild != source.guild
+        config = self.bot.config["clone"]
+        budget = MemoryBudget(config["memory_budget_mb"] * 2**20)
+        # Attachments of the next messages are downloaded while the current message is sent. The webhook adapter of
+        # discord.py waits for the rate limit bucket of the webhook to reset when it is exhausted, so no delay is needed
+        # between the messages.
+        downloads = deque(
+            (msg, asyncio.create_task(download_attachments(self.bot.session, msg.attachments, budget)))
+            for msg in messages[: config["prefetch_messages"] + 1]
+        )
+        pending_messages = iter(messages[config["prefetch_messages"] + 1 :])
         try:
-            await webhook_copy(webhook, messages.pop(), clean_content := ctx.guild != source.guild)
-        except ignored_exceptions:
-            pass
-        else:
-            for msg in messages[::-1]:
-                await asyncio.sleep(0.5)
+            while downloads:
+                msg, download = downloads.popleft()
+                if (next_msg := next(pending_messages, None)) is not None:
+                    downloads.append(
+                        (next_msg, asyncio.create_task(download_attachments(self.bot.session, next_msg.attachments, budget)))
+                    )
+                attachments = await download
                 try:
-                    await webhook_copy(webhook, msg, clean_content)
-                except ignored_exceptions:
+                    await webhook_copy(webhook, msg, clean_content, attachments.files, attachments.urls)
+                except discord.NotFound:
+                    # The cached webhook was deleted
+                    self._clone_webhooks.pop(ctx.channel.id)
                     break
-        try:
-            await webhook.delete()
-        except ignored_exceptions:
-            pass
+                except discord.HTTPException:
+                    break
+                finally:
+                    attachments.close()
+        finally:
+            for _, download in downloads:
+                download.cancel()
+                if download.done() and not download.cancelled() and download.exception() is None:
+                    download.result().close()
+
+    async def _get_clone_webhook(self, channel: discord.TextChannel) -> discord.Webhook:
+        if (webhook := self._clone_webhooks.get(channel.id)) is None:
+            webhook = discord.utils.find(
+                lambda webhook: webhook.user == self.bot.user and webhook.token is not None, await channel.webhooks()
+            ) or await channel.create_webhook(name=self.bot.user.name)
+            self._clone_webhooks[channel.id] = webhook
+        return webhook
 
     async def _quote_last_message(self, ctx: commands.Context) -> None:
         try:
@@ -164,6 +209,8 @@ class Quote(commands.Cog):
                 await ctx.send(":x: **I don't have permissions to read messages from that channel.**")
             except commands.BadArgument:
                 await ctx.send(":x: **Couldn't find the message.**")
+            except PatternTooExpensive:
+                await ctx.send(":x: **That regular expression is too expensive to search with. Try a simpler pattern.**")
             except commands.UserInputError:
                 await ctx.send(":x: **Please specify a valid message ID/URL or regular expression.**")
 
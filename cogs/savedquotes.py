@@ -45,28 +45,27 @@ class SavedQuotes(commands.Cog):
             if msg_id := await con.fetch_saved_quote_message_id(
                 owner_id := ctx_guild_id if server else ctx.author.id, alias
             ):
-                if row := await con.fetch_message_channel_or_thread(msg_id):
-                    channel_or_thread_id, guild_id = row
-                    await self._quote_channel_or_thread_message(
-                        con, ctx, owner_id, alias, server, MessageTuple(msg_id, channel_or_thread_id, guild_id)
-                    )
-                else:
-                    # Message is a DM
-                    try:
-                        msg = await lazy_load_message(ctx.author, msg_id)
-                        await self.bot.quote_message(
-                            msg, ctx.channel, ctx.send, str(ctx.author), "server" if server else "personal"
-                        )
-                    except discord.Forbidden:
-                        await con.delete_saved_quote(owner_id, alias)
-                        await con.commit()
-                        await ctx.send(":x: **I don't have permissions to read messages from that channel.**")
-            else:
-                await ctx.send(":x: **Personal Quote not found.**")
+                row = await con.fetch_message_channel_or_thread(msg_id)
+        if not msg_id:
+            await ctx.send(":x: **Personal Quote not found.**")
+        elif row:
+            channel_or_thread_id, guild_id = row
+            await self._quote_channel_or_thread_message(
+                ctx, owner_id, alias, server, MessageTuple(msg_id, channel_or_thread_id, guild_id)
+            )
+        else:
+            # Message is a DM
+            try:
+                msg = await lazy_load_message(ctx.author, msg_id)
+                await self.bot.quote_message(msg, ctx.channel, ctx.send, str(ctx.author), "server" if server else "personal")
+            except discord.Forbidden:
+                async with self.bot.db_connect(write=True) as con:
+                    await con.delete_saved_quote(owner_id, alias)
+                    await con.commit()
+                await ctx.send(":x: **I don't have permissions to read messages from that channel.**")
 
     async def _quote_channel_or_thread_message(
         self,
-        con: QuoteBotDatabaseConnection,
         ctx: MessageRetrievalContext,
         owner_id: int,
         alias: str,
@@ -77,36 +76,40 @@ class SavedQuotes(commands.Cog):
             msg = await ctx.get_channel_or_thread_message(msg_tuple)
             await self.bot.quote_message(msg, ctx.channel, ctx.send, str(ctx.author), "server" if server else "personal")
         except commands.BadArgument as error:
-            await con.enable_foreign_keys()
-            if isinstance(error, commands.MessageNotFound):
-                await con.delete_message(msg_tuple.msg_id)
-            elif isinstance(error, commands.ChannelNotFound):
-                await con.delete_channel_or_thread(msg_tuple.channel_or_thread_id)
-            elif isinstance(error, commands.GuildNotFound):
-                await con.delete_guild(msg_tuple.guild_id)
-            await con.commit()
+            async with self.bot.db_connect(write=True) as con:
+                await con.enable_foreign_keys()
+                if isinstance(error, commands.MessageNotFound):
+                    await con.delete_message(msg_tuple.msg_id)
+                    self.bot.saved_message_ids.discard(msg_tuple.msg_id)
+                    self.bot.broadcast("saved_messages", added=[], removed=[msg_tuple.msg_id])
+                elif isinstance(error, commands.ChannelNotFound):
+                    await con.delete_channel_or_thread(msg_tuple.channel_or_thread_id)
+                elif isinstance(error, commands.GuildNotFound) and self.bot.is_local_guild(msg_tuple.guild_id):
+                    await self.bot.delete_guild(con, msg_tuple.guild_id)
+                await con.commit()
             await ctx.send(":x: **Couldn't find the message.**")
         except discord.Forbidden:
-            await con.delete_saved_quote(owner_id, alias)
-            await con.commit()
+            async with self.bot.db_connect(write=True) as con:
+                await con.delete_saved_quote(owner_id, alias)
+                await con.commit()
             await ctx.send(":x: **I don't have permissions to read messages from that channel.**")
 
     async def send_list(self, ctx: commands.Context, server: bool = False) -> None:
         guild_id = getattr(ctx.guild, "id", None)
         async with self.bot.db_connect() as con:
             aliases = tuple(await con.fetch_owner_aliases(guild_id if server else ctx.author.id))
-            if aliases:
-                embed = discord.Embed(
-                    description=", ".join(f"`{alias}`" for alias in aliases),
-                    color=ctx.author.color.value,
-                )
-                embed.set_author(
-                    name=f"{'Server' if server else 'Personal'} Quotes",
-                    icon_url=getattr(ctx.author.avatar, "url", DEFAULT_AVATAR_URL),
-                )
-                await ctx.send(embed=embed)
-            else:
-                await ctx.send(f':x: **{"This server has no Server" if server else "You have no Personal"} Quotes.**')
+        if aliases:
+            embed = discord.Embed(
+                description=", ".join(f"`{alias}`" for alias in aliases),
+                color=ctx.author.color.value,
+            )
+            embed.set_author(
+                name=f"{'Server' if server else 'Personal'} Quotes",
+                icon_url=getattr(ctx.author.avatar, "url", DEFAULT_AVATAR_URL),
+            )
+            await ctx.send(embed=embed)
+        else:
+            await ctx.send(f':x: **{"This server has no Server" if server else "You have no Personal"} Quotes.**')
 
     async def set_saved_quote(self, ctx: MessageRetrievalContext, alias: str, query: str, server: bool = False) -> None:
         guild_id = getattr(ctx.guild, "id", None)
@@ -120,14 +123,16 @@ class SavedQuotes(commands.Cog):
         except discord.Forbidden:
             await ctx.send(":x: **I don't have permissions to read messages from that channel.**")
         else:
-            async with self.bot.db_connect() as con:
-                if await _has_reached_saved_quote_limit(con, owner_id := guild_id if server else ctx.author.id):
-                    await ctx.send(
-                        f":x: **You can't have more than {_MAX_SAVED_QUOTES} {'Server' if server else 'Personal'} Quotes.**"
-                    )
-                else:
+            async with self.bot.db_connect(write=True) as con:
+                owner_id = guild_id if server else ctx.author.id
+                if not (limit_reached := await _has_reached_saved_quote_limit(con, owner_id)):
                     await self._add_saved_quote_to_db(con, owner_id, alias, msg)
-                    await ctx.send(f":white_check_mark: **{'Server' if server else 'Personal'} Quote** `{alias}` set.")
+            if limit_reached:
+                await ctx.send(
+                    f":x: **You can't have more than {_MAX_SAVED_QUOTES} {'Server' if server else 'Personal'} Quotes.**"
+                )
+            else:
+                await ctx.send(f":white_check_mark: **{'Server' if server else 'Personal'} Quote** `{alias}` set.")
 
     async def _add_saved_quote_to_db(
         self, con: QuoteBotDatabaseConnection, owner_id: int, alias: str, msg: discord.Message
@@ -137,55 +142,75 @@ class SavedQuotes(commands.Cog):
         await con.insert_message(msg.id, None if isinstance(msg.channel, discord.DMChannel) else msg.channel.id)
         await con.set_saved_quote(owner_id, alias, msg.id)
         await con.commit()
+        self.bot.saved_message_ids.add(msg.id)
+        self.bot.broadcast("saved_messages", added=[msg.id], removed=[])
 
     async def copy_quote(self, ctx: commands.Context, owner_id: int, alias: str, server: bool = False) -> None:
         guild_id = getattr(ctx.guild, "id", None)
-        async with self.bot.db_connect() as con:
+        copied_id = None
+        async with self.bot.db_connect(write=True) as con:
             # check if new owner already has the quote alias or fewer quotes than limit
-            if await con.fetch_saved_quote_message_id(
+            if within_limit := await con.fetch_saved_quote_message_id(
                 new_owner_id := guild_id if server else ctx.author.id, alias
             ) or not await _has_reached_saved_quote_limit(con, new_owner_id):
                 if copied_id := await con.fetch_saved_quote_message_id(owner_id, alias):
                     await con.set_saved_quote(new_owner_id, alias, copied_id)
                     await con.commit()
-                    await ctx.send(f":white_check_mark: **{'Server' if server else 'Personal'} Quote** `{alias}` set.")
-                else:
-                    await ctx.send(":x: **Quote not found.**")
-            else:
-                await ctx.send(
-                    f":x: **You can't have more than {_MAX_SAVED_QUOTES} {'Server' if server else 'Personal'} Quotes.**"
-                )
+        if not within_limit:
+            await ctx.send(
+                f":x: **You can't have more than {_MAX_SAVED_QUOTES} {'Server' if server else 'Personal'} Quotes.**"
+            )
+        elif copied_id:
+            await ctx.send(f":white_check_mark: **{'Server' if server else 'Personal'} Quote** `{alias}` set.")
+        else:
+            await ctx.send(":x: **Quote not found.**")
 
     async def remove_quote(self, ctx: commands.Context, alias: str, server: bool = False) -> None:
         guild_id = getattr(ctx.guild, "id", None)
-        async with self.bot.db_connect() as con:
-            if await con.fetch_saved_quote(owner_id := guild_id if server else ctx.author.id, alias):
+        async with self.bot.db_connect(write=True) as con:
+            if found := await con.fetch_saved_quote(owner_id := guild_id if server else ctx.author.id, alias):
                 await con.delete_saved_quote(owner_id, alias)
                 await con.commit()
-                await ctx.send(f":white_check_mark: **{'Server' if server else 'Personal'} Quote** `{alias}` removed.")
-            else:
-                await ctx.send(":x: **Quote not found.**")
+        if found:
+            await ctx.send(f":white_check_mark: **{'Server' if server else 'Personal'} Quote** `{alias}` removed.")
+        else:
+            await ctx.send(":x: **Quote not found.**")
 
     async def clear_quotes(self, ctx: commands.Context, server=False) -> None:
         guild_id = getattr(ctx.guild, "id", None)
-        async with self.bot.db_connect() as con:
+        async with self.bot.db_connect(write=True) as con:
             await con.clear_owner_saved_quotes(guild_id if server else ctx.author.id)
             await con.commit()
         await ctx.send(f":white_check_mark: **{'Server' if server else 'Personal'} Quotes** cleared.")
 
     @commands.Cog.listener()
     async def on_guild_channel_delete(self, channel) -> None:
-        async with self.bot.db_connect() as con:
+        async with self.bot.db_connect(write=True) as con:
             await con.enable_foreign_keys()
             await con.delete_channel_or_thread(channel.id)
             await con.commit()
 
     @commands.Cog.listener()
-    async def on_message_delete(self, msg: discord.Message) -> None:
-        async with self.bot.db_connect() as con:
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent) -> None:
+        if payload.message_id not in self.bot.saved_message_ids:
+            return
+        async with self.bot.db_connect(write=True) as con:
             await con.enable_foreign_keys()
-            await con.delete_message(msg.id)
+            await con.delete_message(payload.message_id)
             await con.commit()
+        self.bot.saved_message_ids.discard(payload.message_id)
+        self.bot.broadcast("saved_messages", added=[], removed=[payload.message_id])
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent) -> None:
+        if not (msg_ids := payload.message_ids & self.bot.saved_message_ids):
+            return
+        async with self.bot.db_connect(write=True) as con:
+            await con.enable_foreign_keys()
+            async with con.transaction():
+                await con.delete_messages(msg_ids)
+        self.bot.saved_message_ids -= msg_ids
+        self.bot.broadcast("saved_messages", added=[], removed=list(msg_ids))
 
     @commands.hybrid_command(aliases=["personal", "pquote", "pq"])
     @delete_message_if_needed
@@ -15,6 +15,8 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+from typing import Any
+
 from discord.ext import commands
 
 from bot import QuoteBot
@@ -24,6 +26,10 @@ class Settings(commands.Cog):
     def __init__(self, bot: QuoteBot) -> None:
         self.bot = bot
 
+    def _update_settings(self, guild_id: int, **changes: Any) -> None:
+        self.bot.guild_settings.update(guild_id, **changes)
+        self.bot.broadcast("settings", guild_id=guild_id, changes=changes)
+
     @commands.hybrid_command(aliases=["togglereactions", "togglereact", "reactions"])
     @commands.check_any(commands.is_owner(), commands.has_permissions(manage_guild=True))
     @commands.guild_only()
@@ -33,10 +39,11 @@ class Settings(commands.Cog):
 
         Requires the 'Manage Server' permission.
         """
-        async with self.bot.db_connect() as con:
+        async with self.bot.db_connect(write=True) as con:
             new = not await con.fetch_quote_reactions(ctx.guild.id)
             await con.set_quote_reactions(ctx.guild.id, new)
             await con.commit()
+        self._update_settings(ctx.guild.id, quote_reactions=new)
         await ctx.send(f":white_check_mark: **Quoting messages by adding reactions {'enabled' if new else 'disabled'}.**")
 
     @commands.hybrid_command(aliases=["links"])
@@ -48,10 +55,11 @@ class Settings(commands.Cog):
 
         Requires the 'Manage Server' permission.
         """
-        async with self.bot.db_connect() as con:
+        async with self.bot.db_connect(write=True) as con:
             new = not await con.fetch_quote_links(ctx.guild.id)
             await con.set_quote_links(ctx.guild.id, new)
             await con.commit()
+        self._update_settings(ctx.guild.id, quote_links=new)
         await ctx.send(f":white_check_mark: **Quoting linked messages {'enabled' if new else 'disabled'}.**")
 
     @commands.hybrid_command(aliases=["delcommands", "delete"])
@@ -64,10 +72,11 @@ class Settings(commands.Cog):
 
         Requires the 'Manage Server' permission.
         """
-        async with self.bot.db_connect() as con:
+        async with self.bot.db_connect(write=True) as con:
             new = not await con.fetch_delete_commands(ctx.guild.id)
             await con.set_delete_commands(ctx.guild.id, new)
             await con.commit()
+        self._update_settings(ctx.guild.id, delete_commands=new)
         await ctx.send(f":white_check_mark: **Deleting quote command messages {'enabled' if new else 'disabled'}.**")
 
     @commands.hybrid_command(aliases=["snipepermission", "snipeperms"])
@@ -79,10 +88,11 @@ class Settings(commands.Cog):
 
         Requires the 'Manage Server' permission.
         """
-        async with self.bot.db_connect() as con:
+        async with self.bot.db_connect(write=True) as con:
             new = not await con.fetch_snipe_requires_manage_messages(ctx.guild.id)
             await con.set_snipe_requires_manage_messages(ctx.guild.id, new)
             await con.commit()
+        self._update_settings(ctx.guild.id, snipe_requires_manage_messages=new)
         await ctx.send(
             f":white_check_mark: **Snipe commands {'now' if new else 'no longer'} require the 'Manage Messages' permission.**"
         )
@@ -99,9 +109,10 @@ class Settings(commands.Cog):
         if len(prefix) > 3:
             await ctx.send(":x: **Prefix must be less than 4 characters.**")
         else:
-            async with self.bot.db_connect() as con:
+            async with self.bot.db_connect(write=True) as con:
                 await con.set_prefix(ctx.guild.id, prefix)
                 await con.commit()
+            self._update_settings(ctx.guild.id, prefix=prefix)
             await ctx.send(f":white_check_mark: **Prefix set to '{prefix}' in this server.**")
 
 
@@ -28,13 +28,10 @@ from core.decorators import delete_message_if_needed
 class Snipe(commands.Cog):
     def __init__(self, bot: QuoteBot) -> None:
         self.bot = bot
-        self.deletes = {}
-        self.edits = {}
 
     @commands.Cog.listener()
     async def on_guild_remove(self, guild: discord.Guild) -> None:
-        self.deletes.pop(guild.id, None)
-        self.edits.pop(guild.id, None)
+        self.bot.snipe_store.remove_guild(guild.id)
 
     @commands.Cog.listener()
     async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel) -> None:
@@ -51,31 +48,42 @@ class Snipe(commands.Cog):
 
     @commands.Cog.listener()
     async def on_message_delete(self, msg: discord.Message) -> None:
-        if msg.guild and not msg.author.bot and not (await self.bot.get_context(msg)).valid:
-            if guild_deletes := self.deletes.get(msg.guild.id):
-                guild_deletes[msg.channel.id] = msg
-            else:
-                self.deletes[msg.guild.id] = {msg.channel.id: msg}
+        if msg.guild and not msg.author.bot and not await self.bot.is_command_message(msg):
+            self._store_delete(msg)
+
+    @commands.Cog.listener()
+    async def on_bulk_message_delete(self, messages: list[discord.Message]) -> None:
+        # Only the most recent `entries_per_channel` messages of a purge can be sniped, so older messages don't need to
+        # be classified.
+        entries_per_channel = self.bot.snipe_store.entries_per_channel
+        stored: dict[int, list[discord.Message]] = {}
+        for msg in sorted(messages, key=lambda msg: msg.id, reverse=True):
+            if len(channel_messages := stored.setdefault(msg.channel.id, [])) >= entries_per_channel:
+                continue
+            if msg.guild and not msg.author.bot and not await self.bot.is_command_message(msg):
+                channel_messages.append(msg)
+        # Stored from oldest to newest, so the newest message is sniped first
+        for channel_messages in stored.values():
+            for msg in reversed(channel_messages):
+                self._store_delete(msg)
+
+    def _store_delete(self, msg: discord.Message) -> None:
+        self.bot.snipe_store.put(msg)
 
     @commands.Cog.listener()
     async def on_message_edit(self, before: discord.Message, after: discord.Message) -> None:
         if before.guild and not before.author.bot and before.pinned == after.pinned:
-            if guild_edits := self.edits.get(before.guild.id):
-                guild_edits[before.channel.id] = before
-            else:
-                self.edits[before.guild.id] = {before.channel.id: before}
+            self.bot.snipe_store.put(before, edit=True)
 
     def _clear_channel_or_thread_deletes(self, channel_or_thread: TextChannelOrThread) -> None:
-        if guild_deletes := self.deletes.get(channel_or_thread.guild.id):
-            guild_deletes.pop(channel_or_thread.id, None)
-        if guild_edits := self.edits.get(channel_or_thread.guild.id):
-            guild_edits.pop(channel_or_thread.id, None)
+        self.bot.snipe_store.remove_channel(channel_or_thread.id)
 
     async def snipe_msg(
         self,
         ctx: commands.Context,
         channel_or_thread: Optional[TextChannelOrThread],
         edit: bool = False,
+        index: int = 1,
     ) -> None:
         await ctx.typing()
         if channel_or_thread is None:
@@ -93,25 +101,25 @@ class Snipe(commands.Cog):
                 perms = ctx.channel.permissions_for(ctx.me)
                 if not perms.send_messages:
                     return
-            await self._send_snipe(ctx, channel_or_thread, edit)
+            await self._send_snipe(ctx, channel_or_thread, edit, index)
 
-    async def _send_snipe(self, ctx: commands.Context, channel_or_thread: TextChannelOrThread, edit: bool = False) -> None:
-        try:
-            msg = (self.edits if edit else self.deletes)[channel_or_thread.guild.id][channel_or_thread.id]
-        except KeyError:
+    async def _send_snipe(
+        self, ctx: commands.Context, channel_or_thread: TextChannelOrThread, edit: bool = False, index: int = 1
+    ) -> None:
+        if (msg := self.bot.snipe_store.get(channel_or_thread.id, edit, index)) is None:
             await ctx.send(":x: **Couldn't find the message.**")
         else:
-            await self.bot.quote_message(msg, ctx.channel, ctx.send, str(ctx.author), "snipe")
+            await self.bot.quote_message(msg, ctx.channel, ctx.send, str(ctx.author), "snipe")  # type: ignore
 
     async def _snipe_if_permitted(
-        self, ctx: commands.Context, channel_or_thread: TextChannelOrThread, edit: bool = False
+        self, ctx: commands.Context, channel_or_thread: TextChannelOrThread, edit: bool = False, index: int = 1
     ) -> None:
         if channel_or_thread is None:
             if not isinstance(ctx.channel, (discord.TextChannel, discord.Thread)):
                 raise commands.NoPrivateMessage("Sniping DMs is not supported.")
             channel_or_thread = ctx.channel
         if await self._has_snipe_permission(ctx.author, channel_or_thread):
-            await self.snipe_msg(ctx, channel_or_thread, edit)
+            await self.snipe_msg(ctx, channel_or_thread, edit, index)
         else:
             await ctx.send(":x: **You don't have permission to snipe messages.**")
 
@@ -123,24 +131,37 @@ class Snipe(commands.Cog):
             return False
         if channel_or_thread.permissions_for(member).manage_messages:
             return True
-        async with self.bot.db_connect() as con:
-            return not await con.fetch_snipe_requires_manage_messages(channel_or_thread.guild.id)
+        return not self.bot.guild_settings.get(channel_or_thread.guild.id).snipe_requires_manage_messages
 
     @commands.hybrid_command()
     @delete_message_if_needed
     async def snipe(
-        self, ctx: commands.Context, channel_or_thread: Optional[GlobalTextChannelOrThreadConverter] = None
+        self,
+        ctx: commands.Context,
+        channel_or_thread: Optional[GlobalTextChannelOrThreadConverter] = None,
+        index: commands.Range[int, 1] = 1,
     ) -> None:
-        """Snipe the last cached deleted message from a specified channel or the current channel."""
-        await self._snipe_if_permitted(ctx, channel_or_thread)  # type: ignore
+        """
+        Snipe a cached deleted message from a specified channel or the current channel.
+
+        index: 1 for the last deleted message, 2 for the one before, etc. Default: 1.
+        """
+        await self._snipe_if_permitted(ctx, channel_or_thread, index=index)  # type: ignore
 
     @commands.hybrid_command()
     @delete_message_if_needed
     async def snipeedit(
-        self, ctx: commands.Context, channel_or_thread: Optional[GlobalTextChannelOrThreadConverter] = None
+        self,
+        ctx: commands.Context,
+        channel_or_thread: Optional[GlobalTextChannelOrThreadConverter] = None,
+        index: commands.Range[int, 1] = 1,
     ) -> None:
-        """Snipe the last cached edited message from a specified channel or the current channel."""
-        await self._snipe_if_permitted(ctx, channel_or_thread, True)  # type: ignore
+        """
+        Snipe a cached edited message from a specified channel or the current channel.
+
+        index: 1 for the last edited message, 2 for the one before, etc. Default: 1.
+        """
+        await self._snipe_if_permitted(ctx, channel_or_thread, True, index)  # type: ignore
 
 
 async def setup(bot: QuoteBot) -> None:
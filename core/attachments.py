@@ -0,0 +1,114 @@
+"""
+Copyright (C) 2020-2024 JonathanFeenstra, Deivedux, kageroukw
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import io
+import tempfile
+from collections.abc import Iterable
+
+import aiohttp
+import discord
+from aiohttp import ClientSession
+
+_CHUNK_SIZE = 2**16
+
+
+class MemoryBudget:
+    """Number of bytes that downloads may keep in memory at the same time."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.available = max_bytes
+
+    def reserve(self, nbytes: int) -> bool:
+        if nbytes > self.available:
+            return False
+        self.available -= nbytes
+        return True
+
+    def release(self, nbytes: int) -> None:
+        self.available += nbytes
+
+
+class DownloadedAttachments:
+    """Downloaded attachments of a message as files, which must be closed to release their memory.
+
+    The URLs of attachments that failed to download are kept instead, so they can be sent as links.
+    """
+
+    def __init__(self, budget: MemoryBudget) -> None:
+        self.files: list[discord.File] = []
+        self.urls: list[str] = []
+        self._budget = budget
+        self._reserved = 0
+
+    def close(self) -> None:
+        for file in self.files:
+            file.close()
+        self.files.clear()
+        self.urls.clear()
+        self._budget.release(self._reserved)
+        self._reserved = 0
+
+    async def download(self, session: ClientSession, attachment: discord.Attachment) -> None:
+        reserved = self._budget.reserve(attachment.size)
+        if reserved:
+            self._reserved += attachment.size
+            fp = io.BytesIO()
+        else:
+            # Attachments that don't fit in the memory budget are spilled to disk
+            fp = tempfile.TemporaryFile()
+        try:
+            async with session.get(attachment.url, raise_for_status=True) as response:
+                async for chunk in response.content.iter_chunked(_CHUNK_SIZE):
+                    fp.write(chunk)
+            fp.seek(0)
+            self.files.append(
+                discord.File(
+                    fp,  # type: ignore
+                    attachment.filename,
+                    spoiler=attachment.is_spoiler(),
+                    description=attachment.description,
+                )
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            fp.close()
+            if reserved:
+                self._reserved -= attachment.size
+                self._budget.release(attachment.size)
+            self.urls.append(attachment.url)
+        except BaseException:
+            fp.close()
+            raise
+
+
+async def download_attachments(
+    session: ClientSession, attachments: Iterable[discord.Attachment], budget: MemoryBudget
+) -> DownloadedAttachments:
+    """Download attachments within a memory budget.
+
+    Returns:
+        DownloadedAttachments: The downloaded attachments, and the URLs of those that failed to download.
+    """
+    downloaded = DownloadedAttachments(budget)
+    try:
+        for attachment in attachments:
+            await downloaded.download(session, attachment)
+    except BaseException:
+        downloaded.close()
+        raise
+    return downloaded
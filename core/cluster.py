@@ -0,0 +1,180 @@
+"""
+Copyright (C) 2020-2024 JonathanFeenstra, Deivedux, kageroukw
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import json
+from collections.abc import AsyncIterator, Sequence
+from sys import stderr
+from traceback import print_exc
+from typing import Any, Callable, Optional
+
+_HOST = "127.0.0.1"
+_RECONNECT_DELAY = 5
+# Operation that makes the launcher stop restarting the processes
+SHUTDOWN_OP = "shutdown"
+
+
+def shard_ranges(shard_count: int, processes: int) -> list[list[int]]:
+    """Split the shard IDs into consecutive ranges of nearly equal size, one for each process."""
+    processes = max(1, min(processes, shard_count))
+    size, remainder = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for i in range(processes):
+        end = start + size + (i < remainder)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+def shard_id_of(guild_id: int, shard_count: int) -> int:
+    """Get the ID of the shard that receives the events of a guild."""
+    return (guild_id >> 22) % shard_count
+
+
+def _encode(op: str, data: dict[str, Any]) -> bytes:
+    return json.dumps({"op": op, "data": data}, separators=(",", ":")).encode() + b"\n"
+
+
+def _decode(line: bytes) -> Optional[tuple[str, dict[str, Any]]]:
+    """Decode a message into its operation and data, or print it and return None if it is invalid."""
+    try:
+        message = json.loads(line)
+        return message["op"], message["data"]
+    except (ValueError, KeyError, TypeError):
+        print(f"Invalid cluster message: {line!r}", file=stderr)
+        return None
+
+
+async def _read_lines(reader: asyncio.StreamReader) -> AsyncIterator[bytes]:
+    """Read lines until the end of the stream, skipping lines over the limit of the reader."""
+    while True:
+        try:
+            line = await reader.readline()
+        except ValueError:
+            # The reader discards the line when raising this
+            print("Cluster message over the length limit ignored.", file=stderr)
+            continue
+        if not line:
+            return
+        yield line
+
+
+class ClusterHub:
+    """Local server that relays JSON lines published by one cluster process to all other processes."""
+
+    def __init__(self, port: int, on_publish: Optional[Callable[[str, dict[str, Any]], None]] = None) -> None:
+        self.port = port
+        self._on_publish = on_publish
+        self._writers: set[asyncio.StreamWriter] = set()
+        self._server: Optional[asyncio.Server] = None
+
+    async def start(self) -> None:
+        # Bound to the loopback interface only, since the hub is not authenticated
+        self._server = await asyncio.start_server(self._handle_client, _HOST, self.port)
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for writer in tuple(self._writers):
+            writer.close()
+
+    def publish(self, op: str, **data: Any) -> None:
+        """Send a message to all connected processes."""
+        line = _encode(op, data)
+        for writer in tuple(self._writers):
+            if not writer.is_closing():
+                writer.write(line)
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._writers.add(writer)
+        try:
+            async for line in _read_lines(reader):
+                if (message := _decode(line)) is None:
+                    continue
+                op, data = message
+                for other in tuple(self._writers):
+                    if other is not writer and not other.is_closing():
+                        other.write(line)
+                if self._on_publish is not None:
+                    self._on_publish(op, data)
+        except ConnectionError:
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+
+class ClusterClient:
+    """Connection of a cluster process to the :class:`ClusterHub` of its launcher.
+
+    Messages published by the other processes are passed to `on_message` with their operation and data. Messages
+    published while disconnected from the hub are lost, so they should only keep caches in sync with the database.
+    """
+
+    def __init__(
+        self,
+        port: int,
+        cluster_id: int,
+        shard_ids: Sequence[int],
+        shard_count: int,
+        on_message: Callable[[str, dict[str, Any]], None],
+    ) -> None:
+        self.port = port
+        self.cluster_id = cluster_id
+        self.shard_ids = tuple(shard_ids)
+        self.shard_count = shard_count
+        self._on_message = on_message
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._listen())
+
+    def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def publish(self, op: str, **data: Any) -> None:
+        if self._writer is None or self._writer.is_closing():
+            print(f"Cluster message {op!r} not published, not connected to the hub.", file=stderr)
+            return
+        self._writer.write(_encode(op, data))
+
+    def is_local_guild(self, guild_id: int) -> bool:
+        return shard_id_of(guild_id, self.shard_count) in self.shard_ids
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_connection(_HOST, self.port)
+                async for line in _read_lines(reader):
+                    if (message := _decode(line)) is None:
+                        continue
+                    try:
+                        self._on_message(*message)
+                    except Exception:
+                        print_exc()
+            except (ConnectionError, OSError):
+                pass
+            print(f"Cluster {self.cluster_id} disconnected from the hub, reconnecting.", file=stderr)
+            self._writer = None
+            await asyncio.sleep(_RECONNECT_DELAY)
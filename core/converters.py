@@ -67,6 +67,21 @@ class GlobalTextChannelOrThreadConverter(commands.IDConverter[TextChannelOrThrea
         return result
 
 
+class GuildOrIdConverter(commands.converter.GuildConverter):
+    """A :class:`commands.converter.GuildConverter` returning a :class:`discord.Object` for the ID of an uncached guild.
+
+    In cluster mode, guilds of the shards run by other processes are not cached.
+    """
+
+    async def convert(self, ctx: commands.Context, argument: str) -> discord.Guild | discord.Object:
+        try:
+            return await super().convert(ctx, argument)
+        except commands.GuildNotFound:
+            if (match := commands.IDConverter._get_id_match(argument)) is None:
+                raise
+            return discord.Object(int(match.group(1)), type=discord.Guild)
+
+
 class OptionalGuildConverter(commands.converter.GuildConverter):
     """A :class:`commands.converter.GuildConverter` returning no guild (None) with "0" or "global" as guild-id input."""
 
@@ -32,10 +32,12 @@ def delete_message_if_needed(coro: Callable[..., Coroutine]) -> Callable[..., Co
 
     @functools.wraps(coro)
     async def decorator(cog: commands.Cog, ctx: commands.Context, *args: Any, **kwargs: Any) -> Any:
-        if ctx.guild is not None and ctx.channel.permissions_for(ctx.me).manage_messages:
-            async with ctx.bot.db_connect() as con:
-                if await con.fetch_delete_commands(ctx.guild.id):
-                    await ctx.message.delete()
+        if (
+            ctx.guild is not None
+            and ctx.bot.guild_settings.get(ctx.guild.id).delete_commands
+            and ctx.channel.permissions_for(ctx.me).manage_messages
+        ):
+            await ctx.message.delete()
         return await coro(cog, ctx, *args, **kwargs)
 
     return decorator
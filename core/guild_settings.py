@@ -0,0 +1,102 @@
+"""
+Copyright (C) 2020-2024 JonathanFeenstra, Deivedux, kageroukw
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import sqlite3
+from collections.abc import Iterable, Iterator
+from typing import Any
+
+
+class GuildSettings:
+    """Settings of a single guild, mirroring a row of the `guild` table."""
+
+    __slots__ = ("prefix", "quote_reactions", "quote_links", "delete_commands", "snipe_requires_manage_messages")
+
+    def __init__(
+        self,
+        prefix: str,
+        quote_reactions: bool = False,
+        quote_links: bool = False,
+        delete_commands: bool = False,
+        snipe_requires_manage_messages: bool = False,
+    ) -> None:
+        self.prefix = prefix
+        self.quote_reactions = quote_reactions
+        self.quote_links = quote_links
+        self.delete_commands = delete_commands
+        self.snipe_requires_manage_messages = snipe_requires_manage_messages
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row) -> "GuildSettings":
+        return cls(
+            row["prefix"],
+            bool(row["quote_reactions"]),
+            bool(row["quote_links"]),
+            bool(row["delete_commands"]),
+            bool(row["snipe_requires_manage_messages"]),
+        )
+
+
+class GuildSettingsCache:
+    """In-memory copy of the guild settings and blocked IDs, kept up to date by writing through to it.
+
+    Guilds without a row in the database get the default settings, like the `fetch_*` methods of
+    :class:`core.persistence.GuildConnectionMixin` returning None.
+    """
+
+    def __init__(self, default_prefix: str) -> None:
+        self.default = GuildSettings(default_prefix)
+        self._settings: dict[int, GuildSettings] = {}
+        self._blocked_ids: set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self._settings)
+
+    def __iter__(self) -> Iterator[int]:
+        """Iterate over the IDs of the guilds with settings."""
+        return iter(self._settings)
+
+    def load(self, rows: Iterable[sqlite3.Row], blocked_ids: Iterable[int]) -> None:
+        self._settings = {row["guild_id"]: GuildSettings.from_row(row) for row in rows}
+        self._blocked_ids = set(blocked_ids)
+
+    def get(self, guild_id: int) -> GuildSettings:
+        """Get the settings of a guild.
+
+        The returned object must not be modified, use :meth:`update` instead.
+        """
+        return self._settings.get(guild_id, self.default)
+
+    def add_guild(self, guild_id: int, prefix: str) -> None:
+        self._settings.setdefault(guild_id, GuildSettings(prefix))
+
+    def remove_guild(self, guild_id: int) -> None:
+        self._settings.pop(guild_id, None)
+
+    def update(self, guild_id: int, **changes: Any) -> None:
+        if (settings := self._settings.get(guild_id)) is None:
+            settings = self._settings[guild_id] = GuildSettings(self.default.prefix)
+        for name, value in changes.items():
+            setattr(settings, name, value)
+
+    def is_blocked(self, guild_id: int) -> bool:
+        return guild_id in self._blocked_ids
+
+    def block(self, guild_id: int) -> None:
+        self._blocked_ids.add(guild_id)
+
+    def unblock(self, guild_id: int) -> None:
+        self._blocked_ids.discard(guild_id)
@@ -0,0 +1,174 @@
+"""
+Copyright (C) 2020-2024 JonathanFeenstra, Deivedux, kageroukw
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import statistics
+from collections import deque
+from time import monotonic
+from traceback import print_exc
+from typing import Awaitable, Callable, NamedTuple, Optional, Sequence
+
+import discord
+
+# Maximum number of embeds in a single message
+MAX_DIGEST_SIZE = 10
+# Maximum total length of the embeds and maximum length of the content of a single message
+_MAX_EMBEDS_LENGTH = 6000
+_MAX_CONTENT_LENGTH = 2000
+_MAX_LATENCY_SAMPLES = 1000
+_MAX_TRACKED_USERS = 10000
+
+
+class _PendingDigest:
+    __slots__ = ("member", "messages", "enqueued_at")
+
+    def __init__(self, member: discord.Member, enqueued_at: float) -> None:
+        self.member = member
+        self.messages: list[discord.Message] = []
+        self.enqueued_at = enqueued_at
+
+
+def split_digest(quotes: Sequence[tuple[Optional[str], discord.Embed]]) -> list[list[tuple[Optional[str], discord.Embed]]]:
+    """Split the content and embeds of the quotes of a digest into batches that fit in a single message each.
+
+    Args:
+        quotes (Sequence[tuple[Optional[str], discord.Embed]]): The content and embed of each quote.
+
+    Returns:
+        list[list[tuple[Optional[str], discord.Embed]]]: The batches of quotes in order.
+    """
+    batches: list[list[tuple[Optional[str], discord.Embed]]] = []
+    embeds_length = content_length = 0
+    for content, embed in quotes:
+        # Contents are joined by newlines
+        quote_content_length = len(content) + 1 if content else 0
+        if (
+            not batches
+            or len(batches[-1]) >= MAX_DIGEST_SIZE
+            or embeds_length + len(embed) > _MAX_EMBEDS_LENGTH
+            or content_length + quote_content_length > _MAX_CONTENT_LENGTH + 1
+        ):
+            batches.append([])
+            embeds_length = content_length = 0
+        batches[-1].append((content, embed))
+        embeds_length += len(embed)
+        content_length += quote_content_length
+    return batches
+
+
+class DeliveryStats(NamedTuple):
+    pending_users: int
+    pending_messages: int
+    sent: int
+    failed: int
+    dropped: int
+    median_latency: Optional[float]
+    max_latency: Optional[float]
+
+
+class HighlightDeliveryQueue:
+    """Background queue that delivers highlights to users in digests.
+
+    Highlights of a user that are enqueued within `coalesce_window` seconds of the first pending one are sent together
+    in a single digest. A user receives at most one digest per `cooldown` seconds, which keeps the DMs well within
+    the rate limits of their DM channel. Highlights enqueued during the cooldown are added to the next digest, which
+    keeps only the newest `MAX_DIGEST_SIZE` messages. Digests are sent by `workers` concurrent tasks.
+    """
+
+    def __init__(
+        self,
+        send_digest: Callable[[discord.Member, list[discord.Message]], Awaitable[None]],
+        workers: int,
+        cooldown: float,
+        coalesce_window: float,
+    ) -> None:
+        self._send_digest = send_digest
+        self.workers = workers
+        self.cooldown = cooldown
+        self.coalesce_window = coalesce_window
+        self._pending: dict[int, _PendingDigest] = {}
+        self._timers: dict[int, asyncio.TimerHandle] = {}
+        self._ready: asyncio.Queue[int] = asyncio.Queue()
+        self._last_sent: dict[int, float] = {}
+        self._worker_tasks: list[asyncio.Task] = []
+        self._latencies: deque[float] = deque(maxlen=_MAX_LATENCY_SAMPLES)
+        self._sent = 0
+        self._failed = 0
+        self._dropped = 0
+
+    def start(self) -> None:
+        self._worker_tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    def stop(self) -> None:
+        """Stop the workers and discard the pending highlights."""
+        for task in self._worker_tasks:
+            task.cancel()
+        for timer in self._timers.values():
+            timer.cancel()
+        self._worker_tasks.clear()
+        self._timers.clear()
+        self._pending.clear()
+
+    def enqueue(self, member: discord.Member, msg: discord.Message) -> None:
+        if (pending := self._pending.get(member.id)) is None:
+            now = monotonic()
+            pending = self._pending[member.id] = _PendingDigest(member, now)
+            if (last_sent := self._last_sent.get(member.id)) is not None and last_sent + self.cooldown <= now:
+                del self._last_sent[member.id]
+                last_sent = None
+            delay = self.coalesce_window if last_sent is None else max(self.coalesce_window, last_sent + self.cooldown - now)
+            self._timers[member.id] = asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, member.id)
+        elif len(pending.messages) >= MAX_DIGEST_SIZE:
+            pending.messages.pop(0)
+            self._dropped += 1
+        pending.messages.append(msg)
+
+    def stats(self) -> DeliveryStats:
+        latencies = self._latencies
+        return DeliveryStats(
+            len(self._pending),
+            sum(len(pending.messages) for pending in self._pending.values()),
+            self._sent,
+            self._failed,
+            self._dropped,
+            statistics.median(latencies) if latencies else None,
+            max(latencies) if latencies else None,
+        )
+
+    async def _work(self) -> None:
+        while True:
+            user_id = await self._ready.get()
+            del self._timers[user_id]
+            pending = self._pending.pop(user_id)
+            try:
+                await self._send_digest(pending.member, pending.messages)
+            except discord.HTTPException:
+                self._failed += 1
+            except Exception:
+                self._failed += 1
+                print_exc()
+            else:
+                self._sent += 1
+                self._latencies.append(monotonic() - pending.enqueued_at)
+            finally:
+                self._last_sent[user_id] = monotonic()
+                if len(self._last_sent) > _MAX_TRACKED_USERS:
+                    self._forget_expired_cooldowns()
+
+    def _forget_expired_cooldowns(self) -> None:
+        expired_before = monotonic() - self.cooldown
+        self._last_sent = {user_id: sent for user_id, sent in self._last_sent.items() if sent > expired_before}
@@ -0,0 +1,289 @@
+"""
+Copyright (C) 2020-2024 JonathanFeenstra, Deivedux, kageroukw
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import re
+import sqlite3
+from collections.abc import Iterable, Iterator
+
+import discord
+
+_PREFILTER_CHUNK_SIZE = 32
+
+
+class _HighlightBucket:
+    """Precompiled highlight patterns of a single guild, or of the global highlights of a guild's members.
+
+    Patterns are combined into alternations of up to `_PREFILTER_CHUNK_SIZE` patterns each. A message is only
+    matched against the individual patterns of the chunks whose combined pattern matches, so messages without any
+    candidate match cost one search per chunk.
+    """
+
+    __slots__ = ("_users_by_query", "_patterns", "_chunks", "_unfiltered", "_dirty")
+
+    def __init__(self) -> None:
+        self._users_by_query: dict[str, set[int]] = {}
+        self._patterns: dict[str, re.Pattern[str]] = {}
+        self._chunks: list[tuple[re.Pattern[str], tuple[str, ...]]] = []
+        self._unfiltered: tuple[str, ...] = ()
+        self._dirty = False
+
+    def __bool__(self) -> bool:
+        return bool(self._users_by_query)
+
+    def add(self, user_id: int, query: str) -> None:
+        if (users := self._users_by_query.get(query)) is None:
+            try:
+                self._patterns[query] = re.compile(query, re.IGNORECASE)
+            except re.error:
+                return
+            users = self._users_by_query[query] = set()
+            self._dirty = True
+        users.add(user_id)
+
+    def remove(self, user_id: int, query: str) -> None:
+        if (users := self._users_by_query.get(query)) is None:
+            return
+        users.discard(user_id)
+        if not users:
+            del self._users_by_query[query]
+            del self._patterns[query]
+            self._dirty = True
+
+    def entries(self) -> Iterator[tuple[int, str]]:
+        for query, users in self._users_by_query.items():
+            for user_id in users:
+                yield user_id, query
+
+    def matches(self, content: str) -> Iterator[tuple[int, str]]:
+        """Find the highlights matching the content.
+
+        Yields:
+            tuple[int, str]: The user ID and query of each matching highlight.
+        """
+        if self._dirty:
+            self._build_prefilter()
+        for prefilter, queries in self._chunks:
+            if prefilter.search(content) is not None:
+                yield from self._verify(queries, content)
+        yield from self._verify(self._unfiltered, content)
+
+    def _verify(self, queries: Iterable[str], content: str) -> Iterator[tuple[int, str]]:
+        for query in queries:
+            if self._patterns[query].search(content) is not None:
+                for user_id in self._users_by_query[query]:
+                    yield user_id, query
+
+    def _build_prefilter(self) -> None:
+        filtered = []
+        unfiltered = []
+        for query, pattern in self._patterns.items():
+            # Patterns with groups can't be combined without renumbering their backreferences and patterns with global
+            # flags can't be combined at all, so these are always matched individually.
+            if pattern.groups or not _compiles_as_group(query):
+                unfiltered.append(query)
+            else:
+                filtered.append(query)
+        self._chunks = []
+        for i in range(0, len(filtered), _PREFILTER_CHUNK_SIZE):
+            chunk = tuple(filtered[i : i + _PREFILTER_CHUNK_SIZE])
+            self._chunks.append((re.compile("|".join(f"(?:{query})" for query in chunk), re.IGNORECASE), chunk))
+        self._unfiltered = tuple(unfiltered)
+        self._dirty = False
+
+
+def _compiles_as_group(query: str) -> bool:
+    try:
+        re.compile(f"(?:{query})")
+    except re.error:
+        return False
+    return True
+
+
+class _GlobalView:
+    """Global highlights of the cached members of a guild, kept up to date as members join and leave."""
+
+    __slots__ = ("guild", "bucket", "user_ids")
+
+    def __init__(self, guild: discord.Guild) -> None:
+        # The guild object is replaced when the guild becomes available again, after which the view is rebuilt
+        self.guild = guild
+        self.bucket = _HighlightBucket()
+        self.user_ids: set[int] = set()
+
+    def add_user(self, user_id: int, queries: Iterable[str]) -> None:
+        self.user_ids.add(user_id)
+        for query in queries:
+            self.bucket.add(user_id, query)
+
+    def remove_user(self, user_id: int, queries: Iterable[str]) -> None:
+        self.user_ids.discard(user_id)
+        for query in queries:
+            self.bucket.remove(user_id, query)
+
+
+class HighlightIndex:
+    """In-memory index of all highlights, mirroring the `highlight` table.
+
+    Guild highlights are kept per guild. Global highlights (guild ID 0) are indexed by user and joined into a per-guild
+    view that only contains the highlights of the guild's cached members. A view is built when a message is first
+    matched in its guild and is then updated incrementally: global highlight changes only update the views of the
+    guilds the user is a member of, and member changes only update the view of their guild.
+    """
+
+    def __init__(self) -> None:
+        self._buckets: dict[int, _HighlightBucket] = {}
+        self._user_entries: dict[int, set[tuple[int, str]]] = {}
+        self._global_queries: dict[int, set[str]] = {}
+        self._global_views: dict[int, _GlobalView] = {}
+        # Users with global highlights mapped to the IDs of the guilds with a view they are in
+        self._user_views: dict[int, set[int]] = {}
+
+    def __len__(self) -> int:
+        return sum(len(entries) for entries in self._user_entries.values())
+
+    def load(self, rows: Iterable[sqlite3.Row]) -> None:
+        self.__init__()
+        for user_id, query, guild_id in rows:
+            self.add(user_id, query, guild_id)
+
+    def add(self, user_id: int, query: str, guild_id: int = 0) -> None:
+        self._user_entries.setdefault(user_id, set()).add((guild_id, query))
+        if guild_id != 0:
+            self._buckets.setdefault(guild_id, _HighlightBucket()).add(user_id, query)
+            return
+        if (queries := self._global_queries.get(user_id)) is None:
+            queries = self._global_queries[user_id] = set()
+            # The views the user is in are only known for users who already had global highlights
+            for view in self._global_views.values():
+                if view.guild.get_member(user_id) is not None:
+                    self._user_views.setdefault(user_id, set()).add(view.guild.id)
+        queries.add(query)
+        for view_guild_id in self._user_views.get(user_id, ()):
+            self._global_views[view_guild_id].add_user(user_id, (query,))
+
+    def remove(self, user_id: int, query: str, guild_id: int = 0) -> None:
+        """Remove a highlight, from all guilds if `guild_id` is 0 like
+        :meth:`core.persistence.HighlightConnectionMixin.delete_highlight`."""
+        for entry in tuple(self._user_entries.get(user_id, ())):
+            if entry[1] == query and (guild_id == 0 or entry[0] == guild_id):
+                self._remove_entry(user_id, *entry)
+
+    def clear_user(self, user_id: int, guild_id: int = 0) -> None:
+        """Remove the highlights of a user, in all guilds if `guild_id` is 0 like
+        :meth:`core.persistence.HighlightConnectionMixin.clear_user_highlights`."""
+        for entry in tuple(self._user_entries.get(user_id, ())):
+            if guild_id == 0 or entry[0] == guild_id:
+                self._remove_entry(user_id, *entry)
+
+    def remove_guild(self, guild_id: int) -> None:
+        """Remove the highlights of a guild, like the `delete_guild_highlights` trigger."""
+        if (bucket := self._buckets.pop(guild_id, None)) is not None:
+            for user_id, query in bucket.entries():
+                self._discard_user_entry(user_id, guild_id, query)
+        self._drop_global_view(guild_id)
+
+    def add_member(self, member: discord.Member) -> None:
+        """Add the global highlights of a member that joined or was cached to the view of their guild."""
+        if (queries := self._global_queries.get(member.id)) is None:
+            return
+        if (view := self._global_views.get(member.guild.id)) is None or view.guild is not member.guild:
+            return
+        if member.guild.id not in (guild_ids := self._user_views.setdefault(member.id, set())):
+            guild_ids.add(member.guild.id)
+            view.add_user(member.id, queries)
+
+    def remove_member(self, member: discord.Member) -> None:
+        """Remove the global highlights of a member that left from the view of their guild."""
+        if (guild_ids := self._user_views.get(member.id)) is None or member.guild.id not in guild_ids:
+            return
+        guild_ids.discard(member.guild.id)
+        self._global_views[member.guild.id].remove_user(member.id, self._global_queries.get(member.id, ()))
+
+    def has_global_highlights(self, user_id: int) -> bool:
+        return user_id in self._global_queries
+
+    def has_highlights(self, guild: discord.Guild) -> bool:
+        """Check whether a guild has guild highlights or global highlights of its cached members.
+
+        Unlike matching, this doesn't build the global view of the guild.
+        """
+        if self._buckets.get(guild.id):
+            return True
+        if (view := self._global_views.get(guild.id)) is not None and view.guild is guild:
+            return bool(view.bucket)
+        if len(self._global_queries) <= len(guild._members):
+            return any(guild.get_member(user_id) is not None for user_id in self._global_queries)
+        return any(user_id in self._global_queries for user_id in guild._members)
+
+    def find_matches(self, guild: discord.Guild, content: str) -> Iterator[tuple[int, str]]:
+        """Find the highlights matching a message in a guild.
+
+        Users may be yielded more than once and guild highlights of users who are no longer members are included.
+
+        Yields:
+            tuple[int, str]: The user ID and query of each matching highlight.
+        """
+        if bucket := self._buckets.get(guild.id):
+            yield from bucket.matches(content)
+        if self._global_queries and (global_bucket := self._get_global_view(guild)):
+            yield from global_bucket.matches(content)
+
+    def _get_global_view(self, guild: discord.Guild) -> _HighlightBucket:
+        if (view := self._global_views.get(guild.id)) is not None and view.guild is guild:
+            return view.bucket
+        self._drop_global_view(guild.id)
+        view = self._global_views[guild.id] = _GlobalView(guild)
+        # Only the users with global highlights or the cached members are checked, whichever are fewer
+        if len(self._global_queries) <= len(guild._members):
+            user_ids = (user_id for user_id in self._global_queries if guild.get_member(user_id) is not None)
+        else:
+            user_ids = (user_id for user_id in guild._members if user_id in self._global_queries)
+        for user_id in user_ids:
+            self._user_views.setdefault(user_id, set()).add(guild.id)
+            view.add_user(user_id, self._global_queries[user_id])
+        return view.bucket
+
+    def _drop_global_view(self, guild_id: int) -> None:
+        if (view := self._global_views.pop(guild_id, None)) is None:
+            return
+        for user_id in view.user_ids:
+            if (guild_ids := self._user_views.get(user_id)) is not None:
+                guild_ids.discard(guild_id)
+
+    def _remove_entry(self, user_id: int, guild_id: int, query: str) -> None:
+        if guild_id == 0:
+            if (queries := self._global_queries.get(user_id)) is not None:
+                queries.discard(query)
+                for view_guild_id in self._user_views.get(user_id, ()):
+                    view = self._global_views[view_guild_id]
+                    view.bucket.remove(user_id, query)
+                    if not queries:
+                        view.user_ids.discard(user_id)
+                if not queries:
+                    del self._global_queries[user_id]
+                    self._user_views.pop(user_id, None)
+        elif (bucket := self._buckets.get(guild_id)) is not None:
+            bucket.remove(user_id, query)
+            if not bucket:
+                del self._buckets[guild_id]
+        self._discard_user_entry(user_id, guild_id, query)
+
+    def _discard_user_entry(self, user_id: int, guild_id: int, query: str) -> None:
+        if (entries := self._user_entries.get(user_id)) is not None:
+            entries.discard((guild_id, query))
+            if not entries:
+                del self._user_entries[user_id]
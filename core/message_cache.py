@@ -0,0 +1,220 @@
+"""
+Copyright (C) 2020-2024 JonathanFeenstra, Deivedux, kageroukw
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+from collections import OrderedDict
+from collections.abc import Iterable, Iterator
+from itertools import islice
+from time import monotonic
+from typing import Any, NamedTuple, Optional
+
+import discord
+from discord.shard import AutoShardedConnectionState
+
+
+class MessageCacheStats(NamedTuple):
+    messages: int
+    maxlen: Optional[int]
+    guilds: int
+    largest_guild_messages: int
+
+
+class IndexedMessageCache:
+    """Drop-in replacement for the message cache deque of discord.py that is indexed by message ID.
+
+    Only the parts of the deque interface used by discord.py are implemented. Messages are kept in insertion order and
+    also indexed per channel or thread and per guild (0 for DMs).
+
+    Instead of the oldest message overall, the oldest message of the guild with the most cached messages is evicted
+    when `maxlen` is reached. Every guild is guaranteed an equal share of the cache, and guilds can borrow the share
+    other guilds don't use until those need it back.
+    """
+
+    __slots__ = ("_messages", "_channels", "_guilds", "_guild_ids_by_count", "_max_guild_count", "maxlen")
+
+    def __init__(self, messages: Iterable[discord.Message] = (), maxlen: Optional[int] = None) -> None:
+        self._messages: OrderedDict[int, discord.Message] = OrderedDict()
+        self._channels: dict[int, OrderedDict[int, discord.Message]] = {}
+        self._guilds: dict[int, OrderedDict[int, discord.Message]] = {}
+        self._guild_ids_by_count: dict[int, set[int]] = {}
+        self._max_guild_count = 0
+        self.maxlen = maxlen
+        for msg in messages:
+            self.append(msg)
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __iter__(self) -> Iterator[discord.Message]:
+        return iter(self._messages.values())
+
+    def __reversed__(self) -> Iterator[discord.Message]:
+        return reversed(self._messages.values())
+
+    def __contains__(self, msg: Any) -> bool:
+        return isinstance(msg, discord.Message) and msg.id in self._messages
+
+    def __getitem__(self, index: int) -> discord.Message:
+        if index < 0:
+            index += len(self._messages)
+        if not 0 <= index < len(self._messages):
+            raise IndexError("message cache index out of range")
+        if index > len(self._messages) // 2:
+            return next(islice(reversed(self._messages.values()), len(self._messages) - index - 1, None))
+        return next(islice(self._messages.values(), index, None))
+
+    def get(self, msg_id: int) -> Optional[discord.Message]:
+        return self._messages.get(msg_id)
+
+    def in_channel(self, channel_id: int) -> Iterator[discord.Message]:
+        """Iterate over the cached messages of a channel or thread, newest first."""
+        return reversed(self._channels.get(channel_id, {}).values())
+
+    def stats(self) -> MessageCacheStats:
+        return MessageCacheStats(len(self._messages), self.maxlen, len(self._guilds), self._max_guild_count)
+
+    def append(self, msg: discord.Message) -> None:
+        if msg.id in self._messages:
+            self._discard(self._messages[msg.id])
+        self._messages[msg.id] = msg
+        self._channels.setdefault(msg.channel.id, OrderedDict())[msg.id] = msg
+        guild_id = msg.guild.id if msg.guild else 0
+        guild_messages = self._guilds.setdefault(guild_id, OrderedDict())
+        guild_messages[msg.id] = msg
+        self._move_guild(guild_id, len(guild_messages) - 1, len(guild_messages))
+        self._evict_overflow()
+
+    def remove(self, msg: discord.Message) -> None:
+        if (cached_msg := self._messages.get(msg.id)) is None:
+            raise ValueError("message not in cache")
+        self._discard(cached_msg)
+
+    def resize(self, maxlen: Optional[int]) -> None:
+        self.maxlen = maxlen
+        self._evict_overflow()
+
+    def _evict_overflow(self) -> None:
+        while self.maxlen is not None and len(self._messages) > self.maxlen:
+            largest_guild_id = next(iter(self._guild_ids_by_count[self._max_guild_count]))
+            self._discard(next(iter(self._guilds[largest_guild_id].values())))
+
+    def _discard(self, msg: discord.Message) -> None:
+        del self._messages[msg.id]
+        if (channel_messages := self._channels.get(msg.channel.id)) is not None:
+            channel_messages.pop(msg.id, None)
+            if not channel_messages:
+                del self._channels[msg.channel.id]
+        guild_id = msg.guild.id if msg.guild else 0
+        guild_messages = self._guilds[guild_id]
+        del guild_messages[msg.id]
+        self._move_guild(guild_id, len(guild_messages) + 1, len(guild_messages))
+        if not guild_messages:
+            del self._guilds[guild_id]
+
+    def _move_guild(self, guild_id: int, old_count: int, new_count: int) -> None:
+        # Guilds are bucketed by their number of cached messages, which only changes by 1 at a time, to find the
+        # largest guild in constant time.
+        if old_count:
+            bucket = self._guild_ids_by_count[old_count]
+            bucket.discard(guild_id)
+            if not bucket:
+                del self._guild_ids_by_count[old_count]
+                if old_count == self._max_guild_count:
+                    self._max_guild_count = new_count
+        if new_count:
+            self._guild_ids_by_count.setdefault(new_count, set()).add(guild_id)
+            self._max_guild_count = max(self._max_guild_count, new_count)
+
+
+class FetchedMessageStats(NamedTuple):
+    messages: int
+    max_messages: int
+    hits: int
+    misses: int
+
+
+class FetchedMessageCache:
+    """LRU cache of messages fetched from the API, which discord.py does not cache.
+
+    Messages expire after `ttl` seconds, because edits and deletes of messages in channels the bot can't see are never
+    received.
+    """
+
+    def __init__(self, max_messages: int, ttl: float) -> None:
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self._messages: OrderedDict[int, tuple[float, discord.Message]] = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def get(self, msg_id: int) -> Optional[discord.Message]:
+        if (entry := self._messages.get(msg_id)) is None or entry[0] < monotonic():
+            self._messages.pop(msg_id, None)
+            self._misses += 1
+            return None
+        self._hits += 1
+        self._messages.move_to_end(msg_id)
+        return entry[1]
+
+    def put(self, msg: discord.Message) -> None:
+        self._messages[msg.id] = (monotonic() + self.ttl, msg)
+        self._messages.move_to_end(msg.id)
+        if len(self._messages) > self.max_messages:
+            self._messages.popitem(last=False)
+
+    def invalidate(self, msg_id: int) -> None:
+        self._messages.pop(msg_id, None)
+
+    def stats(self) -> FetchedMessageStats:
+        return FetchedMessageStats(len(self._messages), self.max_messages, self._hits, self._misses)
+
+
+class IndexedConnectionState(AutoShardedConnectionState):
+    """Connection state that stores its message cache in an :class:`IndexedMessageCache`.
+
+    discord.py assigns a new deque to `_messages` when it clears its state or removes a guild, so the property setter
+    converts every assigned deque. Messages fetched with :func:`core.message_retrieval.lazy_load_message` are cached
+    separately in `fetched_messages`.
+    """
+
+    fetched_messages = FetchedMessageCache(0, 0)
+
+    @property
+    def _messages(self) -> Optional[IndexedMessageCache]:
+        return self._indexed_messages
+
+    @_messages.setter
+    def _messages(self, messages: Optional[Iterable[discord.Message]]) -> None:
+        if messages is None or isinstance(messages, IndexedMessageCache):
+            self._indexed_messages = messages
+        else:
+            self._indexed_messages = IndexedMessageCache(messages, self.max_messages)
+
+    def _get_message(self, msg_id: Optional[int]) -> Optional[discord.Message]:
+        return self._indexed_messages.get(msg_id) if self._indexed_messages and msg_id is not None else None
+
+
+def read_rss() -> Optional[int]:
+    """Read the resident set size of the current process in bytes, or None if `/proc` is not available."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
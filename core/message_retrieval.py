@@ -15,12 +15,17 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import asyncio
+import itertools
 import re
-from typing import AsyncGenerator, Iterator, NamedTuple, Optional
+from typing import AsyncGenerator, Awaitable, Callable, Iterator, NamedTuple, Optional, Sequence
 
 import discord
 from discord.ext import commands
 
+from core.guild_settings import GuildSettings
+from core.pattern_search import compile_search_pattern
+
 DEFAULT_AVATAR_URL = "https://cdn.discordapp.com/embed/avatars/0.png"
 MARKDOWN = re.compile(
     (
@@ -51,7 +56,7 @@ _MEMBER_CONVERTER = commands.MemberConverter()
 
 
 async def lazy_load_message(messageable: discord.abc.Messageable, msg_id: int) -> discord.Message:
-    """Get message from cache if found, otherwise using an API call.
+    """Get message from cache if found, otherwise using an API call and cache the fetched message.
 
     Args:
         messageable (discord.abc.Messageable): The messageable to get the message from.
@@ -65,12 +70,15 @@ async def lazy_load_message(messageable: discord.abc.Messageable, msg_id: int) -
     Returns:
         discord.Message: The message.
     """
-    if (msg := messageable._state._get_message(msg_id)) is not None:
+    state = messageable._state
+    if (msg := state._get_message(msg_id) or state.fetched_messages.get(msg_id)) is not None:
         return msg
     try:
-        return await messageable.fetch_message(msg_id)
+        msg = await messageable.fetch_message(msg_id)
     except discord.NotFound:
         raise commands.MessageNotFound(str(msg_id))
+    state.fetched_messages.put(msg)
+    return msg
 
 
 class MessageTuple(NamedTuple):
@@ -82,6 +90,12 @@ class MessageTuple(NamedTuple):
 class MessageRetrievalContext(commands.Context):
     """Custom command invocation context with methods for message retrieval."""
 
+    @discord.utils.cached_property
+    def guild_settings(self) -> GuildSettings:
+        """The settings of the current guild, or the default settings outside of guilds."""
+        settings = self.bot.guild_settings
+        return settings.get(self.guild.id) if self.guild else settings.default
+
     async def get_messages(self, query: str) -> AsyncGenerator[discord.Message, None]:
         """Get message(s) from a query.
 
@@ -108,6 +122,7 @@ class MessageRetrievalContext(commands.Context):
             commands.ChannelNotFound: If the channel is not found.
             commands.GuildNotFound: If the guild is not found.
             commands.UserInputError: If the query is invalid.
+            PatternTooExpensive: If the query is a regular expression that may take too long to search with.
             discord.Forbidden: If the bot does not have permission to access the message.
             discord.HTTPException: If the request failed.
 
@@ -209,43 +224,145 @@ class MessageRetrievalContext(commands.Context):
         raise commands.GuildNotFound(str(msg_tuple.guild_id))
 
     async def _get_last_message_from_author(self, author_id: int, limit=100) -> discord.Message:
-        async for msg in self.history(limit=limit, before=self.message):
-            if msg.author.id == author_id:
-                return msg
+        async def find_first_from_author(messages: Sequence[tuple[int, str]]) -> Optional[int]:
+            return next((i for i, (msg_author_id, _) in enumerate(messages) if msg_author_id == author_id), None)
+
+        if msg := await self._search_recent_messages(find_first_from_author, limit):
+            return msg
         raise commands.MessageNotFound(str(author_id))
 
+    async def _search_recent_messages(
+        self, find_first: Callable[[Sequence[tuple[int, str]]], Awaitable[Optional[int]]], limit: int
+    ) -> Optional[discord.Message]:
+        """Find the newest message before the invoking message within the last `limit` messages of the channel or thread.
+
+        The recent message buffer of the channel or thread is searched first and the history is only requested for the
+        messages older than the buffered ones.
+
+        Args:
+            find_first (Callable[[Sequence[tuple[int, str]]], Awaitable[Optional[int]]]): Finds the index of the first
+                matching message in a sequence of message author IDs and contents, newest first.
+            limit (int): The maximum number of messages to search.
+
+        Raises:
+            discord.Forbidden: If the bot does not have permission to read the message history.
+            discord.HTTPException: If the request failed.
+
+        Returns:
+            Optional[discord.Message]: The message, or None if no message matches.
+        """
+        snapshots = self.bot.recent_messages.before(self.channel.id, self.message.id)[:limit]
+        candidates = snapshots
+        while (i := await find_first([(snapshot.author_id, snapshot.content) for snapshot in candidates])) is not None:
+            try:
+                return await lazy_load_message(self.channel, candidates[i].id)
+            except commands.MessageNotFound:
+                # Deleted before the delete event was received
+                candidates = candidates[i + 1 :]
+        if len(snapshots) == limit:
+            return None
+        before = discord.Object(snapshots[-1].id) if snapshots else self.message
+        history = [msg async for msg in self.history(limit=limit - len(snapshots), before=before)]
+        if (i := await find_first([(msg.author.id, msg.content) for msg in history])) is not None:
+            return history[i]
+        return None
+
     async def _get_message_from_unknown_channel_or_thread(self, msg_id: int) -> discord.Message:
-        if msg := discord.utils.find(lambda msg: msg.id == msg_id, self.bot.cached_messages):
+        if msg := self.bot.get_cached_message(msg_id):
             return msg
+        if (channel_or_thread := self._get_remembered_channel_or_thread(msg_id)) is not None:
+            try:
+                return await lazy_load_message(channel_or_thread, msg_id)
+            except (commands.MessageNotFound, discord.Forbidden):
+                self.bot.message_channel_ids.pop(msg_id)
         try:
-            return await lazy_load_message(self, msg_id)
+            msg = await lazy_load_message(self, msg_id)
         except (commands.MessageNotFound, discord.Forbidden):
             if not self.guild:
                 raise
-            for channel_or_thread in self.guild.text_channels + self.guild.threads:
+            if (msg := await self._probe_channels_and_threads(msg_id)) is None:
+                raise commands.MessageNotFound(str(msg_id))
+        self.bot.message_channel_ids[msg_id] = msg.channel.id
+        return msg
+
+    def _get_remembered_channel_or_thread(self, msg_id: int) -> Optional[discord.abc.Messageable]:
+        if (channel_or_thread_id := self.bot.message_channel_ids.get(msg_id)) is None:
+            return None
+        if channel_or_thread_id == self.channel.id:
+            return self.channel
+        return self.guild.get_channel_or_thread(channel_or_thread_id) if self.guild else None
+
+    async def _probe_channels_and_threads(self, msg_id: int) -> Optional[discord.Message]:
+        """Concurrently try to fetch a message from the channels and threads in the current guild that may contain it.
+
+        Channels and threads created after the message or without messages since are skipped. The remaining ones are
+        probed in order of their last message ID, closest to the message ID first, and all pending fetches are
+        cancelled as soon as the message is found.
+
+        Raises:
+            discord.HTTPException: If a request failed.
+
+        Returns:
+            Optional[discord.Message]: The message, or None if it is not found.
+        """
+        me = self.guild.me
+        candidates = sorted(
+            (
+                channel_or_thread
+                for channel_or_thread in itertools.chain(self.guild.text_channels, self.guild.threads)
+                if channel_or_thread.id <= msg_id
+                and channel_or_thread != self.channel
+                and (channel_or_thread.last_message_id is None or channel_or_thread.last_message_id >= msg_id)
+                and channel_or_thread.permissions_for(me).read_message_history
+            ),
+            # Channels and threads without a known last message are probed last
+            key=lambda channel_or_thread: (
+                channel_or_thread.last_message_id is None,
+                (channel_or_thread.last_message_id or 0) - msg_id,
+            ),
+        )
+        if not candidates:
+            return None
+        pending_candidates = iter(candidates)
+
+        async def probe() -> Optional[discord.Message]:
+            for channel_or_thread in pending_candidates:
                 try:
                     return await lazy_load_message(channel_or_thread, msg_id)
                 except (commands.MessageNotFound, discord.Forbidden):
                     pass
-        raise commands.MessageNotFound(str(msg_id))
+            return None
+
+        workers = {
+            asyncio.create_task(probe())
+            for _ in range(min(self.bot.config["message_retrieval"]["probe_concurrency"], len(candidates)))
+        }
+        try:
+            while workers:
+                done, workers = await asyncio.wait(workers, return_when=asyncio.FIRST_COMPLETED)
+                for worker in done:
+                    if (msg := worker.result()) is not None:
+                        return msg
+        finally:
+            for worker in workers:
+                worker.cancel()
+        return None
 
     async def _regex_search_message(self, query: str, limit: int = 100) -> discord.Message:
         try:
-            pattern = re.compile(query, re.IGNORECASE)
+            compile_search_pattern(query)
         except re.error:
-            raise commands.UserInputError(f"Pattern {query:r} cannot be compiled.")
-        else:
-            async for msg in self.history(limit=limit, before=self.message):
-                if pattern.search(msg.content):
-                    return msg
-
-            def check(msg: discord.Message) -> bool:
-                return (
-                    msg.channel == self.channel
-                    and msg.created_at < self.message.created_at
-                    and bool(pattern.search(msg.content))
-                )
-
-            if msg := discord.utils.find(check, self.bot.cached_messages):
-                return msg
+            raise commands.UserInputError(f"Pattern {query!r} cannot be compiled.")
+        search_pool = self.bot.pattern_search_pool
+
+        async def find_first_match(messages: Sequence[tuple[int, str]]) -> Optional[int]:
+            return await search_pool.find_first_match(query, [content for _, content in messages])
+
+        if msg := await self._search_recent_messages(find_first_match, limit):
+            return msg
+        cached_messages = [
+            msg for msg in self.bot.get_cached_channel_messages(self.channel.id) if msg.created_at < self.message.created_at
+        ]
+        if (i := await search_pool.find_first_match(query, [msg.content for msg in cached_messages])) is not None:
+            return cached_messages[i]
         raise commands.MessageNotFound(query)
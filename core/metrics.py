@@ -0,0 +1,208 @@
+"""
+Copyright (C) 2020-2024 JonathanFeenstra, Deivedux, kageroukw
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import bisect
+import ipaddress
+import logging
+from collections.abc import Callable, Iterable, Iterator
+from typing import Optional
+
+from aiohttp import web
+
+# Default buckets of the Prometheus client libraries, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    labels = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return f"{{{labels}}}" if labels else ""
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+
+    def expose(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {_escape(self.documentation)}"
+        yield f"# TYPE {self.name} {self.type_name}"
+        yield from self._samples()
+
+    def _samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1) -> None:
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def _samples(self) -> Iterator[str]:
+        for labelvalues, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}"
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        # Per label values: the count of each bucket (not cumulative) and of +Inf, and the sum
+        self._counts: dict[LabelValues, list[int]] = {}
+        self._sums: dict[LabelValues, float] = {}
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        if (counts := self._counts.get(labelvalues)) is None:
+            counts = self._counts[labelvalues] = [0] * (len(self.buckets) + 1)
+            self._sums[labelvalues] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[labelvalues] += value
+
+    def _samples(self) -> Iterator[str]:
+        bucket_labelnames = (*self.labelnames, "le")
+        for labelvalues, counts in self._counts.items():
+            cumulative = 0
+            for upper_bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                labels = _format_labels(bucket_labelnames, (*labelvalues, str(upper_bound)))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield f"{self.name}_sum{labels} {self._sums[labelvalues]}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class CallbackMetric(_Metric):
+    """Gauge or counter whose values are collected from a callback when the metrics are exposed.
+
+    The callback returns the label values mapped to the values, like `{("messages",): 100}`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...],
+        collect: Callable[[], dict[LabelValues, float]],
+        type_name: str = "gauge",
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.type_name = type_name
+        self._collect = collect
+
+    def _samples(self) -> Iterator[str]:
+        for labelvalues, value in self._collect().items():
+            yield f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}"
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric) -> None:
+        self._metrics.append(metric)
+
+    def counter(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        self.register(counter := Counter(name, documentation, labelnames))
+        return counter
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Histogram:
+        self.register(histogram := Histogram(name, documentation, labelnames))
+        return histogram
+
+    def expose(self) -> str:
+        """Format the metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.expose())
+            except Exception as error:
+                # A failing callback, e.g. of a cog that is being reloaded, should not break the other metrics
+                lines.append(f"# {metric.name} unavailable: {_escape(repr(error))}")
+        lines.append("")
+        return "\n".join(lines)
+
+
+class RateLimitCounter(logging.Filter):
+    """Logging filter that counts the 429 responses discord.py logs a warning for, without filtering any records."""
+
+    # Format strings of the warnings in `discord.http` and `discord.webhook.async_`
+    _RATE_LIMITED_MESSAGES = ("responded with 429", "is rate limited")
+
+    def __init__(self, counter: Counter) -> None:
+        super().__init__()
+        self.counter = counter
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if isinstance(record.msg, str) and any(message in record.msg for message in self._RATE_LIMITED_MESSAGES):
+            self.counter.inc(record.name)
+        return True
+
+    def install(self, logger_names: Iterable[str] = ("discord.http", "discord.webhook.async_")) -> None:
+        for name in logger_names:
+            logging.getLogger(name).addFilter(self)
+
+
+class MetricsServer:
+    """HTTP server exposing the metrics of a registry at `/metrics`.
+
+    Only local addresses are allowed, since the metrics are not authenticated.
+    """
+
+    def __init__(self, registry: MetricsRegistry, host: str, port: int) -> None:
+        address = ipaddress.ip_address(host)
+        if not (address.is_loopback or address.is_private) or address.is_unspecified:
+            raise ValueError(f"Metrics address {host} is not a local address.")
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.registry.expose(), content_type="text/plain", charset="utf-8")
@@ -0,0 +1,190 @@
+"""
+Copyright (C) 2020-2024 JonathanFeenstra, Deivedux, kageroukw
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import multiprocessing
+import re
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from re import _constants as sre_constants  # type: ignore
+from re import _parser as sre_parse  # type: ignore
+from typing import Optional, Sequence
+
+from discord.ext import commands
+
+_UNBOUNDED_REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+
+
+class PatternTooExpensive(commands.UserInputError):
+    """Exception raised when a regular expression may take too long to search with.
+
+    This inherits from :exc:`commands.UserInputError`
+
+    Attributes
+    -----------
+    pattern: :class:`str`
+        The pattern supplied by the caller.
+    """
+
+    def __init__(self, pattern: str) -> None:
+        self.pattern: str = pattern
+        super().__init__(f"Pattern {pattern!r} is too expensive.")
+
+
+def has_nested_unbounded_repeat(pattern: str) -> bool:
+    """Check whether a pattern repeats a subpattern without an upper bound inside another unbounded repeat, like
+    `(a+)+` or `(a*b?)*`, which can cause catastrophic backtracking.
+
+    Raises:
+        re.error: If the pattern cannot be parsed.
+    """
+    return _has_nested_unbounded_repeat(sre_parse.parse(pattern), False)
+
+
+def _has_nested_unbounded_repeat(subpattern: sre_parse.SubPattern, in_unbounded_repeat: bool) -> bool:
+    for op, av in subpattern:
+        if op in _UNBOUNDED_REPEATS:
+            unbounded = av[1] == sre_constants.MAXREPEAT
+            if unbounded and in_unbounded_repeat:
+                return True
+            children = (av[2],)
+            in_child_repeat = in_unbounded_repeat or unbounded
+        else:
+            # Possessive repeats and atomic groups never backtrack into their contents, so nesting is safe there
+            if op in (sre_constants.POSSESSIVE_REPEAT, sre_constants.ATOMIC_GROUP):
+                continue
+            if op is sre_constants.SUBPATTERN:
+                children = (av[-1],)
+            elif op is sre_constants.BRANCH:
+                children = av[1]
+            elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+                children = (av[1],)
+            elif op is sre_constants.GROUPREF_EXISTS:
+                children = tuple(child for child in av[1:] if child is not None)
+            else:
+                continue
+            in_child_repeat = in_unbounded_repeat
+        if any(_has_nested_unbounded_repeat(child, in_child_repeat) for child in children):
+            return True
+    return False
+
+
+def compile_search_pattern(pattern: str) -> re.Pattern[str]:
+    """Compile a user supplied search pattern case-insensitively.
+
+    Raises:
+        re.error: If the pattern cannot be compiled.
+        PatternTooExpensive: If the pattern contains nested unbounded repeats.
+    """
+    compiled = re.compile(pattern, re.IGNORECASE)
+    if has_nested_unbounded_repeat(pattern):
+        raise PatternTooExpensive(pattern)
+    return compiled
+
+
+def _start_worker() -> None:
+    pass
+
+
+def _find_first_match(pattern: str, contents: Sequence[str]) -> Optional[int]:
+    compiled = re.compile(pattern, re.IGNORECASE)
+    for i, content in enumerate(contents):
+        if compiled.search(content) is not None:
+            return i
+    return None
+
+
+class PatternSearchPool:
+    """Pool of worker processes to search with user supplied patterns, so a slow search can be stopped.
+
+    The workers are started in the background by :meth:`start` and again after every restart, and at most one search
+    per worker is submitted at a time, so the timeout only covers the time a worker spends on the search and not the
+    time it takes to start the workers or to wait for a free worker. Searches that exceed the timeout are stopped by killing the
+    workers and replacing the pool. Searches that were running in the killed pool at the same time are retried once in
+    the new pool.
+    """
+
+    def __init__(self, workers: int, timeout: float) -> None:
+        self.workers = workers
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(workers)
+        self._executor = self._create_executor()
+        self._started: Optional[asyncio.Future] = None
+
+    def start(self) -> None:
+        """Start the worker processes in the background, which takes longer than most searches."""
+        loop = asyncio.get_running_loop()
+        self._started = asyncio.gather(
+            *(loop.run_in_executor(self._executor, _start_worker) for _ in range(self.workers)), return_exceptions=True
+        )
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        # Forking the bot process would copy its event loop and open connections into the workers
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    async def find_first_match(self, pattern: str, contents: Sequence[str]) -> Optional[int]:
+        """Search the contents for the pattern case-insensitively in a worker process.
+
+        Args:
+            pattern (str): The pattern, which should be checked with :func:`compile_search_pattern` first.
+            contents (Sequence[str]): The contents to search.
+
+        Raises:
+            PatternTooExpensive: If the search did not finish before the timeout.
+
+        Returns:
+            Optional[int]: The index of the first matching content, or None if there is no match.
+        """
+        if not contents:
+            return None
+        executor = self._executor
+        try:
+            return await self._search(executor, pattern, contents)
+        except BrokenProcessPool:
+            # Killed because of another search that timed out
+            self._restart(executor)
+            return await self._search(self._executor, pattern, contents)
+
+    async def _search(self, executor: ProcessPoolExecutor, pattern: str, contents: Sequence[str]) -> Optional[int]:
+        async with self._semaphore:
+            if executor is not self._executor:
+                # Replaced while waiting for a free worker
+                executor = self._executor
+            if self._started is None:
+                self.start()
+            # Shielded, since the workers are shared with the other searches
+            await asyncio.shield(self._started)
+            future = asyncio.get_running_loop().run_in_executor(executor, _find_first_match, pattern, list(contents))
+            try:
+                return await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                self._restart(executor)
+                raise PatternTooExpensive(pattern) from None
+
+    def _restart(self, executor: ProcessPoolExecutor) -> None:
+        if executor is not self._executor:
+            return
+        self._executor = self._create_executor()
+        self.start()
+        for process in tuple((getattr(executor, "_processes", None) or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def close(self) -> None:
+        if self._started is not None:
+            self._started.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
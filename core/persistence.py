@@ -15,28 +15,264 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import asyncio
+import re
 import sqlite3
-from collections.abc import Iterable
+from collections.abc import AsyncIterator, Iterable, Mapping
+from contextlib import asynccontextmanager
 from os import PathLike
-from typing import Any
+from sys import stderr
+from time import perf_counter
+from typing import Any, Callable, ClassVar, Optional
 
 from aiosqlite import Connection
 from aiosqlite.context import contextmanager
+from aiosqlite.cursor import Cursor
+
+# Schema migrations, applied in order. The index of a migration + 1 is the schema version (`PRAGMA user_version`) after
+# applying it. Existing migrations must not be changed, add a new migration instead.
+_MIGRATIONS = (
+    # 1: Initial schema
+    """
+    CREATE TABLE
+    IF NOT EXISTS guild (
+        guild_id INTEGER PRIMARY KEY,
+        prefix TEXT DEFAULT '{default_prefix}' NOT NULL,
+        quote_reactions INTEGER DEFAULT 0 NOT NULL,
+        quote_links INTEGER DEFAULT 0 NOT NULL,
+        delete_commands INTEGER DEFAULT 0 NOT NULL,
+        snipe_requires_manage_messages INTEGER DEFAULT 0 NOT NULL
+    );
+    CREATE TABLE
+    IF NOT EXISTS channel (
+        channel_id INTEGER NOT NULL PRIMARY KEY,
+        guild_id INTEGER NOT NULL REFERENCES guild ON DELETE CASCADE
+    );
+    CREATE TABLE
+    IF NOT EXISTS message (
+        message_id INTEGER NOT NULL PRIMARY KEY,
+        channel_id INTEGER REFERENCES channel ON DELETE CASCADE
+    );
+    CREATE TABLE
+    IF NOT EXISTS saved_quote (
+        owner_id INTEGER NOT NULL,
+        alias TEXT NOT NULL,
+        message_id INTEGER NOT NULL REFERENCES message ON DELETE CASCADE,
+        PRIMARY KEY (owner_id, alias)
+    );
+    CREATE TABLE
+    IF NOT EXISTS highlight (
+        user_id INTEGER NOT NULL,
+        query TEXT NOT NULL,
+        guild_id INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, query, guild_id)
+    );
+    CREATE TABLE
+    IF NOT EXISTS blocked (
+        blocked_id INTEGER NOT NULL PRIMARY KEY
+    );
+
+    CREATE TRIGGER
+    IF NOT EXISTS delete_saved_guild_quotes
+        AFTER DELETE ON guild
+    BEGIN
+        DELETE FROM saved_quote
+        WHERE owner_id = old.guild_id;
+    END;
+
+    CREATE TRIGGER
+    IF NOT EXISTS delete_guild_highlights
+        AFTER DELETE ON guild
+    BEGIN
+        DELETE FROM highlight
+        WHERE guild_id = old.guild_id;
+    END;
+    """,
+    # 2: Indexes for the ON DELETE CASCADE and trigger lookups
+    """
+    CREATE INDEX IF NOT EXISTS channel_guild_id_idx ON channel (guild_id);
+    CREATE INDEX IF NOT EXISTS message_channel_id_idx ON message (channel_id);
+    CREATE INDEX IF NOT EXISTS saved_quote_message_id_idx ON saved_quote (message_id);
+    CREATE INDEX IF NOT EXISTS highlight_guild_id_idx ON highlight (guild_id);
+    """,
+)
+
+# Named sets of performance-related PRAGMAs applied to every connection, selected with `database.profile` in the config.
+PERFORMANCE_PROFILES: dict[str, dict[str, int | str]] = {
+    # SQLite's defaults: every commit is synced to disk.
+    "durable": {
+        "synchronous": "FULL",
+        "busy_timeout": 5000,
+    },
+    # Commits are synced at checkpoints only, which can lose the last transactions (but not corrupt the database) on
+    # power loss.
+    "balanced": {
+        "synchronous": "NORMAL",
+        "cache_size": -16384,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+    # Additionally memory-maps the database and checkpoints the WAL less often, at the cost of memory and WAL size.
+    "fast": {
+        "synchronous": "NORMAL",
+        "cache_size": -65536,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+        "wal_autocheckpoint": 4000,
+    },
+}
+_PERFORMANCE_PRAGMAS = frozenset(
+    ("synchronous", "cache_size", "mmap_size", "temp_store", "busy_timeout", "wal_autocheckpoint")
+)
+_PRAGMA_KEYWORD_RE = re.compile(r"[A-Za-z]+")
+
+
+def performance_pragmas(profile: str, overrides: Mapping[str, int | str] | None = None) -> dict[str, int | str]:
+    """Get the performance PRAGMAs of a profile, with optional overrides of individual PRAGMAs.
+
+    Args:
+        profile (str): The name of a profile in `PERFORMANCE_PROFILES`.
+        overrides (Mapping[str, int | str], optional): PRAGMA values replacing those of the profile.
+
+    Raises:
+        ValueError: If the profile, a PRAGMA name or a PRAGMA value is invalid.
+
+    Returns:
+        dict[str, int | str]: The PRAGMA names mapped to their values.
+    """
+    try:
+        pragmas = PERFORMANCE_PROFILES[profile] | dict(overrides or {})
+    except KeyError:
+        raise ValueError(f"Unknown database profile {profile!r}, expected one of {', '.join(PERFORMANCE_PROFILES)}.")
+    for name, value in pragmas.items():
+        if name not in _PERFORMANCE_PRAGMAS:
+            raise ValueError(f"Unsupported database PRAGMA {name!r}.")
+        if not isinstance(value, int) and not (isinstance(value, str) and _PRAGMA_KEYWORD_RE.fullmatch(value)):
+            raise ValueError(f"Invalid value {value!r} for database PRAGMA {name!r}.")
+    return pragmas
+
+
+def normalize_sql(sql: str) -> str:
+    """Collapse the whitespace of a statement, so the same statement is formatted the same everywhere."""
+    return " ".join(sql.split())
 
 
 class AsyncDatabaseConnection(Connection):
+    # Called with each statement, its duration in seconds and the number of rows fetched by `execute_fetchone` and
+    # `execute_fetchall` (None for the other methods), e.g. to collect metrics
+    query_observers: ClassVar[list[Callable[[str, float, Optional[int]], None]]] = []
+    # Statements taking at least this many seconds are logged with their query plan, if set
+    slow_query_threshold: ClassVar[Optional[float]] = None
+
     def __init__(self, *args: Any, **kwargs: Any) -> None:
         super().__init__(*args, **kwargs)
 
+    @contextmanager
+    async def execute(self, sql: str, parameters: Optional[Iterable[Any]] = None) -> Cursor:
+        start = perf_counter()
+        try:
+            cursor = await super().execute(sql, parameters)
+        finally:
+            duration = self._observe_query(sql, start)
+        await self._log_if_slow(sql, parameters, duration)
+        return cursor
+
+    @contextmanager
+    async def executemany(self, sql: str, parameters: Iterable[Iterable[Any]]) -> Cursor:
+        start = perf_counter()
+        try:
+            return await super().executemany(sql, parameters)
+        finally:
+            # Not logged if slow, since the parameters may have been consumed, so the query plan can't be explained
+            self._observe_query(sql, start)
+
+    async def execute_fetchall(self, sql: str, parameters: Optional[Iterable[Any]] = None) -> Iterable[sqlite3.Row]:
+        start = perf_counter()
+        rows: Iterable[sqlite3.Row] = ()
+        try:
+            rows = await super().execute_fetchall(sql, parameters)
+        finally:
+            duration = self._observe_query(sql, start, len(rows))  # type: ignore
+        await self._log_if_slow(sql, parameters, duration)
+        return rows
+
+    def _observe_query(self, sql: str, start: float, rows: Optional[int] = None) -> float:
+        duration = perf_counter() - start
+        for observer in AsyncDatabaseConnection.query_observers:
+            observer(sql, duration, rows)
+        return duration
+
+    async def _log_if_slow(self, sql: str, parameters: Optional[Iterable[Any]], duration: float) -> None:
+        """Log a statement with its query plan if it was slow.
+
+        This is awaited before the statement returns, so the plan is explained while the caller still holds the
+        connection, instead of in between the statements of the next holder.
+        """
+        if (threshold := AsyncDatabaseConnection.slow_query_threshold) is None or duration < threshold:
+            return
+        try:
+            # Not through `self.execute_fetchall`, so explaining is not recorded as a statement itself
+            plan = [row[3] for row in await Connection.execute_fetchall(self, f"EXPLAIN QUERY PLAN {sql}", parameters)]
+        except (sqlite3.Error, ValueError):
+            # E.g. a statement that can't be explained
+            plan = ["(query plan unavailable)"]
+        print(f"Slow query ({duration * 1000:.1f} ms): {normalize_sql(sql)}", file=stderr)
+        for detail in plan:
+            print(f"    {detail}", file=stderr)
+
     async def enable_foreign_keys(self) -> None:
         await self.execute("PRAGMA foreign_keys = ON")
 
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[None]:
+        """Run the statements in the block in a single transaction, rolling back if an exception is raised.
+
+        The write lock is taken immediately, so a transaction waits for writers in other processes up to the busy timeout
+        instead of failing when it starts writing after reading.
+        """
+        await self.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            await self.rollback()
+            raise
+        await self.commit()
+
+    async def replace_temp_ids(self, table: str, ids: Iterable[int]) -> None:
+        """Fill a temporary table of this connection with the given IDs, for use in set-based statements.
+
+        Args:
+            table (str): The name of the temporary table, which has a single `id` column.
+            ids (Iterable[int]): The IDs to insert.
+        """
+        await self.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY)")
+        await self.execute(f"DELETE FROM temp.{table}")
+        await self.executemany(f"INSERT OR IGNORE INTO temp.{table} VALUES (?)", ((id_,) for id_ in ids))
+
+    async def shard_condition(self, shard_ids: Iterable[int] | None, shard_count: int) -> str:
+        """Get a condition restricting a statement on a table with a `guild_id` column to guilds of some shards.
+
+        The condition has a `shard_count` parameter, which must follow the other parameters of the statement.
+        """
+        if shard_ids is None:
+            return ""
+        await self.replace_temp_ids("local_shard", shard_ids)
+        return " AND (guild_id >> 22) % ? IN (SELECT id FROM temp.local_shard)"
+
     @contextmanager
     async def execute_fetchone(self, sql: str, parameters: Iterable[Any] | None = None) -> sqlite3.Row | None:
         if parameters is None:
             parameters = []
-        cursor = await self.execute(sql, parameters)
-        return await cursor.fetchone()
+        start = perf_counter()
+        row = None
+        try:
+            cursor = await super().execute(sql, parameters)
+            row = await cursor.fetchone()
+        finally:
+            duration = self._observe_query(sql, start, int(row is not None))
+        await self._log_if_slow(sql, parameters, duration)
+        return row
 
 
 class GuildConnectionMixin(AsyncDatabaseConnection):
@@ -46,6 +282,12 @@ class GuildConnectionMixin(AsyncDatabaseConnection):
             (guild_id, prefix),
         )
 
+    async def insert_guilds(self, guild_ids: Iterable[int], prefix: str) -> None:
+        await self.executemany(
+            "INSERT OR IGNORE INTO guild (guild_id, prefix) VALUES (?, ?)",
+            ((guild_id, prefix) for guild_id in guild_ids),
+        )
+
     async def fetch_prefix(self, guild_id: int) -> str | None:
         if row := await self.execute_fetchone("SELECT prefix FROM guild WHERE guild_id = ?", (guild_id,)):
             return row[0]
@@ -69,6 +311,9 @@ class GuildConnectionMixin(AsyncDatabaseConnection):
         ):
             return bool(row[0])
 
+    async def fetch_guild_settings(self) -> Iterable[sqlite3.Row]:
+        return await self.execute_fetchall("SELECT * FROM guild")
+
     async def fetch_guild_ids(self) -> Iterable[int]:
         return (row[0] for row in await self.execute_fetchall("SELECT guild_id FROM guild"))
 
@@ -90,12 +335,22 @@ class GuildConnectionMixin(AsyncDatabaseConnection):
             (int(snipe_requires_manage_messages), guild_id),
         )
 
-    async def filter_guilds(self, keep_guild_ids: tuple[int, ...]) -> None:
-        if (keep_amount := len(keep_guild_ids)) < 1000:
-            await self.execute(f"DELETE FROM guild WHERE guild_id NOT IN ({', '.join('?' * keep_amount)})", keep_guild_ids)
-        else:
-            for i in range(0, keep_amount, 999):
-                await self.filter_guilds(keep_guild_ids[i : i + 999])
+    async def filter_guilds(
+        self, keep_guild_ids: Iterable[int], shard_ids: Iterable[int] | None = None, shard_count: int = 1
+    ) -> None:
+        """Delete the guilds that are not kept.
+
+        Args:
+            keep_guild_ids (Iterable[int]): The IDs of the guilds to keep.
+            shard_ids (Iterable[int], optional): Only delete guilds of these shards. Defaults to all shards.
+            shard_count (int, optional): The total number of shards. Defaults to 1.
+        """
+        await self.replace_temp_ids("keep_guild", keep_guild_ids)
+        await self.execute(
+            f"DELETE FROM guild WHERE guild_id NOT IN (SELECT id FROM temp.keep_guild)"
+            f"{await self.shard_condition(shard_ids, shard_count)}",
+            () if shard_ids is None else (shard_count,),
+        )
 
     async def delete_guild(self, guild_id: int) -> None:
         await self.execute("DELETE FROM guild WHERE guild_id = ?", (guild_id,))
@@ -111,6 +366,17 @@ class MessageConnectionMixin(AsyncDatabaseConnection):
     async def delete_channel_or_thread(self, channel_or_thread_id: int) -> None:
         await self.execute("DELETE FROM channel WHERE channel_id = ?", (channel_or_thread_id,))
 
+    async def filter_channels_and_threads(
+        self, keep_channel_or_thread_ids: Iterable[int], shard_ids: Iterable[int] | None = None, shard_count: int = 1
+    ) -> None:
+        """Delete the channels and threads that are not kept, like :meth:`GuildConnectionMixin.filter_guilds`."""
+        await self.replace_temp_ids("keep_channel", keep_channel_or_thread_ids)
+        await self.execute(
+            f"DELETE FROM channel WHERE channel_id NOT IN (SELECT id FROM temp.keep_channel)"
+            f"{await self.shard_condition(shard_ids, shard_count)}",
+            () if shard_ids is None else (shard_count,),
+        )
+
     async def insert_message(self, msg_id: int, channel_id: int | None) -> None:
         await self.execute("INSERT OR IGNORE INTO message VALUES (?, ?)", (msg_id, channel_id))
 
@@ -124,9 +390,15 @@ class MessageConnectionMixin(AsyncDatabaseConnection):
         ):
             return row
 
+    async def fetch_message_ids(self) -> Iterable[int]:
+        return (row[0] for row in await self.execute_fetchall("SELECT message_id FROM message"))
+
     async def delete_message(self, msg_id: int) -> None:
         await self.execute("DELETE FROM message WHERE message_id = ?", (msg_id,))
 
+    async def delete_messages(self, msg_ids: Iterable[int]) -> None:
+        await self.executemany("DELETE FROM message WHERE message_id = ?", ((msg_id,) for msg_id in msg_ids))
+
 
 class BlockedConnectionMixin(AsyncDatabaseConnection):
     async def insert_blocked_id(self, blocked_id: int) -> None:
@@ -253,73 +525,54 @@ class QuoteBotDatabaseConnection(
     SavedQuoteConnectionMixin,
 ):
     async def __aenter__(self) -> "QuoteBotDatabaseConnection":
+        return await self.open()
+
+    async def open(
+        self, read_only: bool = False, pragmas: Mapping[str, int | str] | None = None
+    ) -> "QuoteBotDatabaseConnection":
+        """Open the connection.
+
+        Args:
+            read_only (bool, optional): Whether to disallow modifying the database. Defaults to False.
+            pragmas (Mapping[str, int | str], optional): PRAGMAs to set, see :func:`performance_pragmas`.
+
+        Returns:
+            QuoteBotDatabaseConnection: The opened connection.
+        """
         con = await self
         con.row_factory = sqlite3.Row
+        if read_only:
+            await con.execute("PRAGMA query_only = ON")
+        else:
+            # Only has an effect on a new database and must precede switching to WAL mode, which initialises the file.
+            await con.execute("PRAGMA auto_vacuum = 1")
         await con.execute("PRAGMA journal_mode = WAL")
+        for name, value in (pragmas or {}).items():
+            await con.execute(f"PRAGMA {name} = {value}")
         return con  # type: ignore
 
     async def prepare_db(self, default_prefix: str) -> None:
-        await self.executescript(
-            f"""
-            PRAGMA auto_vacuum = 1;
-            PRAGMA foreign_keys = ON;
-
-            CREATE TABLE
-            IF NOT EXISTS guild (
-                guild_id INTEGER PRIMARY KEY,
-                prefix TEXT DEFAULT '{default_prefix}' NOT NULL,
-                quote_reactions INTEGER DEFAULT 0 NOT NULL,
-                quote_links INTEGER DEFAULT 0 NOT NULL,
-                delete_commands INTEGER DEFAULT 0 NOT NULL,
-                snipe_requires_manage_messages INTEGER DEFAULT 0 NOT NULL
-            );
-            CREATE TABLE
-            IF NOT EXISTS channel (
-                channel_id INTEGER NOT NULL PRIMARY KEY,
-                guild_id INTEGER NOT NULL REFERENCES guild ON DELETE CASCADE
-            );
-            CREATE TABLE
-            IF NOT EXISTS message (
-                message_id INTEGER NOT NULL PRIMARY KEY,
-                channel_id INTEGER REFERENCES channel ON DELETE CASCADE
-            );
-            CREATE TABLE
-            IF NOT EXISTS saved_quote (
-                owner_id INTEGER NOT NULL,
-                alias TEXT NOT NULL,
-                message_id INTEGER NOT NULL REFERENCES message ON DELETE CASCADE,
-                PRIMARY KEY (owner_id, alias)
-            );
-            CREATE TABLE
-            IF NOT EXISTS highlight (
-                user_id INTEGER NOT NULL,
-                query TEXT NOT NULL,
-                guild_id INTEGER NOT NULL DEFAULT 0,
-                PRIMARY KEY (user_id, query, guild_id)
-            );
-            CREATE TABLE
-            IF NOT EXISTS blocked (
-                blocked_id INTEGER NOT NULL PRIMARY KEY
-            );
-
-            CREATE TRIGGER
-            IF NOT EXISTS delete_saved_guild_quotes
-                AFTER DELETE ON guild
-            BEGIN
-                DELETE FROM saved_quote
-                WHERE owner_id = old.guild_id;
-            END;
-
-            CREATE TRIGGER
-            IF NOT EXISTS delete_guild_highlights
-                AFTER DELETE ON guild
-            BEGIN
-                DELETE FROM highlight
-                WHERE guild_id = old.guild_id;
-            END;
+        """Create the schema or migrate it to the latest version.
+
+        The schema version is stored in `PRAGMA user_version`, so an up-to-date database is left untouched. Each
+        migration runs in its own transaction together with the version update.
+
+        Args:
+            default_prefix (str): The default command prefix of new guilds.
         """
-        )
-        await self.commit()
+        version = (await self.execute_fetchone("PRAGMA user_version"))[0]  # type: ignore
+        if version >= len(_MIGRATIONS):
+            return
+        await self.enable_foreign_keys()
+        for version, migration in enumerate(_MIGRATIONS[version:], version + 1):
+            try:
+                await self.executescript(
+                    f"BEGIN IMMEDIATE; {migration.format(default_prefix=default_prefix)} PRAGMA user_version = {version}; COMMIT;"
+                )
+            except sqlite3.Error:
+                if self.in_transaction:
+                    await self.rollback()
+                raise
 
 
 def connect(database: str | bytes | PathLike, iter_chunk_size: int = 64) -> QuoteBotDatabaseConnection:
@@ -329,3 +582,76 @@ def connect(database: str | bytes | PathLike, iter_chunk_size: int = 64) -> Quot
         ),
         iter_chunk_size=iter_chunk_size,
     )
+
+
+class ConnectionPool:
+    """Long-lived connections to a QuoteBot database.
+
+    SQLite in WAL mode allows many concurrent readers but only one writer, so the pool keeps a fixed set of read-only
+    connections that are handed out concurrently and a single writer connection that is serialised with a lock.
+    """
+
+    def __init__(
+        self, database: str | bytes | PathLike, readers: int = 4, pragmas: Mapping[str, int | str] | None = None
+    ) -> None:
+        self.database = database
+        self.reader_count = max(1, readers)
+        self.pragmas = pragmas or {}
+        self._readers: asyncio.Queue[QuoteBotDatabaseConnection] = asyncio.Queue()
+        self._connections: list[QuoteBotDatabaseConnection] = []
+        self._writer: QuoteBotDatabaseConnection | None = None
+        self._write_lock = asyncio.Lock()
+        self._closing = False
+
+    async def open(self) -> None:
+        # The writer is opened first, so it can switch a new database to WAL mode before any reader connects.
+        self._writer = await connect(self.database).open(pragmas=self.pragmas)
+        await self._writer.enable_foreign_keys()
+        self._connections.append(self._writer)
+        for _ in range(self.reader_count):
+            reader = await connect(self.database).open(read_only=True, pragmas=self.pragmas)
+            self._connections.append(reader)
+            self._readers.put_nowait(reader)
+
+    async def close(self) -> None:
+        """Close the connections once they are no longer in use. Readers can no longer be acquired from then on."""
+        self._closing = True
+        # Wait for the readers in use to be returned, before the writer in case their holders also need the writer
+        for _ in range(len(self._connections) - (self._writer is not None)):
+            await self._readers.get()
+        async with self._write_lock:
+            for con in self._connections:
+                await con.close()
+            self._connections.clear()
+            self._writer = None
+
+    @asynccontextmanager
+    async def acquire(self, write: bool = False) -> AsyncIterator[QuoteBotDatabaseConnection]:
+        """Acquire a connection from the pool.
+
+        Args:
+            write (bool, optional): Whether the writer connection is needed. Defaults to a read-only connection.
+
+        Yields:
+            QuoteBotDatabaseConnection: The connection, which is returned to the pool afterwards.
+        """
+        if not write:
+            if self._closing:
+                raise sqlite3.ProgrammingError("Cannot operate on a closed connection pool.")
+            reader = await self._readers.get()
+            try:
+                yield reader
+            finally:
+                self._readers.put_nowait(reader)
+            return
+        async with self._write_lock:
+            if (writer := self._writer) is None:
+                raise sqlite3.ProgrammingError("Cannot operate on a closed connection pool.")
+            try:
+                yield writer
+            except BaseException:
+                if writer.in_transaction:
+                    await writer.rollback()
+                raise
+            if writer.in_transaction:
+                await writer.commit()
@@ -0,0 +1,97 @@
+"""
+Copyright (C) 2020-2024 JonathanFeenstra, Deivedux, kageroukw
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import statistics
+from collections import deque
+from typing import NamedTuple, Optional
+
+from core.persistence import normalize_sql
+
+_MAX_DURATION_SAMPLES = 1000
+
+
+class _StatementRecord:
+    __slots__ = ("count", "total_duration", "rows", "durations")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total_duration = 0.0
+        self.rows = 0
+        self.durations: deque[float] = deque(maxlen=_MAX_DURATION_SAMPLES)
+
+
+class StatementStats(NamedTuple):
+    sql: str
+    count: int
+    total_duration: float
+    median_duration: float
+    p95_duration: float
+    max_duration: float
+    # Rows fetched, or None if the statement was only executed without fetching
+    rows: Optional[int]
+
+
+class QueryStats:
+    """Per-statement counts, durations and fetched rows of the database statements.
+
+    Statements are identified by their SQL with collapsed whitespace, so the same statement with different parameters
+    is counted together. The percentiles are computed from the last `_MAX_DURATION_SAMPLES` durations.
+    """
+
+    def __init__(self) -> None:
+        self._records: dict[str, _StatementRecord] = {}
+        # Raw SQL mapped to its normalized form, since most statements are executed many times
+        self._normalized: dict[str, str] = {}
+        self._fetched: set[str] = set()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def record(self, sql: str, duration: float, rows: Optional[int] = None) -> None:
+        if (normalized := self._normalized.get(sql)) is None:
+            normalized = self._normalized[sql] = normalize_sql(sql)
+        if (record := self._records.get(normalized)) is None:
+            record = self._records[normalized] = _StatementRecord()
+        record.count += 1
+        record.total_duration += duration
+        record.durations.append(duration)
+        if rows is not None:
+            record.rows += rows
+            self._fetched.add(normalized)
+
+    def top(self, n: int = 10) -> list[StatementStats]:
+        """Get the stats of the `n` statements with the highest total duration."""
+        return [
+            self._stats(sql, record)
+            for sql, record in sorted(self._records.items(), key=lambda item: item[1].total_duration, reverse=True)[:n]
+        ]
+
+    def reset(self) -> None:
+        self._records.clear()
+        self._fetched.clear()
+
+    def _stats(self, sql: str, record: _StatementRecord) -> StatementStats:
+        durations = sorted(record.durations)
+        return StatementStats(
+            sql,
+            record.count,
+            record.total_duration,
+            statistics.median(durations),
+            durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+            durations[-1],
+            record.rows if sql in self._fetched else None,
+        )
@@ -0,0 +1,108 @@
+"""
+Copyright (C) 2020-2024 JonathanFeenstra, Deivedux, kageroukw
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from collections import OrderedDict, deque
+from collections.abc import Iterable
+from datetime import datetime
+from typing import Optional
+
+import discord
+
+
+class MessageSnapshot:
+    """The parts of a message needed to look it up by author or content."""
+
+    __slots__ = ("id", "author_id", "content")
+
+    def __init__(self, msg_id: int, author_id: int, content: str) -> None:
+        self.id = msg_id
+        self.author_id = author_id
+        self.content = content
+
+    @property
+    def created_at(self) -> datetime:
+        return discord.utils.snowflake_time(self.id)
+
+
+class _ChannelBuffer:
+    __slots__ = ("guild_id", "snapshots")
+
+    def __init__(self, guild_id: Optional[int], capacity: int) -> None:
+        self.guild_id = guild_id
+        self.snapshots: deque[MessageSnapshot] = deque(maxlen=capacity)
+
+
+class RecentMessageBuffers:
+    """Ring buffers with snapshots of the most recent messages per channel or thread.
+
+    A buffer holds every message sent in its channel or thread since the buffer was created, up to its capacity, so it
+    always covers the newest messages without gaps. Buffers of a shard are dropped when it disconnects, because
+    messages sent in the meantime would be missing. The least recently active buffer is dropped when there are more
+    than `max_channels` buffers.
+    """
+
+    def __init__(self, messages_per_channel: int, max_channels: int) -> None:
+        self.messages_per_channel = messages_per_channel
+        self.max_channels = max_channels
+        self._buffers: OrderedDict[int, _ChannelBuffer] = OrderedDict()
+
+    def __len__(self) -> int:
+        return sum(len(buffer.snapshots) for buffer in self._buffers.values())
+
+    def add(self, msg: discord.Message) -> None:
+        if (buffer := self._buffers.get(msg.channel.id)) is None:
+            buffer = self._buffers[msg.channel.id] = _ChannelBuffer(msg.guild and msg.guild.id, self.messages_per_channel)
+            if len(self._buffers) > self.max_channels:
+                self._buffers.popitem(last=False)
+        else:
+            self._buffers.move_to_end(msg.channel.id)
+        buffer.snapshots.append(MessageSnapshot(msg.id, msg.author.id, msg.content))
+
+    def update_content(self, channel_or_thread_id: int, msg_id: int, content: str) -> None:
+        if (snapshot := self._find(channel_or_thread_id, msg_id)) is not None:
+            snapshot.content = content
+
+    def remove(self, channel_or_thread_id: int, msg_ids: Iterable[int]) -> None:
+        if (buffer := self._buffers.get(channel_or_thread_id)) is not None:
+            msg_ids = set(msg_ids)
+            snapshots = [snapshot for snapshot in buffer.snapshots if snapshot.id not in msg_ids]
+            if len(snapshots) != len(buffer.snapshots):
+                buffer.snapshots = deque(snapshots, maxlen=self.messages_per_channel)
+
+    def drop_shard(self, shard_id: int, shard_count: int) -> None:
+        """Drop the buffers of the channels and threads of a shard, including DM channels for shard 0."""
+        for channel_or_thread_id, buffer in tuple(self._buffers.items()):
+            if (0 if buffer.guild_id is None else (buffer.guild_id >> 22) % shard_count) == shard_id:
+                del self._buffers[channel_or_thread_id]
+
+    def before(self, channel_or_thread_id: int, msg_id: int) -> list[MessageSnapshot]:
+        """Get the buffered messages of a channel or thread sent before a message.
+
+        Returns:
+            list[MessageSnapshot]: The snapshots, newest first. These are the newest messages before `msg_id` without
+            gaps, so messages older than the last snapshot need to be fetched from the history.
+        """
+        if (buffer := self._buffers.get(channel_or_thread_id)) is None:
+            return []
+        return [snapshot for snapshot in reversed(buffer.snapshots) if snapshot.id < msg_id]
+
+    def _find(self, channel_or_thread_id: int, msg_id: int) -> Optional[MessageSnapshot]:
+        if (buffer := self._buffers.get(channel_or_thread_id)) is not None:
+            for snapshot in reversed(buffer.snapshots):
+                if snapshot.id == msg_id:
+                    return snapshot
+        return None
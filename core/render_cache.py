@@ -0,0 +1,90 @@
+"""
+Copyright (C) 2020-2024 JonathanFeenstra, Deivedux, kageroukw
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from collections import OrderedDict
+from copy import deepcopy
+from datetime import datetime
+from typing import Any, NamedTuple, Optional
+
+import discord
+
+
+class RenderKey(NamedTuple):
+    msg_id: int
+    edited_at: Optional[datetime]
+    same_guild: bool
+    nsfw_hidden: bool
+    quote_type: str
+
+
+class RenderCacheStats(NamedTuple):
+    entries: int
+    max_entries: int
+    hits: int
+    misses: int
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / lookups if (lookups := self.hits + self.misses) else 0.0
+
+
+class RenderCache:
+    """LRU cache of rendered quote embeds without their footer, which depends on who quotes the message.
+
+    Entries of a message are invalidated when it is edited or deleted. Changes to the author, like a new avatar, are
+    only reflected once the entry is evicted.
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._payloads: OrderedDict[RenderKey, dict[str, Any]] = OrderedDict()
+        self._keys_by_msg_id: dict[int, set[RenderKey]] = {}
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self) -> int:
+        return len(self._payloads)
+
+    def get(self, key: RenderKey) -> Optional[discord.Embed]:
+        """Get a copy of a cached embed, which can be modified."""
+        if (payload := self._payloads.get(key)) is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        self._payloads.move_to_end(key)
+        # The nested payloads, like the author and fields, would otherwise be shared with the cached payload
+        return discord.Embed.from_dict(deepcopy(payload))
+
+    def put(self, key: RenderKey, embed: discord.Embed) -> None:
+        self._payloads[key] = deepcopy(embed.to_dict())
+        self._payloads.move_to_end(key)
+        self._keys_by_msg_id.setdefault(key.msg_id, set()).add(key)
+        if len(self._payloads) > self.max_entries:
+            self._discard_key(self._payloads.popitem(last=False)[0])
+
+    def invalidate(self, msg_id: int) -> None:
+        for key in self._keys_by_msg_id.pop(msg_id, ()):
+            del self._payloads[key]
+
+    def stats(self) -> RenderCacheStats:
+        return RenderCacheStats(len(self._payloads), self.max_entries, self._hits, self._misses)
+
+    def _discard_key(self, key: RenderKey) -> None:
+        if (keys := self._keys_by_msg_id.get(key.msg_id)) is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_msg_id[key.msg_id]
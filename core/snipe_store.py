@@ -0,0 +1,215 @@
+"""
+Copyright (C) 2020-2024 JonathanFeenstra, Deivedux, kageroukw
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import itertools
+import sys
+from collections import OrderedDict, deque
+from datetime import datetime
+from time import monotonic
+from typing import Any, NamedTuple, Optional, Union
+
+import discord
+
+# Rough size of a snapshot with its author and deque/index entries, excluding the strings and embeds
+_SNAPSHOT_OVERHEAD = 600
+_ATTACHMENT_OVERHEAD = 120
+_EMBED_OVERHEAD = 400
+
+GuildMessageable = Union[discord.TextChannel, discord.Thread, discord.VoiceChannel, discord.StageChannel]
+
+
+class SnipedAuthor:
+    """The parts of a message author needed to quote a message."""
+
+    __slots__ = ("id", "bot", "color", "display_avatar", "_name")
+
+    def __init__(self, author: Union[discord.User, discord.Member]) -> None:
+        self.id = author.id
+        self.bot = author.bot
+        self.color = author.color
+        self.display_avatar = author.display_avatar
+        self._name = str(author)
+
+    def __str__(self) -> str:
+        return self._name
+
+    def __eq__(self, other: Any) -> bool:
+        return getattr(other, "id", None) == self.id
+
+    def __hash__(self) -> int:
+        return self.id >> 22
+
+    @property
+    def mention(self) -> str:
+        return f"<@{self.id}>"
+
+
+class SnipedAttachment(NamedTuple):
+    filename: str
+    url: str
+
+
+class SnipedMessage:
+    """Snapshot of a deleted or edited message with the attributes :meth:`bot.QuoteBot.quote_message` needs.
+
+    The channel and guild are references to the live objects, which are kept in the client cache anyway, so the
+    snapshot does not keep the rest of the message (like the member, references and stickers) alive.
+    """
+
+    __slots__ = (
+        "id",
+        "content",
+        "clean_content",
+        "author",
+        "embeds",
+        "attachments",
+        "channel",
+        "guild",
+        "edited_at",
+        "nbytes",
+        "stored_at",
+        "_serial",
+    )
+
+    def __init__(self, msg: discord.Message) -> None:
+        self.id = msg.id
+        self.content = msg.content
+        # Content without mentions is cleaned to itself, which doesn't need to be stored twice
+        self.clean_content = msg.clean_content if "<" in msg.content or "@" in msg.content else msg.content
+        self.author = SnipedAuthor(msg.author)
+        self.embeds = msg.embeds
+        self.attachments = tuple(SnipedAttachment(attachment.filename, attachment.url) for attachment in msg.attachments)
+        self.channel: GuildMessageable = msg.channel  # type: ignore
+        self.guild: discord.Guild = msg.guild  # type: ignore
+        self.edited_at = msg.edited_at
+        self.nbytes = (
+            _SNAPSHOT_OVERHEAD
+            + sys.getsizeof(self.content)
+            + (0 if self.clean_content is self.content else sys.getsizeof(self.clean_content))
+            + sum(
+                _ATTACHMENT_OVERHEAD + sys.getsizeof(attachment.filename) + sys.getsizeof(attachment.url)
+                for attachment in self.attachments
+            )
+            + sum(
+                _EMBED_OVERHEAD + sys.getsizeof(embed.title or "") + sys.getsizeof(embed.description or "")
+                for embed in self.embeds
+            )
+        )
+        self.stored_at = 0.0
+        self._serial = 0
+
+    @property
+    def created_at(self) -> datetime:
+        return discord.utils.snowflake_time(self.id)
+
+    @property
+    def jump_url(self) -> str:
+        return f"https://discord.com/channels/{self.guild.id}/{self.channel.id}/{self.id}"
+
+
+class SnipeStats(NamedTuple):
+    entries: int
+    channels: int
+    nbytes: int
+    max_bytes: int
+
+
+class SnipeStore:
+    """Bounded store of the last deleted and edited messages per channel or thread.
+
+    Each channel or thread keeps its last `entries_per_channel` deletes and edits. Snapshots are evicted across all
+    guilds in the order they were stored once they are older than `ttl` seconds or when the estimated size of all
+    snapshots exceeds `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, entries_per_channel: int) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries_per_channel = entries_per_channel
+        self.nbytes = 0
+        self._channels: dict[tuple[int, bool], deque[SnipedMessage]] = {}
+        self._order: OrderedDict[int, tuple[int, bool]] = OrderedDict()
+        self._serials = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def stats(self) -> SnipeStats:
+        self._expire()
+        return SnipeStats(len(self._order), len(self._channels), self.nbytes, self.max_bytes)
+
+    def put(self, msg: discord.Message, edit: bool = False) -> None:
+        snapshot = SnipedMessage(msg)
+        snapshot.stored_at = monotonic()
+        snapshot._serial = next(self._serials)
+        key = (msg.channel.id, edit)
+        if (snapshots := self._channels.get(key)) is None:
+            snapshots = self._channels[key] = deque()
+        elif len(snapshots) >= self.entries_per_channel:
+            self._forget(snapshots.popleft())
+        snapshots.append(snapshot)
+        self._order[snapshot._serial] = key
+        self.nbytes += snapshot.nbytes
+        while self.nbytes > self.max_bytes and self._order:
+            self._evict_oldest()
+        self._expire()
+
+    def get(self, channel_or_thread_id: int, edit: bool = False, index: int = 1) -> Optional[SnipedMessage]:
+        """Get a sniped message of a channel or thread.
+
+        Args:
+            channel_or_thread_id (int): The channel or thread ID.
+            edit (bool, optional): Whether to get an edit instead of a delete. Defaults to False.
+            index (int, optional): 1 for the most recent message, 2 for the one before, etc. Defaults to 1.
+
+        Returns:
+            Optional[SnipedMessage]: The snapshot, or None if there is no snapshot at the index.
+        """
+        self._expire()
+        if (snapshots := self._channels.get((channel_or_thread_id, edit))) is None or not 0 < index <= len(snapshots):
+            return None
+        return snapshots[-index]
+
+    def remove_channel(self, channel_or_thread_id: int) -> None:
+        for edit in (False, True):
+            for snapshot in self._channels.pop((channel_or_thread_id, edit), ()):
+                self._forget(snapshot)
+
+    def remove_guild(self, guild_id: int) -> None:
+        for channel_or_thread_id, edit in tuple(self._channels):
+            if (snapshots := self._channels.get((channel_or_thread_id, edit))) and snapshots[0].guild.id == guild_id:
+                self.remove_channel(channel_or_thread_id)
+
+    def _expire(self) -> None:
+        deadline = monotonic() - self.ttl
+        while self._order:
+            key = next(iter(self._order.values()))
+            if self._channels[key][0].stored_at > deadline:
+                return
+            self._evict_oldest()
+
+    def _evict_oldest(self) -> None:
+        # The oldest snapshot overall is always the oldest snapshot of its channel or thread
+        _, key = self._order.popitem(last=False)
+        snapshots = self._channels[key]
+        self.nbytes -= snapshots.popleft().nbytes
+        if not snapshots:
+            del self._channels[key]
+
+    def _forget(self, snapshot: SnipedMessage) -> None:
+        del self._order[snapshot._serial]
+        self.nbytes -= snapshot.nbytes
@@ -0,0 +1,137 @@
+"""
+Copyright (C) 2020-2024 JonathanFeenstra, Deivedux, kageroukw
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import itertools
+from time import monotonic
+from traceback import print_exc
+from typing import NamedTuple, Optional
+
+import discord
+
+# Join priorities, lower is joined first
+PRIORITY_NEEDED = 0
+PRIORITY_FEATURES = 1
+PRIORITY_DEFAULT = 2
+
+_PROGRESS_INTERVAL = 1000
+
+
+class ThreadJoinStats(NamedTuple):
+    pending: int
+    joined: int
+    skipped: int
+    failed: int
+    # Seconds since the current backlog started, or the duration of the last completed backlog
+    backlog_duration: Optional[float]
+    backlog_done: bool
+
+
+class ThreadJoinScheduler:
+    """Background queue that joins threads, so the bot can respond to commands and reactions in them.
+
+    Threads are joined by `workers` concurrent tasks in order of priority, after which they are joined in the order
+    they were scheduled. Threads the bot is already a member of, or that are no longer cached when their turn comes,
+    are skipped. Scheduling a pending thread again with a lower priority value moves it forward in the queue.
+    """
+
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        self._pending: dict[int, tuple[int, discord.Thread]] = {}
+        self._queue: asyncio.PriorityQueue[tuple[int, int, int]] = asyncio.PriorityQueue()
+        self._serials = itertools.count()
+        self._worker_tasks: list[asyncio.Task] = []
+        self._active = 0
+        self._joined = 0
+        self._skipped = 0
+        self._failed = 0
+        self._backlog_started: Optional[float] = None
+        self._backlog_joined = 0
+        self._last_backlog_duration: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def start(self) -> None:
+        self._worker_tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    def stop(self) -> None:
+        """Stop the workers and discard the pending joins."""
+        for task in self._worker_tasks:
+            task.cancel()
+        self._worker_tasks.clear()
+        self._pending.clear()
+        self._queue = asyncio.PriorityQueue()
+
+    def schedule(self, thread: discord.Thread, priority: int = PRIORITY_DEFAULT) -> None:
+        if thread.me is not None or thread.archived:
+            return
+        if (pending := self._pending.get(thread.id)) is not None and pending[0] <= priority:
+            return
+        if self._backlog_started is None:
+            self._backlog_started = monotonic()
+            self._backlog_joined = 0
+        self._pending[thread.id] = (priority, thread)
+        self._queue.put_nowait((priority, next(self._serials), thread.id))
+
+    def stats(self) -> ThreadJoinStats:
+        if self._backlog_started is not None:
+            duration, done = monotonic() - self._backlog_started, False
+        else:
+            duration, done = self._last_backlog_duration, True
+        return ThreadJoinStats(len(self._pending), self._joined, self._skipped, self._failed, duration, done)
+
+    async def _work(self) -> None:
+        while True:
+            priority, _, thread_id = await self._queue.get()
+            # Threads scheduled again with a higher priority have a stale entry left in the queue
+            if (pending := self._pending.get(thread_id)) is None or pending[0] != priority:
+                continue
+            del self._pending[thread_id]
+            thread = pending[1]
+            self._active += 1
+            try:
+                await self._join(thread)
+            finally:
+                self._active -= 1
+                if not self._pending and not self._active:
+                    self._finish_backlog()
+
+    async def _join(self, thread: discord.Thread) -> None:
+        if thread.me is not None or thread.guild.get_thread(thread.id) is None:
+            self._skipped += 1
+            return
+        try:
+            await thread.join()
+        except discord.HTTPException:
+            self._failed += 1
+        except Exception:
+            self._failed += 1
+            print_exc()
+        else:
+            self._joined += 1
+            self._backlog_joined += 1
+            if self._backlog_joined % _PROGRESS_INTERVAL == 0:
+                print(f"Joined {self._backlog_joined} threads, {len(self._pending)} pending.")
+
+    def _finish_backlog(self) -> None:
+        if self._backlog_started is None:
+            return
+        self._last_backlog_duration = monotonic() - self._backlog_started
+        self._backlog_started = None
+        if self._backlog_joined:
+            print(f"Joined {self._backlog_joined} threads ({self._last_backlog_duration:.2f}s).")
@@ -0,0 +1,90 @@
+"""
+Copyright (C) 2020-2024 JonathanFeenstra, Deivedux, kageroukw
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from collections.abc import Iterator
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Optional
+
+
+class PhaseTimer:
+    """Records the durations of consecutive phases of a task."""
+
+    def __init__(self) -> None:
+        self.durations: dict[str, float] = {}
+        self._phase_start = perf_counter()
+
+    def end_phase(self, name: str) -> None:
+        now = perf_counter()
+        self.durations[name] = now - self._phase_start
+        self._phase_start = now
+
+    def __str__(self) -> str:
+        return ", ".join(f"{name}: {duration:.2f}s" for name, duration in self.durations.items())
+
+
+class BootReport:
+    """Records when the startup phases started and how long they took, since some phases run concurrently.
+
+    Times are in seconds since the report was created. Shards are reconciled in a phase per shard, which are summarised
+    instead of listed, since there can be hundreds of them.
+    """
+
+    def __init__(self) -> None:
+        self._started = perf_counter()
+        # Phase names mapped to their start times and durations
+        self.phases: dict[str, tuple[float, float]] = {}
+        self.shards: dict[int, tuple[float, float]] = {}
+        self.total: Optional[float] = None
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = (start - self._started, perf_counter() - start)
+
+    @contextmanager
+    def shard_phase(self, shard_id: int) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.shards[shard_id] = (start - self._started, perf_counter() - start)
+
+    def finish(self) -> None:
+        self.total = perf_counter() - self._started
+
+    def __str__(self) -> str:
+        lines = [
+            f"{name}: {duration:.2f}s (at {start:.2f}s)"
+            for name, (start, duration) in sorted(self.phases.items(), key=lambda item: item[1][0])
+        ]
+        if self.shards:
+            first_start = min(start for start, _ in self.shards.values())
+            last_end = max(start + duration for start, duration in self.shards.values())
+            slowest_shard_id, (_, slowest_duration) = max(self.shards.items(), key=lambda item: item[1][1])
+            lines.append(
+                f"{len(self.shards)} shards reconciled: {last_end - first_start:.2f}s (at {first_start:.2f}s), "
+                f"slowest shard {slowest_shard_id} in {slowest_duration:.2f}s"
+            )
+        if self.total is None:
+            lines.append(f"still starting after {perf_counter() - self._started:.2f}s")
+        else:
+            lines.append(f"total: {self.total:.2f}s")
+        return "\n".join(lines)
@@ -0,0 +1,152 @@
+"""
+Copyright (C) 2020-2024 JonathanFeenstra, Deivedux, kageroukw
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import bisect
+import sys
+import threading
+import traceback
+from collections import deque
+from time import monotonic
+from typing import Callable, NamedTuple, Optional
+
+_HEARTBEAT_INTERVAL = 0.1
+# Lag samples of the last 2 minutes, from which the rolling histogram is computed
+_ROLLING_SAMPLES = 1200
+ROLLING_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+_STACK_FRAMES = 20
+
+
+class Stall(NamedTuple):
+    # Seconds the event loop was blocked
+    duration: float
+    # Name and coroutine of the task that blocked the loop, or None if it was not a task or was not caught in the act
+    task: Optional[str]
+    # Innermost frames of the event loop thread while it was blocked, or None if the stall was too short to capture
+    stack: Optional[str]
+
+
+class WatchdogStats(NamedTuple):
+    samples: int
+    median_lag: float
+    p99_lag: float
+    max_lag: float
+    # Counts of the rolling lag samples per bucket of `ROLLING_BUCKETS`, the last count is of the larger samples
+    histogram: tuple[int, ...]
+    stalls: int
+
+
+class LoopWatchdog:
+    """Measures the lag of the event loop and reports the stack of what blocked it.
+
+    A heartbeat task sleeps for short intervals and measures how much later than scheduled it resumes. A separate
+    thread checks the heartbeat, so while the loop is blocked for longer than `threshold` seconds, it can capture the
+    stack of the loop thread. When the heartbeat resumes, `on_stall` is called on the loop with the captured stall.
+    """
+
+    def __init__(
+        self,
+        threshold: Optional[float],
+        on_stall: Callable[[Stall], None],
+        observe: Optional[Callable[[float], None]] = None,
+    ) -> None:
+        """Create a watchdog.
+
+        Args:
+            threshold (float, optional): The lag in seconds from which on the loop is considered stalled, or None to
+                only measure the lag.
+            on_stall (Callable[[Stall], None]): Called on the event loop after a stall.
+            observe (Callable[[float], None], optional): Called with every measured lag, e.g. to update a metric.
+        """
+        self.threshold = threshold
+        self._on_stall = on_stall
+        self._observe = observe
+        self._lags: deque[float] = deque(maxlen=_ROLLING_SAMPLES)
+        self._stalls = 0
+        self._last_beat = monotonic()
+        # Heartbeat time of the stall captured by the thread, with the captured task and stack
+        self._captured: tuple[float, Optional[str], Optional[str]] = (0.0, None, None)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = threading.Event()
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = monotonic()
+        self._task = self._loop.create_task(self._heartbeat())
+        if self.threshold is not None:
+            self._stopping.clear()
+            threading.Thread(target=self._watch, name="QuoteBot loop watchdog", daemon=True).start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> WatchdogStats:
+        lags = sorted(self._lags)
+        histogram = [0] * (len(ROLLING_BUCKETS) + 1)
+        for lag in lags:
+            histogram[bisect.bisect_left(ROLLING_BUCKETS, lag)] += 1
+        if not lags:
+            return WatchdogStats(0, 0.0, 0.0, 0.0, tuple(histogram), self._stalls)
+        return WatchdogStats(
+            len(lags),
+            lags[len(lags) // 2],
+            lags[min(len(lags) - 1, int(len(lags) * 0.99))],
+            lags[-1],
+            tuple(histogram),
+            self._stalls,
+        )
+
+    async def _heartbeat(self) -> None:
+        while True:
+            self._last_beat = beat = monotonic()
+            await asyncio.sleep(_HEARTBEAT_INTERVAL)
+            lag = max(0.0, monotonic() - beat - _HEARTBEAT_INTERVAL)
+            self._lags.append(lag)
+            if self._observe is not None:
+                self._observe(lag)
+            if self.threshold is not None and lag >= self.threshold:
+                self._stalls += 1
+                captured_beat, task, stack = self._captured
+                if captured_beat != beat:
+                    task = stack = None
+                try:
+                    self._on_stall(Stall(lag, task, stack))
+                except Exception:
+                    traceback.print_exc()
+
+    def _watch(self) -> None:
+        """Capture the stack of the loop thread once per stall, run in a separate thread."""
+        assert self.threshold is not None
+        # Checks often enough to catch stalls that are just over the threshold
+        check_interval = max(0.01, self.threshold / 4)
+        while not self._stopping.wait(check_interval):
+            beat = self._last_beat
+            if monotonic() - beat < _HEARTBEAT_INTERVAL + self.threshold or self._captured[0] == beat:
+                continue
+            if (frame := sys._current_frames().get(self._loop_thread_id)) is None:  # type: ignore
+                continue
+            stack = "".join(traceback.format_stack(frame, _STACK_FRAMES))
+            task = None
+            if (current_task := asyncio.current_task(self._loop)) is not None:
+                task = f"{current_task.get_name()} ({getattr(current_task.get_coro(), '__qualname__', '?')})"
+            self._captured = (beat, task, stack)